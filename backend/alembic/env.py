@@ -8,7 +8,7 @@ from alembic import context
 # Import your SQLModel models and engine
 from database import DATABASE_URL
 from sqlmodel import SQLModel
-from db_models import User  # Import all your models
+from db_models import User, TelemetrySample  # Import all your models
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
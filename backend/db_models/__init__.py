@@ -1,5 +1,6 @@
 from .user import User
 from .sauna import Sauna
 from .sauna_session import SaunaSession
+from .telemetry_sample import TelemetrySample
 
-__all__ = ["User", "Sauna", "SaunaSession"]
+__all__ = ["User", "Sauna", "SaunaSession", "TelemetrySample"]
@@ -25,7 +25,8 @@ class SaunaSession(SQLModel, table=True):
     
     # Timestamps
     created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    # Bumped on every ORM update; recommend-session caches by the latest value
+    updated_at: datetime = Field(default_factory=datetime.utcnow, sa_column_kwargs={"onupdate": datetime.utcnow})
     
     class Config:
         json_schema_extra = {
@@ -0,0 +1,42 @@
+from sqlmodel import SQLModel, Field
+from sqlalchemy import Index
+from typing import Optional
+from datetime import datetime
+
+
+class TelemetrySample(SQLModel, table=True):
+    """
+    Telemetry Sample model
+
+    One reading pushed by a gateway or simulator through POST /api/v1/telemetry.
+    Rows are written in batches by services.telemetry_ingest; `recorded_at` is
+    the device's own (UTC) timestamp, `received_at` when the backend accepted it.
+    """
+    __tablename__ = "telemetry_samples"
+    __table_args__ = (
+        Index("ix_telemetry_samples_device_id_recorded_at", "device_id", "recorded_at"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    device_id: str = Field(max_length=255, description="Device that produced the reading")
+    recorded_at: datetime = Field(description="Time the reading was taken (UTC)")
+
+    # Reading values (a sample may carry only some of them)
+    temperature: Optional[float] = Field(default=None, description="Temperature in Celsius")
+    humidity: Optional[float] = Field(default=None, description="Relative humidity in percent")
+    target_temp: Optional[float] = Field(default=None, description="Target temperature in Celsius")
+    heating: Optional[bool] = Field(default=None, description="Whether the heater was on")
+
+    received_at: datetime = Field(default_factory=datetime.utcnow)
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "device_id": "junction-sauna-1",
+                "recorded_at": "2025-11-15T12:00:00",
+                "temperature": 82.5,
+                "humidity": 18.3,
+                "target_temp": 85.0,
+                "heating": True
+            }
+        }
@@ -0,0 +1,207 @@
+"""
+Structured Logging
+JSON log records written by a background thread, with per-request correlation
+IDs and sampled debug traces
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Correlation ID of the HTTP request being handled ("-" outside of requests)
+correlation_id: ContextVar[str] = ContextVar("correlation_id", default="-")
+# Whether debug traces are recorded for the current request (None: not in a request)
+_trace_sampled: ContextVar[Optional[bool]] = ContextVar("trace_sampled", default=None)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# Caller-supplied request IDs end up in every log record; anything else is replaced
+_REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_debug_sample_rate = 1.0
+
+
+def trace_enabled(logger: logging.Logger) -> bool:
+    """
+    True if `logger` would record a debug trace for the current request.
+
+    Guard expensive payload dumps with it so that building them costs nothing
+    when DEBUG is off or the request was not sampled.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    sampled = _trace_sampled.get()
+    return True if sampled is None else sampled
+
+
+class ContextFilter(logging.Filter):
+    """Stamp each record with the current correlation ID and drop unsampled debug records"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        if record.levelno <= logging.DEBUG and _trace_sampled.get() is False:
+            return False
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line; `extra={"fields": {...}}` adds structured fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "correlationId": getattr(record, "correlation_id", "-"),
+        }
+        fields = getattr(record, "fields", None)
+        if isinstance(fields, dict):
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _RenderingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueue records with only their message rendered; JSON encoding and I/O
+    happen on the listener thread. The message and structured fields are
+    snapshotted here because the caller may mutate them after logging returns.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if isinstance(getattr(record, "fields", None), dict):
+            record.fields = copy.deepcopy(record.fields)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(
+    level: Optional[str] = None,
+    fmt: Optional[str] = None,
+    debug_sample_rate: Optional[float] = None,
+) -> None:
+    """
+    Route all logging through a QueueHandler; a QueueListener thread formats
+    and writes records, so request handlers only pay for enqueueing.
+
+    Reads LOG_LEVEL (default INFO), LOG_FORMAT ("json" or "text", default json)
+    and LOG_DEBUG_SAMPLE_RATE (fraction of requests whose debug traces are
+    kept, default 1.0). Safe to call more than once; the last call wins.
+    """
+    global _listener, _debug_sample_rate
+
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    fmt = (fmt or os.getenv("LOG_FORMAT", "json")).lower()
+    if debug_sample_rate is None:
+        debug_sample_rate = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+    _debug_sample_rate = min(1.0, max(0.0, debug_sample_rate))
+
+    shutdown_logging()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if fmt == "text":
+        stream_handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s [%(correlation_id)s] %(message)s"
+        ))
+    else:
+        stream_handler.setFormatter(JSONFormatter())
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    queue_handler = _RenderingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # httpx logs every outbound request at INFO; keep that to DEBUG runs
+    logging.getLogger("httpx").setLevel(logging.DEBUG if level == "DEBUG" else logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging() -> None:
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
+
+
+access_logger = logging.getLogger("access")
+
+
+class CorrelationIdMiddleware:
+    """
+    Give every request a correlation ID (the caller's X-Request-ID if it is a
+    short token of letters, digits, ".", "_" and "-", otherwise a new one), decide whether its debug traces are sampled, log its outcome and
+    echo the ID back in the response headers.
+
+    A plain ASGI middleware rather than BaseHTTPMiddleware, so the context
+    stays set while a streamed response body (NDJSON, SSE) is produced.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = Headers(scope=scope).get(REQUEST_ID_HEADER)
+        if request_id is None or not _REQUEST_ID_PATTERN.fullmatch(request_id):
+            request_id = uuid.uuid4().hex
+        id_token = correlation_id.set(request_id)
+        sampled_token = _trace_sampled.set(random.random() < _debug_sample_rate)
+        started = time.perf_counter()
+        method, path = scope["method"], scope["path"]
+        fields: Dict[str, Any] = {"method": method, "path": path}
+
+        async def send_with_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                fields["status"] = message["status"]
+                MutableHeaders(scope=message)[REQUEST_ID_HEADER] = request_id
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+            fields["durationMs"] = round((time.perf_counter() - started) * 1000, 2)
+            access_logger.info("%s %s %s", method, path, fields.get("status"), extra={"fields": fields})
+        except Exception:
+            fields["durationMs"] = round((time.perf_counter() - started) * 1000, 2)
+            access_logger.exception("%s %s failed", method, path, extra={"fields": fields})
+            raise
+        finally:
+            correlation_id.reset(id_token)
+            _trace_sampled.reset(sampled_token)
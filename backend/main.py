@@ -3,7 +3,12 @@ import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from logging_config import CorrelationIdMiddleware, configure_logging
 from models import model_manager
+from services.ml_executor import ml_executor
+from services.harvia_api import harvia_service
+from services.telemetry_ingest import telemetry_ingestor
+from services.telemetry_poller import telemetry_poller
 from routes import (
     harvia_router,
     knn_router,
@@ -14,6 +19,8 @@ from routes import (
 )
 from database import create_db_and_tables
 
+# Structured logs are formatted and written off the request path (LOG_LEVEL, LOG_FORMAT)
+configure_logging()
 
 app = FastAPI(
     title="Junction Backend API",
@@ -30,8 +37,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
+# Per-request correlation IDs (X-Request-ID) and sampled debug traces
+app.add_middleware(CorrelationIdMiddleware)
+
 # Sauna backend (migrated from Go service)
 app.include_router(sauna_backend_router)
 
@@ -54,6 +65,26 @@ def on_startup():
         print("   To enable database features, start PostgreSQL: docker-compose up -d")
 
 
+@app.on_event("startup")
+async def start_harvia_client():
+    """Open the pooled HTTP client used for all Harvia Cloud API calls"""
+    await harvia_service.start()
+
+
+@app.on_event("shutdown")
+async def close_harvia_client():
+    """Stop telemetry polling, write queued pushed telemetry and close pooled Harvia connections"""
+    await telemetry_poller.close()
+    await telemetry_ingestor.close()
+    await harvia_service.close()
+
+
+@app.on_event("shutdown")
+def stop_ml_workers():
+    """Stop the ML worker pool; jobs still running are abandoned"""
+    ml_executor.shutdown()
+
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -72,12 +103,19 @@ async def health_check():
 
 @app.get("/models/status")
 async def models_status():
-    """Get training status of all models"""
+    """Get training status of all models, with the active and kept versions of each"""
     return {
-        "knn": model_manager.is_trained("knn")
+        "knn": model_manager.is_trained("knn"),
+        "versions": model_manager.registry.status()
     }
 
 
+@app.get("/models/executor")
+async def models_executor():
+    """ML worker pool saturation: running/queued jobs and outcome counters"""
+    return {"success": True, "executor": ml_executor.snapshot()}
+
+
 if __name__ == "__main__":
     import uvicorn
 
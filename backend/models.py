@@ -1,41 +1,206 @@
+from collections import OrderedDict
+from datetime import datetime
 from sklearn.neighbors import KNeighborsClassifier
-from typing import List
+from types import MappingProxyType
+from typing import Any, Dict, Hashable, List, Mapping, NamedTuple, Optional, Tuple
+import os
+import threading
 import numpy as np
 
 
+# Module-level so worker processes can run them (see services.ml_executor)
+def fit_knn(X: Any, y: Any, n_neighbors: int = 3) -> KNeighborsClassifier:
+    """Fit a new K-Nearest Neighbors model"""
+    model = KNeighborsClassifier(n_neighbors=n_neighbors)
+    model.fit(np.asarray(X), np.asarray(y))
+    return model
+
+
+def predict_with_model(model: Any, X: Any) -> List[int]:
+    """Class predictions of a fitted model as plain ints"""
+    return model.predict(np.asarray(X)).tolist()
+
+
+class ModelVersion(NamedTuple):
+    """One trained model; never refitted or modified once published"""
+    name: str
+    version: int
+    model: Any
+    trained_at: datetime
+    samples_trained: int
+    params: Mapping[str, Any]
+
+
+class _RegistryState(NamedTuple):
+    versions: Mapping[str, Mapping[int, ModelVersion]]
+    active: Mapping[str, int]
+
+
+class ModelRegistry:
+    """
+    Named, versioned trained models
+    
+    The registry contents are one immutable snapshot. Writers build a new
+    snapshot under a lock and publish it with a single reference assignment;
+    readers use whichever snapshot is current without locking, so they never
+    wait for training and never see a model that is still being fitted.
+    The newest `keep_versions` versions of each model are kept, plus the
+    active one.
+    """
+    
+    def __init__(self, keep_versions: int = 5):
+        self.keep_versions = max(1, keep_versions)
+        self._state = _RegistryState(MappingProxyType({}), MappingProxyType({}))
+        self._write_lock = threading.Lock()
+        self._last_version: Dict[str, int] = {}
+    
+    def _swap(self, name: str, versions: Dict[int, ModelVersion], active: Dict[str, int]) -> None:
+        all_versions = dict(self._state.versions)
+        all_versions[name] = MappingProxyType(versions)
+        self._state = _RegistryState(MappingProxyType(all_versions), MappingProxyType(active))
+    
+    def publish(
+        self,
+        name: str,
+        model: Any,
+        samples_trained: int,
+        params: Optional[Dict[str, Any]] = None,
+        activate: bool = True,
+    ) -> ModelVersion:
+        """Add a fully trained model as the next version of `name`"""
+        with self._write_lock:
+            version = self._last_version.get(name, 0) + 1
+            self._last_version[name] = version
+            entry = ModelVersion(
+                name, version, model, datetime.utcnow(), samples_trained, MappingProxyType(dict(params or {}))
+            )
+            state = self._state
+            active = dict(state.active)
+            if activate:
+                active[name] = version
+            versions = dict(state.versions.get(name, {}))
+            versions[version] = entry
+            for old in sorted(versions)[:-self.keep_versions]:
+                if old != active.get(name):
+                    del versions[old]
+            self._swap(name, versions, active)
+            return entry
+    
+    def activate(self, name: str, version: int) -> ModelVersion:
+        """Make a kept version of `name` the active one (e.g. to roll back)"""
+        with self._write_lock:
+            state = self._state
+            entry = state.versions.get(name, {}).get(version)
+            if entry is None:
+                raise ValueError(f"Model '{name}' has no version {version}")
+            active = dict(state.active)
+            active[name] = version
+            self._swap(name, dict(state.versions[name]), active)
+            return entry
+    
+    def get(self, name: str, version: Optional[int] = None) -> Optional[ModelVersion]:
+        """The active version of `name`, or a specific kept version"""
+        state = self._state
+        if version is None:
+            version = state.active.get(name)
+        return state.versions.get(name, {}).get(version)
+    
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        state = self._state
+        status = {}
+        for name, versions in state.versions.items():
+            active = versions.get(state.active.get(name))
+            status[name] = {
+                "active_version": active.version if active else None,
+                "versions": sorted(versions),
+                "trained_at": active.trained_at.isoformat() if active else None,
+                "samples_trained": active.samples_trained if active else None,
+            }
+        return status
+
+
 class MLModelManager:
     """Manager class for KNN model"""
     
-    def __init__(self):
-        self.models = {
-            "knn": None
-        }
+    MODEL_NAMES = ("knn",)
     
-    def train_knn(self, X: List[List[float]], y: List[int], n_neighbors: int = 3) -> None:
-        """Train K-Nearest Neighbors model"""
-        X_array = np.array(X)
-        y_array = np.array(y)
-        
-        self.models["knn"] = KNeighborsClassifier(n_neighbors=n_neighbors)
-        self.models["knn"].fit(X_array, y_array)
+    def __init__(self, user_cache_size: int = 1024, keep_versions: int = 5):
+        # Shared models trained through the API, published as immutable versions
+        self.registry = ModelRegistry(keep_versions=keep_versions)
+        # Per-user models: user key -> (data version, model, result), least recently used first
+        self.user_cache_size = user_cache_size
+        self._user_models: "OrderedDict[Hashable, Tuple[Hashable, Any, Any]]" = OrderedDict()
+        self._user_lock = threading.Lock()
+        self.user_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
     
-    def predict(self, model_name: str, X: List[List[float]]) -> List[int]:
-        """Make predictions using specified model"""
-        if model_name not in self.models:
+    def fit_knn(self, X: List[List[float]], y: List[int], n_neighbors: int = 3) -> KNeighborsClassifier:
+        """Fit a new K-Nearest Neighbors model without publishing it"""
+        return fit_knn(X, y, n_neighbors=n_neighbors)
+    
+    def train_knn(self, X: List[List[float]], y: List[int], n_neighbors: int = 3) -> ModelVersion:
+        """Train K-Nearest Neighbors model and make it the active version"""
+        return self.publish_knn(self.fit_knn(X, y, n_neighbors=n_neighbors), len(y), n_neighbors)
+    
+    def publish_knn(self, model: KNeighborsClassifier, samples_trained: int, n_neighbors: int) -> ModelVersion:
+        """Publish an already fitted KNN model as the active version"""
+        return self.registry.publish("knn", model, samples_trained=samples_trained, params={"n_neighbors": n_neighbors})
+    
+    def get_model(self, model_name: str, version: Optional[int] = None) -> ModelVersion:
+        """The active (or given) version of a model; ValueError if there is none"""
+        if model_name not in self.MODEL_NAMES:
             raise ValueError(f"Model '{model_name}' not recognized")
         
-        model = self.models[model_name]
-        if model is None:
+        entry = self.registry.get(model_name, version)
+        if entry is None:
+            if version is not None:
+                raise ValueError(f"Model '{model_name}' has no version {version}")
             raise ValueError(f"Model '{model_name}' has not been trained yet")
-        
-        X_array = np.array(X)
-        predictions = model.predict(X_array)
-        return predictions.tolist()
+        return entry
+    
+    def predict_with_version(
+        self, model_name: str, X: List[List[float]], version: Optional[int] = None
+    ) -> Tuple[List[int], ModelVersion]:
+        """Make predictions using the active (or given) version; returns (predictions, version used)"""
+        entry = self.get_model(model_name, version)
+        return predict_with_model(entry.model, X), entry
+    
+    def predict(self, model_name: str, X: List[List[float]]) -> List[int]:
+        """Make predictions using specified model"""
+        return self.predict_with_version(model_name, X)[0]
     
     def is_trained(self, model_name: str) -> bool:
         """Check if a model has been trained"""
-        return self.models.get(model_name) is not None
+        return self.registry.get(model_name) is not None
+    
+    def cached_user_result(self, user_key: Hashable, version: Hashable) -> Optional[Any]:
+        """
+        Result cached from one user's data, if their data has not changed since
+        
+        `version` identifies the state of the user's data (e.g. session count and
+        latest update time); a cached entry built at another version is a miss.
+        Per-user models are never published to the shared `registry`.
+        """
+        with self._user_lock:
+            entry = self._user_models.get(user_key)
+            if entry is not None and entry[0] == version:
+                self._user_models.move_to_end(user_key)
+                self.user_cache_stats["hits"] += 1
+                return entry[2]
+            self.user_cache_stats["misses"] += 1
+            return None
+    
+    def store_user_result(self, user_key: Hashable, version: Hashable, model: Any, result: Any) -> None:
+        """Cache the model and result built from a user's data at `version`"""
+        with self._user_lock:
+            self._user_models[user_key] = (version, model, result)
+            self._user_models.move_to_end(user_key)
+            while len(self._user_models) > self.user_cache_size:
+                self._user_models.popitem(last=False)
+                self.user_cache_stats["evictions"] += 1
 
 
 # Global model manager instance
-model_manager = MLModelManager()
+model_manager = MLModelManager(
+    user_cache_size=int(os.getenv("ML_USER_MODEL_CACHE_SIZE", "1024")),
+    keep_versions=int(os.getenv("ML_MODEL_KEEP_VERSIONS", "5")),
+)
@@ -3,12 +3,26 @@ Harvia API Routes
 Endpoints for authentication and device management with Harvia Cloud API
 """
 
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import Optional
+import hmac
+import json
+import logging
+import os
+from typing import Any, AsyncIterator, List, Optional
 
+from logging_config import trace_enabled
+from services.command_queue import CommandTicket, device_command_queue
+from services.device_cache import device_list_cache, device_state_responses
+from services.device_normalizer import device_normalizer
+from services.device_stream import DeviceStream
+from services.etag import SerializedResponse, conditional_response
+from services.fast_json import FastJSONResponse, construct, dumps
 from services.harvia_api import harvia_service, HarviaAPIError
+from services.identity import token_fingerprint
+from services.telemetry_poller import telemetry_poller
+from services.token_manager import token_manager
 from schemas import (
     AuthRequest,
     AuthResponse,
@@ -16,17 +30,36 @@ from schemas import (
     DevicesResponse,
     DeviceStateResponse,
     TelemetryResponse,
+    BulkDeviceResponse,
+    BulkDeviceResult,
     DeviceCommandRequest,
     DeviceTargetRequest,
     ErrorResponse,
-    Device,
 )
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/harvia", tags=["Harvia API"])
 
 # Security scheme for Swagger UI
 security = HTTPBearer()
 
+# The /metrics routes expose internal state: they need X-Metrics-Key, or an
+# explicit opt-in for local development
+METRICS_KEY = os.getenv("HARVIA_METRICS_KEY", "")
+METRICS_OPEN = os.getenv("HARVIA_METRICS_OPEN", "false").lower() in ("1", "true", "yes")
+
+
+def require_metrics_access(x_metrics_key: Optional[str] = Header(None)) -> None:
+    if not METRICS_KEY:
+        if METRICS_OPEN:
+            return
+        raise HTTPException(
+            status_code=403, detail="Metrics are disabled: set HARVIA_METRICS_KEY (or HARVIA_METRICS_OPEN=true)"
+        )
+    if x_metrics_key is None or not hmac.compare_digest(x_metrics_key.encode("utf-8"), METRICS_KEY.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid or missing X-Metrics-Key")
+
 
 def _handle_api_error(error: HarviaAPIError) -> JSONResponse:
     """Handle Harvia API errors and return appropriate response"""
@@ -50,13 +83,14 @@ async def login(auth_request: AuthRequest):
     The idToken should be included in the Authorization header for subsequent requests.
     Tokens expire after 1 hour and can be refreshed using the refresh endpoint.
     """
-    print(f"🔐 DEBUG: Login attempt for username: {auth_request.username}")
+    logger.debug("Login attempt for username %s", auth_request.username)
     try:
         tokens = await harvia_service.authenticate(
             auth_request.username,
             auth_request.password
         )
-        print(f"✅ DEBUG: Authentication successful")
+        logger.info("Harvia authentication successful")
+        token_manager.register(auth_request.username, tokens.get("refreshToken"), tokens)
         return AuthResponse(
             success=True,
             idToken=tokens["idToken"],
@@ -65,10 +99,10 @@ async def login(auth_request: AuthRequest):
             expiresIn=tokens["expiresIn"]
         )
     except HarviaAPIError as e:
-        print(f"❌ DEBUG: HarviaAPIError - Status: {e.status_code}, Message: {e.message}")
+        logger.warning("Harvia login failed (status %s): %s", e.status_code, e.message)
         return _handle_api_error(e)
     except Exception as e:
-        print(f"❌ DEBUG: Unexpected error: {type(e).__name__}: {str(e)}")
+        logger.exception("Unexpected error during Harvia login")
         return JSONResponse(
             status_code=500,
             content={
@@ -86,12 +120,16 @@ async def refresh_token(refresh_request: TokenRefreshRequest):
     
     Use this endpoint when your ID token expires (after ~1 hour).
     Returns new ID and access tokens.
+    
+    Sessions started with /auth/login are also refreshed server-side shortly
+    before expiry, so routes keep accepting the original ID token.
     """
     try:
         tokens = await harvia_service.refresh_token(
             refresh_request.refreshToken,
             refresh_request.email
         )
+        token_manager.register(refresh_request.email, refresh_request.refreshToken, tokens)
         return AuthResponse(
             success=True,
             idToken=tokens["idToken"],
@@ -112,8 +150,135 @@ async def refresh_token(refresh_request: TokenRefreshRequest):
         )
 
 
+# Upper bound on devices per bulk state/telemetry request
+MAX_BULK_DEVICES = 100
+
+
+def _parse_device_ids(ids: str) -> List[str]:
+    """Split a comma-separated `ids` query parameter, dropping blanks and duplicates"""
+    device_ids = []
+    for device_id in ids.split(","):
+        device_id = device_id.strip()
+        if device_id and device_id not in device_ids:
+            device_ids.append(device_id)
+    return device_ids
+
+
+def _bulk_response(entries: List[dict]) -> FastJSONResponse:
+    # Entries come from harvia_service.get_many, already in BulkDeviceResult shape
+    return FastJSONResponse(construct(BulkDeviceResponse, {
+        "success": True,
+        "results": [construct(BulkDeviceResult, entry) for entry in entries],
+        "count": len(entries),
+        "failed": sum(1 for entry in entries if not entry["success"])
+    }))
+
+
+def _invalid_bulk_ids(device_ids: List[str]) -> Optional[JSONResponse]:
+    if not device_ids:
+        message = "Query parameter 'ids' must list at least one device ID"
+    elif len(device_ids) > MAX_BULK_DEVICES:
+        message = f"At most {MAX_BULK_DEVICES} device IDs can be requested at once"
+    else:
+        return None
+    return JSONResponse(
+        status_code=400,
+        content={"success": False, "error": message, "statusCode": 400}
+    )
+
+
+def _build_devices_response(devices_data: Any) -> DevicesResponse:
+    """
+    Normalize a raw Harvia devices payload (GraphQL or REST) into a DevicesResponse.
+    """
+    # Parse devices data based on the actual API response structure
+    # The actual structure may vary, so we handle different formats
+    devices_list = []
+    
+    if isinstance(devices_data, dict):
+        # If the response contains a 'devices' or 'data' key
+        devices = devices_data.get("devices") or devices_data.get("data") or []
+    elif isinstance(devices_data, list):
+        devices = devices_data
+    else:
+        devices = []
+    
+    logger.debug("Normalizing %d devices", len(devices))
+    # Raw payload dumps are only built for sampled requests with DEBUG on
+    trace = trace_enabled(logger)
+    
+    # Convert to our Device schema; unchanged payloads are served from the normalizer's memo
+    for device_data in devices:
+        try:
+            if trace:
+                logger.debug("Raw device data", extra={"fields": {"device": device_data}})
+            devices_list.append(device_normalizer.normalize(device_data))
+        except Exception as e:
+            # If parsing fails, log but continue
+            logger.warning("Could not parse device data: %s", e)
+            if trace:
+                logger.debug("Unparseable device data", extra={"fields": {"device": device_data}})
+            continue
+    
+    partial = isinstance(devices_data, dict) and bool(devices_data.get("partial"))
+    timed_out = devices_data.get("timedOut", []) if isinstance(devices_data, dict) else []
+    
+    return construct(DevicesResponse, {
+        "success": True,
+        "devices": devices_list,
+        "count": len(devices_list),
+        "partial": partial,
+        "timedOut": timed_out
+    })
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def _wants_ndjson(request: Request, stream: bool) -> bool:
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+async def _ndjson_devices(stream: DeviceStream) -> AsyncIterator[bytes]:
+    """
+    One `{"type": "device", "device": {...}}` line per device as it is ready,
+    then an `{"type": "end", ...}` trailer with counts, timeouts and errors.
+    """
+    count = 0
+    errors: List[dict] = []
+    failure = None
+    try:
+        async for _, device_data in stream.items():
+            try:
+                device = device_normalizer.normalize(device_data)
+            except Exception as e:
+                logger.warning("Could not parse device data: %s", e)
+                errors.append({"deviceIds": [device_data.get("id")], "error": f"Could not parse device data: {e}"})
+                continue
+            count += 1
+            yield b'{"type":"device","device":' + dumps(device) + b"}\n"
+    except Exception as e:
+        logger.exception("Device stream failed after %d devices", count)
+        failure = f"Internal server error: {str(e)}"
+    
+    trailer = {
+        "type": "end",
+        "success": failure is None,
+        "count": count,
+        "total": stream.count,
+        "partial": stream.partial or bool(errors) or failure is not None,
+        "timedOut": stream.timed_out,
+        "errors": stream.errors + errors,
+    }
+    if failure is not None:
+        trailer["error"] = failure
+    yield dumps(trailer) + b"\n"
+
+
 @router.get("/devices", response_model=DevicesResponse)
 async def get_devices(
+    request: Request,
+    stream: bool = Query(False, description="Stream devices as NDJSON as each one is ready (same as Accept: application/x-ndjson)"),
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
     """
@@ -123,240 +288,42 @@ async def get_devices(
     Click the 🔓 Authorize button at the top to enter your token.
     
     Note: You can use either idToken or accessToken - the endpoint will try both.
+    
+    Responses carry an ETag; send it back in If-None-Match to get 304 Not Modified
+    while the device list is unchanged.
+    
+    With `Accept: application/x-ndjson` or `?stream=1` the response is
+    newline-delimited JSON instead: a `{"type": "device", ...}` line per device
+    as soon as its enrichment finishes, then a `{"type": "end", ...}` trailer
+    with counts, timed-out devices and errors. Streamed listings always go
+    upstream (no cache or ETag).
     """
-    token = credentials.credentials
-    print(f"🔑 DEBUG: Received token (first 30 chars): {token[:30]}...")
+    token = await token_manager.resolve(credentials.credentials)
     
     try:
-        print(f"🔍 DEBUG: Attempting to fetch devices...")
-        devices_data = await harvia_service.get_devices(token)
-        print(f"✅ DEBUG: Received devices data: {type(devices_data)}")
-
-        print("devices_data", devices_data)
+        if _wants_ndjson(request, stream):
+            # Listing errors surface here with a proper status, before the first line
+            device_stream = await harvia_service.stream_devices(token)
+            return StreamingResponse(_ndjson_devices(device_stream), media_type=NDJSON_MEDIA_TYPE)
         
-        # Parse devices data based on the actual API response structure
-        # The actual structure may vary, so we handle different formats
-        devices_list = []
+        async def load_devices() -> SerializedResponse:
+            logger.debug("Fetching devices from Harvia")
+            devices_data = await harvia_service.get_devices(token)
+            
+            if trace_enabled(logger):
+                logger.debug("Received devices data", extra={"fields": {"devicesData": devices_data}})
+            return SerializedResponse(_build_devices_response(devices_data))
         
-        if isinstance(devices_data, dict):
-            # If the response contains a 'devices' or 'data' key
-            devices = devices_data.get("devices") or devices_data.get("data") or []
-        elif isinstance(devices_data, list):
-            devices = devices_data
-        else:
-            devices = []
-        
-        print(f"📊 DEBUG: Found {len(devices)} devices to process")
-        
-        # Convert to our Device schema and enhance with parsed attributes
-        for device_data in devices:
-            try:
-                print(f"🔍 DEBUG: Raw device data: {device_data}")
-                
-                # Set id from name if not present (for REST API responses where name is the device ID)
-                if "id" not in device_data and "name" in device_data:
-                    device_data["id"] = device_data["name"]
-                    print(f"📝 DEBUG: Set id from name field: {device_data['id']}")
-                
-                # Set name from id if not present (GraphQL responses use id, not name)
-                if "name" not in device_data and "id" in device_data:
-                    device_data["name"] = device_data["id"]
-                    print(f"📝 DEBUG: Set name from id field: {device_data['name']}")
-                
-                # Handle displayName from GraphQL response (top-level field) - rare but possible
-                if "displayName" in device_data and device_data["displayName"]:
-                    print(f"✅ DEBUG: Found displayName at top level: {device_data['displayName']}")
-                
-                # Handle connection status from GraphQL (top-level field)
-                if "connected" in device_data:
-                    device_data["isConnected"] = device_data["connected"] if isinstance(device_data["connected"], bool) else device_data["connected"].lower() == "true"
-                
-                # Handle timestamps from GraphQL (top-level fields)
-                timestamp_fields = ["lastActivity", "lastConnectionTime", "lastSeen", "updatedAt", "createdAt"]
-                if not device_data.get("lastSeen"):
-                    for field in timestamp_fields:
-                        if field in device_data and device_data[field]:
-                            device_data["lastSeen"] = device_data[field]
-                            print(f"✅ DEBUG: Using {field} as lastSeen: {device_data[field]}")
-                            break
-                
-                # Parse attr array to extract useful fields (for REST API responses)
-                if "attr" in device_data and isinstance(device_data["attr"], list):
-                    attrs = {item["key"]: item["value"] for item in device_data["attr"] if "key" in item and "value" in item}
-                    print(f"📋 DEBUG: Parsed attributes for device {device_data.get('id') or device_data.get('name')}: {attrs}")
-                    print(f"📋 DEBUG: All attr keys available: {list(attrs.keys())}")
-                    
-                    # Extract display name from attrs if not already set
-                    # The display name is typically in the attr array with key "name"
-                    # But we need to distinguish it from the device ID/name field
-                    if not device_data.get("displayName"):
-                        # Try different name fields in priority order
-                        # "name" in attr array is typically the user-friendly display name
-                        # We want to avoid using serial numbers or device IDs
-                        name_fields = ["name", "displayName", "alias", "deviceName"]
-                        for field in name_fields:
-                            if field in attrs and attrs[field]:
-                                attr_value = attrs[field]
-                                # Skip if it looks like a serial number or device ID (contains dashes/underscores and is long)
-                                if len(attr_value) > 20 and ('-' in attr_value or '_' in attr_value):
-                                    print(f"⚠️ DEBUG: Skipping {field}='{attr_value}' as it looks like a device ID/serial")
-                                    continue
-                                device_data["displayName"] = attr_value
-                                print(f"✅ DEBUG: Using attr['{field}']='{attr_value}' as displayName")
-                                break
-                        
-                        # If we still don't have a displayName, create a user-friendly name from available data
-                        # Note: The official Harvia dashboard shows names like "HypeMen", "MiniSaunaFenx"
-                        # These are likely set via devicesUpdate mutation, but for now we'll create reasonable fallbacks
-                        if not device_data.get("displayName"):
-                            device_type = device_data.get("type", "Device")
-                            city = attrs.get("city")
-                            serial = attrs.get("serialNumber")
-                            organization = attrs.get("organization", "")
-                            
-                            # Try to create a meaningful name
-                            # Priority: Use city if available (most user-friendly)
-                            if city:
-                                # Format: "DeviceType City" (e.g., "Fenix Espoo")
-                                device_data["displayName"] = f"{device_type} {city}"
-                                print(f"✅ DEBUG: Created displayName from type and city: {device_data['displayName']}")
-                            elif serial and len(serial) < 15 and not serial.startswith("simulated"):
-                                # Only use serial if it's short and not a simulated device
-                                # Format: "DeviceType Serial" (e.g., "SaunaSensor 25454C0021")
-                                device_data["displayName"] = f"{device_type} {serial}"
-                                print(f"✅ DEBUG: Created displayName from type and serial: {device_data['displayName']}")
-                            else:
-                                # Fallback: Use device type with a short ID suffix
-                                short_id = device_data.get("id", "")[-8:] if device_data.get("id") else ""
-                                if short_id:
-                                    device_data["displayName"] = f"{device_type} {short_id}"
-                                else:
-                                    device_data["displayName"] = device_type
-                                print(f"✅ DEBUG: Created displayName fallback: {device_data['displayName']}")
-                    
-                    # Extract connection status from attrs if not already set
-                    if "isConnected" not in device_data and "connected" in attrs:
-                        device_data["isConnected"] = attrs["connected"].lower() == "true"
-                    
-                    # Extract timestamps from attrs if not already set
-                    if not device_data.get("lastSeen"):
-                        for field in timestamp_fields:
-                            if field in attrs and attrs[field]:
-                                device_data["lastSeen"] = attrs[field]
-                                break
-                    
-                    # Extract location information
-                    if not device_data.get("location"):
-                        location_data = {}
-                        # Try to get location name from city or location attribute
-                        if attrs.get("city"):
-                            location_data["name"] = attrs["city"]
-                        elif attrs.get("location"):
-                            location_data["name"] = attrs["location"]
-                        elif attrs.get("country"):
-                            location_data["name"] = attrs["country"]
-                        
-                        # Extract coordinates - try GPS first, then WiFi-based as fallback
-                        latitude = None
-                        longitude = None
-                        
-                        # Try GPS coordinates first
-                        if attrs.get("latitude"):
-                            try:
-                                latitude = float(attrs["latitude"])
-                            except (ValueError, TypeError):
-                                pass
-                        if attrs.get("longitude"):
-                            try:
-                                longitude = float(attrs["longitude"])
-                            except (ValueError, TypeError):
-                                pass
-                        
-                        # If GPS coordinates not available, try WiFi-based coordinates
-                        if latitude is None and attrs.get("w_latitude"):
-                            try:
-                                latitude = float(attrs["w_latitude"])
-                            except (ValueError, TypeError):
-                                pass
-                        if longitude is None and attrs.get("w_longitude"):
-                            try:
-                                longitude = float(attrs["w_longitude"])
-                            except (ValueError, TypeError):
-                                pass
-                        
-                        # If we have at least coordinates, create location object
-                        if latitude is not None and longitude is not None:
-                            location_data["latitude"] = latitude
-                            location_data["longitude"] = longitude
-                            if not location_data.get("name"):
-                                # Use city, country, or default
-                                if attrs.get("city"):
-                                    location_data["name"] = attrs["city"]
-                                elif attrs.get("country"):
-                                    location_data["name"] = attrs["country"]
-                                else:
-                                    location_data["name"] = "Unknown Location"
-                            device_data["location"] = location_data
-                            print(f"✅ DEBUG: Extracted location: {location_data}")
-                    
-                    # Extract battery level if available
-                    if "batteryLevel" not in device_data:
-                        battery_fields = ["batteryLevel", "battery", "batteryPercent", "batteryPercentage"]
-                        for field in battery_fields:
-                            if field in attrs:
-                                try:
-                                    device_data["batteryLevel"] = float(attrs[field])
-                                    print(f"✅ DEBUG: Found battery level: {device_data['batteryLevel']}")
-                                    break
-                                except (ValueError, TypeError):
-                                    continue
-                    
-                    # Extract signal strength if available
-                    if "signalStrength" not in device_data:
-                        signal_fields = ["signalStrength", "signal", "rssi", "wifiSignal", "wifiRSSI"]
-                        for field in signal_fields:
-                            if field in attrs:
-                                try:
-                                    device_data["signalStrength"] = float(attrs[field])
-                                    print(f"✅ DEBUG: Found signal strength: {device_data['signalStrength']}")
-                                    break
-                                except (ValueError, TypeError):
-                                    continue
-                    
-                    # Extract additional useful metadata
-                    # Store brand, serial number, organization, etc. as extra fields
-                    if attrs.get("brand"):
-                        device_data["brand"] = attrs["brand"]
-                    if attrs.get("serialNumber"):
-                        device_data["serialNumber"] = attrs["serialNumber"]
-                    if attrs.get("organization"):
-                        device_data["organization"] = attrs["organization"]
-                    if attrs.get("country"):
-                        device_data["country"] = attrs["country"]
-                    if attrs.get("city"):
-                        device_data["city"] = attrs["city"]
-                    if attrs.get("espChip"):
-                        device_data["espChip"] = attrs["espChip"]
-                    if attrs.get("firmwareVersion"):
-                        device_data["firmwareVersion"] = attrs["firmwareVersion"]
-                
-                device = Device(**device_data)
-                devices_list.append(device)
-            except Exception as e:
-                # If parsing fails, log but continue
-                print(f"⚠️ Warning: Could not parse device data: {e}")
-                print(f"   Raw data was: {device_data}")
-                continue
-        
-
-        
-        return DevicesResponse(
-            success=True,
-            devices=devices_list,
-            count=len(devices_list)
+        # Serve repeat loads (already serialized) from the per-caller cache;
+        # partial results are not cached
+        payload = await device_list_cache.get(
+            token_fingerprint(token),
+            load_devices,
+            cache_if=lambda cached: not cached.model.partial
         )
+        return conditional_response(request, payload)
     except HarviaAPIError as e:
-        print(f"❌ DEBUG: Harvia API Error: {e.message} (status: {e.status_code})")
+        logger.warning("Harvia API error listing devices (status %s): %s", e.status_code, e.message)
         
         # If it's a 401/403, provide helpful message about permissions
         if e.status_code in [401, 403]:
@@ -384,25 +351,103 @@ async def get_devices(
         )
 
 
+@router.get("/devices/state", response_model=BulkDeviceResponse)
+async def get_devices_state_bulk(
+    ids: str = Query(..., description="Comma-separated device IDs, e.g. ids=a,b,c"),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """
+    Get device state (shadow) for many devices in one request.
+    
+    Devices are fetched concurrently; each entry in `results` reports its own
+    success or error, so one failing device does not fail the whole request.
+    
+    Requires authentication token. Use the 🔓 Authorize button at the top.
+    """
+    id_token = await token_manager.resolve(credentials.credentials)
+    device_ids = _parse_device_ids(ids)
+    invalid = _invalid_bulk_ids(device_ids)
+    if invalid is not None:
+        return invalid
+    
+    try:
+        entries = await harvia_service.get_many(
+            device_ids,
+            lambda device_id: harvia_service.get_device_state(id_token, device_id)
+        )
+        return _bulk_response(entries)
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={
+                "success": False,
+                "error": f"Internal server error: {str(e)}",
+                "statusCode": 500
+            }
+        )
+
+
+@router.get("/devices/telemetry", response_model=BulkDeviceResponse)
+async def get_devices_telemetry_bulk(
+    ids: str = Query(..., description="Comma-separated device IDs, e.g. ids=a,b,c"),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """
+    Get latest telemetry for many devices in one request.
+    
+    Devices are read concurrently through the shared telemetry poller; each
+    entry in `results` reports its own success or error.
+    
+    Requires authentication token. Use the 🔓 Authorize button at the top.
+    """
+    id_token = await token_manager.resolve(credentials.credentials)
+    device_ids = _parse_device_ids(ids)
+    invalid = _invalid_bulk_ids(device_ids)
+    if invalid is not None:
+        return invalid
+    
+    try:
+        entries = await harvia_service.get_many(
+            device_ids,
+            lambda device_id: telemetry_poller.get_latest(id_token, device_id)
+        )
+        return _bulk_response(entries)
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={
+                "success": False,
+                "error": f"Internal server error: {str(e)}",
+                "statusCode": 500
+            }
+        )
+
+
 @router.get("/devices/{device_id}/state", response_model=DeviceStateResponse)
 async def get_device_state(
     device_id: str,
+    request: Request,
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
     """
     Get device state (shadow) from Harvia API.
     
     Requires authentication token. Use the 🔓 Authorize button at the top.
+    
+    Responses carry an ETag; send it back in If-None-Match to get 304 Not Modified
+    while the state is unchanged.
     """
-    id_token = credentials.credentials
+    id_token = await token_manager.resolve(credentials.credentials)
     
     try:
         state_data = await harvia_service.get_device_state(id_token, device_id)
-        return DeviceStateResponse(
-            success=True,
-            deviceId=device_id,
-            state=state_data
-        )
+        # Unchanged state reuses the body and ETag serialized on the last request
+        payload = device_state_responses.get(device_id, state_data, lambda: construct(DeviceStateResponse, {
+            "success": True,
+            "deviceId": device_id,
+            "state": state_data
+        }))
+        return conditional_response(request, payload)
     except HarviaAPIError as e:
         return _handle_api_error(e)
     except Exception as e:
@@ -430,10 +475,15 @@ async def update_device_name(
     This will set the "name" attribute in the device's attr array, which will then
     be used as the display name in the UI.
     """
-    id_token = credentials.credentials
+    id_token = await token_manager.resolve(credentials.credentials)
     
     try:
         result = await harvia_service.update_device_name(id_token, device_id, display_name)
+        # Cached device lists containing this device now carry the old name
+        device_list_cache.invalidate(token_fingerprint(id_token))
+        device_list_cache.invalidate_where(
+            lambda cached: any(device.id == device_id for device in cached.model.devices)
+        )
         return JSONResponse(
             status_code=200,
             content={
@@ -464,11 +514,14 @@ async def get_device_telemetry(
     Get latest telemetry data for a device.
     
     Requires authentication token. Use the 🔓 Authorize button at the top.
+    
+    Served from the shared telemetry poller: every viewer of a device reads the
+    same sample, which is fetched upstream once per poll interval.
     """
-    id_token = credentials.credentials
+    id_token = await token_manager.resolve(credentials.credentials)
     
     try:
-        telemetry_data = await harvia_service.get_latest_telemetry(id_token, device_id)
+        telemetry_data = await telemetry_poller.get_latest(id_token, device_id)
         return TelemetryResponse(
             success=True,
             deviceId=device_id,
@@ -487,29 +540,87 @@ async def get_device_telemetry(
         )
 
 
+@router.get("/devices/{device_id}/telemetry/stream")
+async def stream_device_telemetry(
+    device_id: str,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """
+    Stream telemetry for a device as Server-Sent Events.
+    
+    Sends the latest sample immediately, then every new sample from the shared
+    poller until the client disconnects.
+    
+    Requires authentication token. Use the 🔓 Authorize button at the top.
+    """
+    id_token = await token_manager.resolve(credentials.credentials)
+    samples = telemetry_poller.subscribe(id_token, device_id)
+    
+    try:
+        # Fetch the first sample up front so auth/upstream errors get a proper status
+        first = await samples.__anext__()
+    except HarviaAPIError as e:
+        return _handle_api_error(e)
+    
+    async def events():
+        sample = first
+        try:
+            while True:
+                payload = {"success": True, "deviceId": device_id, "data": sample}
+                yield f"data: {json.dumps(payload)}\n\n"
+                sample = await samples.__anext__()
+        finally:
+            await samples.aclose()
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+async def _ticket_response(ticket: CommandTicket, wait: bool):
+    """Route response for a queued command: its outcome, or 202 with the ticket ID"""
+    if not wait:
+        return JSONResponse(
+            status_code=202,
+            content={"success": True, "commandId": ticket.id, "status": ticket.status},
+        )
+    await ticket.wait()
+    if ticket.status == "failed":
+        return _handle_api_error(HarviaAPIError(ticket.error, ticket.status_code))
+    return {
+        "success": True,
+        "data": ticket.result,
+        "commandId": ticket.id,
+        "status": ticket.status,
+        "coalesced": ticket.coalesced,
+    }
+
+
 @router.post("/devices/command")
 async def send_device_command(
     command_request: DeviceCommandRequest,
+    wait: bool = Query(True, description="Wait for the upstream result instead of returning 202 with a command ID"),
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
     """
     Send a command to a device.
     
+    An idempotent command (`idempotent: true`, or configured in
+    HARVIA_IDEMPOTENT_COMMANDS) identical to one already in flight or sent
+    within the last moment is not sent again; the caller gets its result with
+    status "duplicate". Other commands are always sent.
+    
     Requires authentication token. Use the 🔓 Authorize button at the top.
     """
-    id_token = credentials.credentials
+    id_token = await token_manager.resolve(credentials.credentials)
     
     try:
-        result = await harvia_service.send_device_command(
+        ticket = device_command_queue.send_command(
             id_token,
             command_request.deviceId,
             command_request.command,
-            command_request.parameters
+            command_request.parameters,
+            idempotent=command_request.idempotent
         )
-        return {
-            "success": True,
-            "data": result
-        }
+        return await _ticket_response(ticket, wait)
     except HarviaAPIError as e:
         return _handle_api_error(e)
     except Exception as e:
@@ -526,26 +637,28 @@ async def send_device_command(
 @router.patch("/devices/target")
 async def set_device_target(
     target_request: DeviceTargetRequest,
+    wait: bool = Query(True, description="Wait for the upstream result instead of returning 202 with a command ID"),
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
     """
     Set target temperature and/or humidity for a device.
     
+    Updates arriving in quick succession (e.g. while dragging a slider) are
+    merged and only the latest values are sent; `coalesced` in the response
+    counts the updates that shared one upstream call.
+    
     Requires authentication token. Use the 🔓 Authorize button at the top.
     """
-    id_token = credentials.credentials
+    id_token = await token_manager.resolve(credentials.credentials)
     
     try:
-        result = await harvia_service.set_device_target(
+        ticket = device_command_queue.set_target(
             id_token,
             target_request.deviceId,
             target_request.temperature,
             target_request.humidity
         )
-        return {
-            "success": True,
-            "data": result
-        }
+        return await _ticket_response(ticket, wait)
     except HarviaAPIError as e:
         return _handle_api_error(e)
     except Exception as e:
@@ -558,3 +671,121 @@ async def set_device_target(
             }
         )
 
+
+@router.get("/commands/{command_id}")
+async def get_command_status(
+    command_id: str,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """
+    Status of a command or target update queued with `wait=false`.
+    
+    Requires authentication token. Use the 🔓 Authorize button at the top.
+    """
+    id_token = await token_manager.resolve(credentials.credentials)
+    ticket = device_command_queue.get_ticket(command_id, id_token)
+    if ticket is None:
+        return JSONResponse(
+            status_code=404,
+            content={"success": False, "error": "Unknown command", "statusCode": 404}
+        )
+    return {"success": True, "command": ticket.snapshot()}
+
+
+@router.get("/metrics/pool", dependencies=[Depends(require_metrics_access)])
+async def get_pool_metrics():
+    """
+    Connection pool usage for outbound Harvia API traffic.
+    
+    Reports pool configuration, request counters, per-host in-flight requests
+    and the number of open/idle connections. Like every /metrics route it
+    needs the X-Metrics-Key header (HARVIA_METRICS_KEY).
+    """
+    return {
+        "success": True,
+        "pool": harvia_service.pool_stats()
+    }
+
+
+@router.get("/metrics/breakers", dependencies=[Depends(require_metrics_access)])
+async def get_breaker_metrics():
+    """
+    Circuit breaker state per upstream Harvia host (closed / open / half_open,
+    consecutive failures, seconds until the next trial request) and retry counters.
+    """
+    return {
+        "success": True,
+        "resilience": harvia_service.resilience_stats()
+    }
+
+
+@router.get("/metrics/rate-limit", dependencies=[Depends(require_metrics_access)])
+async def get_rate_limit_metrics():
+    """
+    Outbound rate limiter: configured rates, current queue depth, wait times
+    and requests rejected because the wait would have been too long.
+    """
+    return {
+        "success": True,
+        "rateLimit": harvia_service.rate_limit_stats()
+    }
+
+
+@router.get("/metrics/device-cache", dependencies=[Depends(require_metrics_access)])
+async def get_device_cache_metrics():
+    """
+    Device list cache usage (hits, stale hits served during refresh, misses, evictions),
+    and reuse of serialized device state responses.
+    """
+    return {
+        "success": True,
+        "cache": device_list_cache.snapshot(),
+        "stateResponses": device_state_responses.snapshot()
+    }
+
+
+@router.get("/metrics/normalizer", dependencies=[Depends(require_metrics_access)])
+async def get_normalizer_metrics():
+    """
+    Device normalizer memo usage (payloads served from the memo versus normalized).
+    """
+    return {
+        "success": True,
+        "normalizer": device_normalizer.snapshot()
+    }
+
+
+@router.get("/metrics/telemetry", dependencies=[Depends(require_metrics_access)])
+async def get_telemetry_metrics():
+    """
+    Shared telemetry poller usage: watched devices, stream subscribers, upstream
+    fetches versus reads served from the shared sample.
+    """
+    return {
+        "success": True,
+        "telemetry": telemetry_poller.snapshot()
+    }
+
+
+@router.get("/metrics/tokens", dependencies=[Depends(require_metrics_access)])
+async def get_token_metrics():
+    """
+    Token manager: tracked sessions, refreshes done ahead of expiry, failed
+    refreshes, and expired or superseded tokens passed through unresolved.
+    """
+    return {
+        "success": True,
+        "tokens": token_manager.snapshot()
+    }
+
+
+@router.get("/metrics/commands", dependencies=[Depends(require_metrics_access)])
+async def get_command_metrics():
+    """
+    Device command queue: target updates and commands received versus sent
+    upstream, duplicates suppressed and updates still waiting to be merged.
+    """
+    return {
+        "success": True,
+        "commands": device_command_queue.snapshot()
+    }
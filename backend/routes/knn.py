@@ -1,156 +1,229 @@
-from fastapi import APIRouter, HTTPException, Depends
-from sqlmodel import Session, select
+import asyncio
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import Session, func, select
+from datetime import datetime
+from typing import Any, Optional, Tuple
 from schemas import TrainRequest, PredictRequest, PredictResponse, TrainResponse, SaunaRecommendationResponse
-from models import model_manager
+from models import fit_knn, model_manager, predict_with_model
 from database import get_session
 from db_models import SaunaSession
-import statistics
+from services.ml_executor import MLExecutorBusy, MLExecutorError, MLJobTimeout, ml_executor
+from services.session_data import SessionColumns, load_session_columns
+from services.session_features import CATEGORY_NAMES, categorize, feature_matrix, mode, summarize
 
 router = APIRouter(prefix="/models/knn", tags=["K-Nearest Neighbors"])
 
 
+def _executor_error(e: MLExecutorError) -> BaseException:
+    """
+    503 when the ML pool is full, 504 on job timeout. A job cancelled because
+    the client went away has nobody to answer, so the request is cancelled too.
+    """
+    if isinstance(e, MLExecutorBusy):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    if isinstance(e, MLJobTimeout):
+        return HTTPException(status_code=504, detail=str(e))
+    return asyncio.CancelledError(str(e))
+
+
 @router.post("/train", response_model=TrainResponse)
-async def train_knn(request: TrainRequest, n_neighbors: int = 3):
-    """Train K-Nearest Neighbors model"""
+async def train_knn(request: TrainRequest, http_request: Request, n_neighbors: int = 3):
+    """Train K-Nearest Neighbors model
+    
+    The model is fitted on the ML worker pool and then published as a new
+    active version, so predictions running meanwhile keep using the previous
+    version.
+    """
     try:
-        model_manager.train_knn(request.X, request.y, n_neighbors=n_neighbors)
+        model = await ml_executor.run(fit_knn, request.X, request.y, n_neighbors, request=http_request)
+        published = model_manager.publish_knn(model, len(request.y), n_neighbors)
         return TrainResponse(
             message="KNN model trained successfully",
             model_type="KNN",
-            samples_trained=len(request.y)
+            samples_trained=len(request.y),
+            model_version=published.version
         )
+    except MLExecutorError as e:
+        raise _executor_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Training failed: {str(e)}")
 
 
 @router.post("/predict", response_model=PredictResponse)
-async def predict_knn(request: PredictRequest):
-    """Make predictions using KNN model"""
+async def predict_knn(request: PredictRequest, http_request: Request, version: Optional[int] = None):
+    """Make predictions using KNN model
+    
+    Parameters:
+    - version: Use this kept model version instead of the active one (optional)
+    """
     try:
-        predictions = model_manager.predict("knn", request.X)
-        return PredictResponse(predictions=predictions, model_type="KNN")
+        used = model_manager.get_model("knn", version)
+        predictions = await ml_executor.run(predict_with_model, used.model, request.X, request=http_request)
+        return PredictResponse(predictions=predictions, model_type="KNN", model_version=used.version)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except MLExecutorError as e:
+        raise _executor_error(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Prediction failed: {str(e)}")
 
 
+@router.post("/versions/{version}/activate")
+async def activate_knn_version(version: int):
+    """Make a previously trained KNN version the active one (e.g. to roll back)"""
+    try:
+        entry = model_manager.registry.activate("knn", version)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"message": f"KNN model version {entry.version} is now active", "model_type": "KNN", "model_version": entry.version}
+
+
+def _sessions_version(session: Session, user_id: int) -> Tuple[int, Any]:
+    """(session count, latest updated_at) for a user: changes whenever their sessions do"""
+    statement = select(func.count(SaunaSession.id), func.max(SaunaSession.updated_at)).where(
+        SaunaSession.user_id == user_id
+    )
+    count, latest = session.exec(statement).one()
+    return count, latest
+
+
+def _default_recommendation() -> SaunaRecommendationResponse:
+    """Default recommendations if no history"""
+    return SaunaRecommendationResponse(
+        recommended_duration_minutes=45,
+        recommended_temperature=80.0,
+        confidence=0.0,
+        based_on_sessions=0,
+        insights=[
+            "No historical data available",
+            "These are default recommended values for beginners",
+            "Start your first session to get personalized recommendations"
+        ]
+    )
+
+
+def _build_recommendation(sessions_data: SessionColumns) -> Tuple[Any, SaunaRecommendationResponse]:
+    """Fit a KNN model on a user's sessions; returns (model or None, recommendation)"""
+    session_count = sessions_data.size
+    X = feature_matrix(sessions_data)  # [duration_minutes, avg_temperature]
+    
+    if session_count < 3:
+        # Need at least 3 sessions for KNN (k=3)
+        summary = summarize(X)
+        return None, SaunaRecommendationResponse(
+            recommended_duration_minutes=round(summary.mean_duration_minutes),
+            recommended_temperature=round(summary.mean_temperature, 1),
+            confidence=session_count / 10.0,
+            based_on_sessions=session_count,
+            insights=[
+                f"Based on {session_count} sessions",
+                "Need more sessions for AI predictions",
+                "Currently using simple averaging"
+            ]
+        )
+    
+    # Label: session quality category (0=short/cool, 1=medium, 2=long/hot)
+    y = categorize(X)
+    
+    # Train this user's KNN model with k=min(3, len(sessions)); the shared
+    # /train model is left alone
+    k = min(3, session_count)
+    model = fit_knn(X, y, n_neighbors=k)
+    
+    # Find the most common session type by predicting on all historical sessions
+    predictions = model.predict(X)
+    most_common_type = mode(predictions)
+    
+    # Calculate recommendations from sessions of the preferred type
+    preferred = summarize(X, predictions == most_common_type)
+    
+    recommended_duration = round(preferred.mean_duration_minutes)
+    recommended_temp = round(preferred.mean_temperature, 1)
+    
+    # Calculate confidence based on consistency and sample size
+    confidence = min(session_count / 10.0, 1.0)
+    if preferred.sessions >= session_count * 0.6:
+        confidence = min(confidence + 0.1, 1.0)  # Bonus for consistent pattern
+    
+    # Generate insights
+    insights = []
+    insights.append(f"KNN model analyzed {session_count} sessions")
+    
+    insights.append(f"Your preferred style: {CATEGORY_NAMES.get(most_common_type, 'balanced')} sessions")
+    
+    if recommended_duration < 30:
+        insights.append("You prefer shorter, intense sessions")
+    elif recommended_duration > 60:
+        insights.append("You enjoy long, relaxing sessions")
+    else:
+        insights.append("You prefer moderate session lengths")
+    
+    if recommended_temp < 75:
+        insights.append("You prefer lower temperatures")
+    elif recommended_temp > 85:
+        insights.append("You enjoy high heat sessions")
+    else:
+        insights.append("Traditional Finnish sauna temperatures suit you")
+    
+    return model, SaunaRecommendationResponse(
+        recommended_duration_minutes=recommended_duration,
+        recommended_temperature=recommended_temp,
+        confidence=round(confidence, 2),
+        based_on_sessions=session_count,
+        insights=insights
+    )
+
+
 @router.get("/recommend-session", response_model=SaunaRecommendationResponse)
-async def recommend_session(session: Session = Depends(get_session)):
+async def recommend_session(
+    http_request: Request,
+    user_id: int = Query(..., description="User whose sessions the recommendation is built from"),
+    since: Optional[datetime] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    session: Session = Depends(get_session)
+):
     """Recommend optimal sauna session parameters using KNN model
     
     Uses K-Nearest Neighbors to predict optimal session parameters based on:
     - Historical session patterns (duration, temperature)
     - Clusters sessions into "categories" (short/medium/long, cool/warm/hot)
     - Finds the most common pattern using KNN classification
+    
+    Parameters:
+    - user_id: Recommend from this user's sessions (required)
+    - since: Only use sessions recorded at or after this time (optional)
+    - limit: Only use this many of the most recent sessions (optional)
+    
+    The model and recommendation over a user's full history are cached per
+    user (least recently used evicted) and only rebuilt when the user's session
+    count or latest update time changes; requests with `since` or `limit` are
+    computed fresh and not cached. Database queries run on the threadpool and
+    model fitting on the ML worker pool.
     """
     try:
-        # Fetch all sessions (assuming all belong to same user)
-        statement = select(SaunaSession)
-        sessions_data = session.exec(statement).all()
-        
-        if not sessions_data:
-            # Default recommendations if no history
-            return SaunaRecommendationResponse(
-                recommended_duration_minutes=45,
-                recommended_temperature=80.0,
-                confidence=0.0,
-                based_on_sessions=0,
-                insights=[
-                    "No historical data available",
-                    "These are default recommended values for beginners",
-                    "Start your first session to get personalized recommendations"
-                ]
-            )
-        
-        if len(sessions_data) < 3:
-            # Need at least 3 sessions for KNN (k=3)
-            durations = [s.duration_seconds / 60 for s in sessions_data]
-            avg_temps = [s.average_temperature for s in sessions_data]
-            return SaunaRecommendationResponse(
-                recommended_duration_minutes=round(statistics.mean(durations)),
-                recommended_temperature=round(statistics.mean(avg_temps), 1),
-                confidence=len(sessions_data) / 10.0,
-                based_on_sessions=len(sessions_data),
-                insights=[
-                    f"Based on {len(sessions_data)} sessions",
-                    "Need more sessions for AI predictions",
-                    "Currently using simple averaging"
-                ]
-            )
-        
-        # Prepare training data: [duration_minutes, avg_temperature]
-        X = []
-        y = []  # Label: session quality category (0=short/cool, 1=medium, 2=long/hot)
+        version = await run_in_threadpool(_sessions_version, session, user_id)
         
-        for s in sessions_data:
-            duration_min = s.duration_seconds / 60
-            avg_temp = s.average_temperature
-            X.append([duration_min, avg_temp])
-            
-            # Classify sessions into categories based on duration and temp
-            # This is a simplified "quality" score
-            if duration_min < 30 or avg_temp < 75:
-                y.append(0)  # Quick/cool session
-            elif duration_min > 60 or avg_temp > 85:
-                y.append(2)  # Long/hot session
-            else:
-                y.append(1)  # Medium session
+        if version[0] == 0:
+            return _default_recommendation()
         
-        # Train KNN model with k=min(3, len(sessions))
-        k = min(3, len(sessions_data))
-        model_manager.train_knn(X, y, n_neighbors=k)
+        # One cache entry per user: arbitrary windows would only fill the cache
+        cacheable = since is None and limit is None
+        if cacheable:
+            cached = model_manager.cached_user_result(user_id, version)
+            if cached is not None:
+                return cached
         
-        # Find the most common session type by predicting on all historical sessions
-        predictions = model_manager.predict("knn", X)
-        most_common_type = max(set(predictions), key=predictions.count)
-        
-        # Get sessions of the preferred type
-        preferred_sessions = [sessions_data[i] for i, pred in enumerate(predictions) if pred == most_common_type]
-        
-        if not preferred_sessions:
-            preferred_sessions = sessions_data
-        
-        # Calculate recommendations from preferred session type
-        durations = [s.duration_seconds / 60 for s in preferred_sessions]
-        avg_temps = [s.average_temperature for s in preferred_sessions]
-        
-        recommended_duration = round(statistics.mean(durations))
-        recommended_temp = round(statistics.mean(avg_temps), 1)
-        
-        # Calculate confidence based on consistency and sample size
-        confidence = min(len(sessions_data) / 10.0, 1.0)
-        if len(preferred_sessions) >= len(sessions_data) * 0.6:
-            confidence = min(confidence + 0.1, 1.0)  # Bonus for consistent pattern
-        
-        # Generate insights
-        insights = []
-        insights.append(f"KNN model analyzed {len(sessions_data)} sessions")
-        
-        type_names = {0: "quick & efficient", 1: "balanced", 2: "extended & intense"}
-        insights.append(f"Your preferred style: {type_names.get(most_common_type, 'balanced')} sessions")
-        
-        if recommended_duration < 30:
-            insights.append("You prefer shorter, intense sessions")
-        elif recommended_duration > 60:
-            insights.append("You enjoy long, relaxing sessions")
-        else:
-            insights.append("You prefer moderate session lengths")
-        
-        if recommended_temp < 75:
-            insights.append("You prefer lower temperatures")
-        elif recommended_temp > 85:
-            insights.append("You enjoy high heat sessions")
+        columns = await run_in_threadpool(load_session_columns, session, user_id, since=since, limit=limit)
+        if columns.size == 0:
+            model, result = None, _default_recommendation()
         else:
-            insights.append("Traditional Finnish sauna temperatures suit you")
-        
-        return SaunaRecommendationResponse(
-            recommended_duration_minutes=recommended_duration,
-            recommended_temperature=recommended_temp,
-            confidence=round(confidence, 2),
-            based_on_sessions=len(sessions_data),
-            insights=insights
-        )
+            model, result = await ml_executor.run(_build_recommendation, columns, request=http_request)
+        if cacheable:
+            model_manager.store_user_result(user_id, version, model, result)
+        return result
         
+    except MLExecutorError as e:
+        raise _executor_error(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Recommendation failed: {str(e)}")
@@ -1,11 +1,13 @@
 from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, Query
-from fastapi.encoders import jsonable_encoder
+from fastapi import APIRouter, Header, Query
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, EmailStr, Field
 
+from services.fast_json import FastJSONResponse
+from services.telemetry_ingest import telemetry_ingestor
+
 router = APIRouter(prefix="/api/v1", tags=["Sauna Backend"])
 
 
@@ -152,6 +154,16 @@ class TargetUpdate(BaseModel):
     )
 
 
+class TelemetryPush(BaseModel):
+    samples: List[Any] = Field(
+        ...,
+        description=(
+            "Readings for any number of devices: objects with deviceId, timestamp, "
+            "temperature, humidity, targetTemp and heating (all but deviceId optional)"
+        ),
+    )
+
+
 class UserPayload(BaseModel):
     id: str = Field(..., min_length=1)
     name: str = Field(..., min_length=1)
@@ -167,6 +179,11 @@ def _find_device(device_id: str) -> Optional[Dict[str, Any]]:
     return next((device for device in devices if device["id"] == device_id), None)
 
 
+def _device_reading(device_id: str) -> Optional[Dict[str, Any]]:
+    device = _find_device(device_id)
+    return device.get("currentReading") if device else None
+
+
 def _calculate_device_stats() -> Dict[str, float]:
     connected = 0
     temperatures: List[float] = []
@@ -175,7 +192,7 @@ def _calculate_device_stats() -> Dict[str, float]:
         if device["isConnected"]:
             connected += 1
         reading = device.get("currentReading")
-        if reading:
+        if reading and reading["temperature"] is not None:
             temperatures.append(reading["temperature"])
 
     avg_temp = sum(temperatures) / len(temperatures) if temperatures else 0.0
@@ -206,17 +223,18 @@ async def list_devices(device_type: Optional[str] = Query(None, alias="type")):
         else devices
     )
 
-    return {
+    # Device records are our own plain data: render straight to bytes
+    return FastJSONResponse({
         "success": True,
         "count": len(filtered),
-        "data": jsonable_encoder(filtered),
-    }
+        "data": filtered,
+    })
 
 
 @router.get("/devices/stats")
 async def get_device_stats():
     data = _calculate_device_stats()
-    return {"success": True, "data": data}
+    return FastJSONResponse({"success": True, "data": data})
 
 
 @router.get("/devices/{device_id}")
@@ -228,13 +246,17 @@ async def get_device(device_id: str):
             content={"success": False, "error": "Device not found"},
         )
 
-    return {"success": True, "data": jsonable_encoder(device)}
+    return FastJSONResponse({"success": True, "data": device})
 
 
 @router.get("/devices/{device_id}/reading")
 async def get_device_reading(device_id: str):
     device = _find_device(device_id)
     if not device:
+        # Devices only known from telemetry pushes have a reading but no record
+        pushed = telemetry_ingestor.latest.get(device_id)
+        if pushed is not None:
+            return FastJSONResponse({"success": True, "data": pushed})
         return JSONResponse(
             status_code=404,
             content={"success": False, "error": "Device not found"},
@@ -247,7 +269,7 @@ async def get_device_reading(device_id: str):
             "error": "Device is offline or has no readings",
         }
 
-    return {"success": True, "data": jsonable_encoder(reading)}
+    return FastJSONResponse({"success": True, "data": reading})
 
 
 @router.put("/devices/{device_id}/target")
@@ -267,13 +289,79 @@ async def update_device_target(device_id: str, payload: TargetUpdate):
         )
 
     reading["targetTemp"] = payload.targetTemp
-    reading["heating"] = reading["temperature"] < payload.targetTemp
+    if reading["temperature"] is not None:
+        reading["heating"] = reading["temperature"] < payload.targetTemp
+    # Later pushes merge into the ingest table, so it must see the new target too
+    telemetry_ingestor.update_reading(device_id, reading)
 
-    return {
+    return FastJSONResponse({
         "success": True,
         "message": "Target temperature updated",
-        "data": jsonable_encoder(device),
-    }
+        "data": device,
+    })
+
+
+@router.post("/telemetry", status_code=202)
+async def push_telemetry(payload: TelemetryPush, x_ingest_key: Optional[str] = Header(None)):
+    """
+    Accept a batch of readings from a gateway or simulator.
+
+    Valid samples update the device readings served by this API right away and
+    are written to the database in the background; invalid ones are reported
+    by index without rejecting the rest of the batch.
+
+    Requires the X-Ingest-Key header matching TELEMETRY_INGEST_KEY; without a
+    configured key pushes are refused unless TELEMETRY_INGEST_OPEN=true.
+    """
+    if not telemetry_ingestor.enabled:
+        return JSONResponse(
+            status_code=403,
+            content={
+                "success": False,
+                "error": "Telemetry push is disabled: set TELEMETRY_INGEST_KEY (or TELEMETRY_INGEST_OPEN=true)",
+            },
+        )
+    if not telemetry_ingestor.authorize(x_ingest_key):
+        return JSONResponse(
+            status_code=401,
+            content={"success": False, "error": "Invalid or missing X-Ingest-Key"},
+        )
+    if len(payload.samples) > telemetry_ingestor.max_samples_per_push:
+        return JSONResponse(
+            status_code=413,
+            content={
+                "success": False,
+                "error": f"At most {telemetry_ingestor.max_samples_per_push} samples per push",
+            },
+        )
+
+    result = telemetry_ingestor.ingest(payload.samples, seed=_device_reading)
+
+    for device_id, reading in result["updated"].items():
+        device = _find_device(device_id)
+        if device:
+            # A copy; target updates are written through with update_reading
+            device["currentReading"] = dict(reading)
+            device["isConnected"] = True
+            if reading["timestamp"] > device["lastSeen"]:
+                device["lastSeen"] = reading["timestamp"]
+
+    return FastJSONResponse(
+        status_code=202 if result["accepted"] else 422,
+        content={
+            "success": result["accepted"] > 0,
+            "accepted": result["accepted"],
+            "rejected": result["rejected"],
+            "devices": len(result["updated"]),
+            "errors": result["errors"],
+            "pending": telemetry_ingestor.pending,
+        },
+    )
+
+
+@router.get("/telemetry/stats")
+async def get_telemetry_stats():
+    return {"success": True, "data": telemetry_ingestor.snapshot()}
 
 
 @router.get("/users")
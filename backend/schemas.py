@@ -40,13 +40,15 @@ class PredictResponse(BaseModel):
         json_schema_extra={
             "example": {
                 "predictions": [0, 1],
-                "model_type": "KNN"
+                "model_type": "KNN",
+                "model_version": 1
             }
         }
     )
     
     predictions: List[int] = Field(..., description="Predicted class labels")
     model_type: str = Field(..., description="Type of model used")
+    model_version: Optional[int] = Field(None, description="Version of the model that made the predictions")
 
 
 class TrainResponse(BaseModel):
@@ -54,6 +56,7 @@ class TrainResponse(BaseModel):
     message: str
     model_type: str
     samples_trained: int
+    model_version: Optional[int] = Field(None, description="Version published by this training run")
 
 
 class SaunaRecommendationResponse(BaseModel):
@@ -187,6 +190,8 @@ class DevicesResponse(BaseModel):
     success: bool = Field(default=True, description="Whether request was successful")
     devices: List[Device] = Field(default_factory=list, description="List of devices")
     count: Optional[int] = Field(None, description="Number of devices")
+    partial: bool = Field(default=False, description="True if some devices could not be fully enriched in time")
+    timedOut: List[str] = Field(default_factory=list, description="IDs of devices returned without full details because the deadline expired")
 
 
 class DeviceStateResponse(BaseModel):
@@ -203,11 +208,45 @@ class TelemetryResponse(BaseModel):
     data: Dict[str, Any] = Field(..., description="Telemetry data")
 
 
+class BulkDeviceResult(BaseModel):
+    """Per-device entry of a bulk state/telemetry response"""
+    deviceId: str = Field(..., description="Device identifier")
+    success: bool = Field(..., description="Whether this device was fetched successfully")
+    data: Optional[Dict[str, Any]] = Field(None, description="State or telemetry data")
+    error: Optional[str] = Field(None, description="Error message if this device failed")
+    statusCode: Optional[int] = Field(None, description="Upstream HTTP status code if this device failed")
+
+
+class BulkDeviceResponse(BaseModel):
+    """Response model for bulk device state/telemetry"""
+    success: bool = Field(default=True, description="Whether the request was processed")
+    results: List[BulkDeviceResult] = Field(default_factory=list, description="One entry per requested device")
+    count: int = Field(..., description="Number of devices requested")
+    failed: int = Field(..., description="Number of devices that could not be fetched")
+    
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "success": True,
+                "results": [
+                    {"deviceId": "device-123", "success": True, "data": {"temperature": 82.5}},
+                    {"deviceId": "device-456", "success": False, "error": "Forbidden", "statusCode": 403}
+                ],
+                "count": 2,
+                "failed": 1
+            }
+        }
+    }
+
+
 class DeviceCommandRequest(BaseModel):
     """Request model for device command"""
     deviceId: str = Field(..., description="Device identifier")
     command: str = Field(..., description="Command to send")
     parameters: Optional[Dict[str, Any]] = Field(None, description="Optional command parameters")
+    idempotent: bool = Field(
+        False, description="Safe to send once for identical repeats (de-duplicate within the dedupe window)"
+    )
     
     model_config = {
         "json_schema_extra": {
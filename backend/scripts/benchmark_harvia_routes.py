@@ -0,0 +1,147 @@
+"""
+Benchmark the /api/harvia routes against the local fake Harvia server
+
+Both apps run in-process (httpx ASGI transports), so no network or Harvia
+account is needed. Reports p50/p95/p99 latency, errors and upstream calls per
+request for each route.
+
+Usage:
+    uv run python scripts/benchmark_harvia_routes.py --devices 100 --latency-ms 60 --jitter-ms 30 --requests 50 --concurrency 10
+    uv run python scripts/benchmark_harvia_routes.py --cold --error-rate 0.05
+"""
+import os
+import sys
+import argparse
+import asyncio
+import time
+from pathlib import Path
+from typing import Dict, List
+
+# Add parent directory to path to import project modules
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+# Keep access logs out of the measurements unless asked for
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# Never reuse a persisted endpoint config from a real deployment
+os.environ.setdefault("HARVIA_CONFIG_CACHE_PATH", "")
+
+import httpx
+
+from main import app
+from scripts.fake_harvia_server import FakeHarviaConfig, create_app, device_id
+from services.device_cache import device_list_cache
+from services.device_normalizer import device_normalizer
+from services.harvia_api import harvia_service
+from services.http_pool import HTTPPool
+from services.rate_limit import RateLimiter
+from services.telemetry_poller import telemetry_poller
+
+FAKE_BASE_URL = "http://fake-harvia.local"
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def route_paths(devices: int, bulk: int) -> Dict[str, str]:
+    first = device_id(0)
+    ids = ",".join(device_id(i) for i in range(min(bulk, devices)))
+    return {
+        "GET /devices": "/api/harvia/devices",
+        "GET /devices/{id}/state": f"/api/harvia/devices/{first}/state",
+        "GET /devices/{id}/telemetry": f"/api/harvia/devices/{first}/telemetry",
+        "GET /devices/state?ids": f"/api/harvia/devices/state?ids={ids}",
+        "GET /devices/telemetry?ids": f"/api/harvia/devices/telemetry?ids={ids}",
+    }
+
+
+async def run_route(client: httpx.AsyncClient, path: str, args, fake_app) -> Dict[str, float]:
+    latencies: List[float] = []
+    errors = 0
+    slots = asyncio.Semaphore(args.concurrency)
+    calls_before = sum(fake_app.state.calls.values())
+
+    async def one(index: int) -> None:
+        nonlocal errors
+        headers = {"Authorization": f"Bearer bench-user-{index % args.users}"}
+        async with slots:
+            if args.cold:
+                device_list_cache.clear()
+                device_normalizer.clear()
+            started = time.perf_counter()
+            response = await client.get(path, headers=headers)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    upstream = sum(fake_app.state.calls.values()) - calls_before
+    return {
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "errors": errors,
+        "upstream": upstream / max(1, args.requests),
+    }
+
+
+async def run(args) -> None:
+    fake_app = create_app(FakeHarviaConfig(
+        devices=args.devices,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    ))
+    # Point the shared service at the fake server
+    harvia_service.ENDPOINTS_URL = f"{FAKE_BASE_URL}/endpoints"
+    harvia_service.endpoints_config = None
+    harvia_service.config_cache_path = None
+    harvia_service.http = HTTPPool(transport=httpx.ASGITransport(app=fake_app))
+    if args.no_rate_limit:
+        harvia_service.rate_limiter = RateLimiter(rate=0, per_key_rate=0)
+
+    print(
+        f"Fake Harvia: {args.devices} devices, latency {args.latency_ms}±{args.jitter_ms} ms, "
+        f"error rate {args.error_rate:.0%} | {args.requests} requests/route, "
+        f"concurrency {args.concurrency}, {args.users} user(s){', cold caches' if args.cold else ''}"
+    )
+    print(f"{'route':<30}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'upstream/req':>14}")
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://backend.local", timeout=60.0) as client:
+        for name, path in route_paths(args.devices, args.bulk).items():
+            result = await run_route(client, path, args, fake_app)
+            print(
+                f"{name:<30}{result['p50']:>10.1f}{result['p95']:>10.1f}{result['p99']:>10.1f}"
+                f"{result['errors']:>8d}{result['upstream']:>14.2f}"
+            )
+
+    await telemetry_poller.close()
+    await harvia_service.close()
+    print(f"Upstream calls by endpoint: {dict(fake_app.state.calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /api/harvia routes against a fake Harvia API")
+    parser.add_argument("--devices", type=int, default=50, help="Devices per account on the fake server")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Base upstream latency")
+    parser.add_argument("--jitter-ms", type=float, default=20.0, help="Upstream latency jitter (+/-)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of upstream calls failing with 503")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for jitter and errors")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per route")
+    parser.add_argument("--concurrency", type=int, default=10, help="Concurrent requests")
+    parser.add_argument("--users", type=int, default=1, help="Distinct bearer tokens to rotate through")
+    parser.add_argument("--bulk", type=int, default=10, help="Device IDs per bulk request")
+    parser.add_argument("--cold", action="store_true", help="Clear device caches before every request")
+    parser.add_argument("--no-rate-limit", action="store_true", help="Disable the outbound rate limiter")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark the Harvia device normalizer, independently of the HTTP route
+
+Usage:
+    uv run python scripts/benchmark_normalizer.py --devices 500 --rounds 20
+"""
+import sys
+import argparse
+import time
+from pathlib import Path
+
+# Add parent directory to path to import project modules
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from schemas import Device
+from services.device_normalizer import DeviceNormalizer, normalize_device_data
+
+
+def make_payloads(count: int):
+    """REST-style payloads with the attr list the normalizer parses"""
+    payloads = []
+    for i in range(count):
+        payloads.append({
+            "name": f"device-{i:06d}",
+            "type": "Fenix",
+            "attr": [
+                {"key": "serialNumber", "value": f"2545{i:06d}"},
+                {"key": "city", "value": "Espoo"},
+                {"key": "country", "value": "Finland"},
+                {"key": "connected", "value": "true" if i % 3 else "false"},
+                {"key": "lastActivity", "value": "2025-01-01T12:00:00Z"},
+                {"key": "w_latitude", "value": "60.2055"},
+                {"key": "w_longitude", "value": "24.6559"},
+                {"key": "rssi", "value": "-61"},
+                {"key": "brand", "value": "Harvia"},
+                {"key": "firmwareVersion", "value": "1.4.2"},
+                {"key": "espChip", "value": "ESP32"},
+            ],
+        })
+    return payloads
+
+
+def timed(label: str, rounds: int, count: int, fn):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    elapsed = time.perf_counter() - started
+    per_device_us = elapsed / (rounds * count) * 1e6
+    print(f"{label:<28} {elapsed * 1000:9.1f} ms total  {per_device_us:8.2f} us/device")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark device normalization")
+    parser.add_argument("--devices", type=int, default=500, help="Devices per round")
+    parser.add_argument("--rounds", type=int, default=20, help="Rounds (simulated polls)")
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.devices)
+    print(f"Normalizing {args.devices} devices x {args.rounds} rounds")
+
+    timed("unmemoized (map + model)", args.rounds, args.devices,
+          lambda: [Device(**normalize_device_data(raw)) for raw in payloads])
+
+    normalizer = DeviceNormalizer(max_entries=args.devices * 2)
+    normalize_all = lambda: [normalizer.normalize(raw) for raw in payloads]
+    timed("memoized, first round", 1, args.devices, normalize_all)
+    timed("memoized, unchanged", args.rounds, args.devices, normalize_all)
+    print(f"Memo stats: {normalizer.snapshot()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark device response serialization: validated models + jsonable_encoder
+versus the fast path (model_construct + services.fast_json)
+
+Usage:
+    uv run python scripts/benchmark_serialization.py --devices 500 --rounds 20
+"""
+import sys
+import argparse
+import json
+from pathlib import Path
+
+# Add parent directory to path to import project modules
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from routes.sauna_backend import devices as v1_devices
+from schemas import Device, DeviceLocation, DevicesResponse
+from scripts.benchmark_normalizer import make_payloads, timed
+from services import fast_json
+from services.device_normalizer import normalize_device_data
+from services.fast_json import FastJSONResponse, construct, dumps
+
+
+def validated_devices(normalized):
+    devices = [Device(**data) for data in normalized]
+    return DevicesResponse(success=True, devices=devices, count=len(devices))
+
+
+def constructed_devices(normalized):
+    devices = []
+    for data in normalized:
+        data = dict(data)
+        if isinstance(data.get("location"), dict):
+            data["location"] = construct(DeviceLocation, data["location"])
+        devices.append(construct(Device, data))
+    return construct(DevicesResponse, {"success": True, "devices": devices, "count": len(devices)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark device response serialization")
+    parser.add_argument("--devices", type=int, default=500, help="Devices per response")
+    parser.add_argument("--rounds", type=int, default=20, help="Responses rendered per variant")
+    args = parser.parse_args()
+
+    normalized = [normalize_device_data(raw) for raw in make_payloads(args.devices)]
+    encoder = "orjson" if fast_json.orjson is not None else "json (orjson not installed)"
+    print(f"Rendering {args.devices} devices x {args.rounds} rounds, fast path encoder: {encoder}")
+
+    # The fast path must produce the same document
+    reference = json.loads(JSONResponse(jsonable_encoder(validated_devices(normalized))).body)
+    assert json.loads(dumps(constructed_devices(normalized))) == reference
+
+    print("/api/harvia/devices (normalized data -> response bytes)")
+    timed("  validate + jsonable_encoder", args.rounds, args.devices,
+          lambda: JSONResponse(jsonable_encoder(validated_devices(normalized))).body)
+    timed("  validate + model_dump_json", args.rounds, args.devices,
+          lambda: validated_devices(normalized).model_dump_json().encode("utf-8"))
+    timed("  construct + fast_json", args.rounds, args.devices,
+          lambda: dumps(constructed_devices(normalized)))
+
+    rows = (v1_devices * (args.devices // len(v1_devices) + 1))[:args.devices]
+    print("/api/v1/devices (plain dicts with datetimes -> response bytes)")
+    timed("  jsonable_encoder + JSONResponse", args.rounds, args.devices,
+          lambda: JSONResponse({"success": True, "count": len(rows), "data": jsonable_encoder(rows)}).body)
+    timed("  FastJSONResponse", args.rounds, args.devices,
+          lambda: FastJSONResponse({"success": True, "count": len(rows), "data": rows}).body)
+
+
+if __name__ == "__main__":
+    main()
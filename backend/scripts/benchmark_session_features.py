@@ -0,0 +1,96 @@
+"""
+Benchmark session features, labels, mode and summary stats: the per-session
+Python loops recommend-session used to run versus services.session_features
+
+Usage:
+    uv run python scripts/benchmark_session_features.py --sessions 1000000 --rounds 3
+    uv run python scripts/benchmark_session_features.py --knn   # also time KNN fit + predict
+"""
+import sys
+import argparse
+import statistics
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Add parent directory to path to import project modules
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from models import model_manager
+from services.session_data import SessionColumns
+from services.session_features import categorize, feature_matrix, mode, summarize
+
+
+def make_columns(count: int, seed: int = 0) -> SessionColumns:
+    """Sessions of 5-120 minutes at 55-100 C, as loaded by load_session_columns"""
+    rng = np.random.default_rng(seed)
+    durations = rng.integers(5 * 60, 120 * 60, size=count).astype(np.float64)
+    temperatures = rng.uniform(55, 100, size=count).round(1)
+    return SessionColumns(durations, temperatures)
+
+
+def python_pipeline(columns: SessionColumns):
+    """The loop-based version recommend-session used before session_features"""
+    X = []
+    y = []
+    for duration_seconds, avg_temp in zip(columns.duration_seconds.tolist(), columns.average_temperature.tolist()):
+        duration_min = duration_seconds / 60
+        X.append([duration_min, avg_temp])
+        if duration_min < 30 or avg_temp < 75:
+            y.append(0)
+        elif duration_min > 60 or avg_temp > 85:
+            y.append(2)
+        else:
+            y.append(1)
+    most_common = max(set(y), key=y.count)
+    preferred = [X[i] for i, label in enumerate(y) if label == most_common]
+    durations = [row[0] for row in preferred]
+    temperatures = [row[1] for row in preferred]
+    return y, most_common, len(preferred), statistics.mean(durations), statistics.mean(temperatures)
+
+
+def numpy_pipeline(columns: SessionColumns):
+    X = feature_matrix(columns)
+    y = categorize(X)
+    most_common = mode(y)
+    summary = summarize(X, y == most_common)
+    return y, most_common, summary.sessions, summary.mean_duration_minutes, summary.mean_temperature
+
+
+def timed(label: str, rounds: int, count: int, fn):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        result = fn()
+    elapsed = (time.perf_counter() - started) / rounds
+    print(f"{label:<24} {elapsed * 1000:10.1f} ms/run  {elapsed / count * 1e9:8.1f} ns/session")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark session feature extraction")
+    parser.add_argument("--sessions", type=int, default=1_000_000, help="Sessions per run")
+    parser.add_argument("--rounds", type=int, default=3, help="Runs per variant")
+    parser.add_argument("--knn", action="store_true", help="Also time KNN fit + predict on the features")
+    args = parser.parse_args()
+
+    columns = make_columns(args.sessions)
+    print(f"{args.sessions} sessions, {args.rounds} rounds")
+
+    expected = timed("python loops", args.rounds, args.sessions, lambda: python_pipeline(columns))
+    actual = timed("numpy (session_features)", args.rounds, args.sessions, lambda: numpy_pipeline(columns))
+
+    # Same labels, mode and preferred-session stats
+    assert actual[0].tolist() == expected[0]
+    assert actual[1:3] == expected[1:3]
+    assert np.allclose(actual[3:], expected[3:])
+
+    if args.knn:
+        X = feature_matrix(columns)
+        y = categorize(X)
+        model = timed("knn fit (k=3)", 1, args.sessions, lambda: model_manager.fit_knn(X, y, n_neighbors=3))
+        timed("knn predict", 1, args.sessions, lambda: model.predict(X))
+
+
+if __name__ == "__main__":
+    main()
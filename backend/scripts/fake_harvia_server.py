@@ -0,0 +1,259 @@
+"""
+Local stand-in for the Harvia Cloud API, for benchmarks and offline testing
+
+Serves the endpoint discovery document, /auth/token, the device and users
+GraphQL services (usersDevicesList, aliased devicesGet, devicesUpdate),
+/devices/state and /data/latest-data, with configurable device counts,
+latency, jitter and error rate. The device GraphQL service accepts automatic
+persisted queries (hash-only requests after a first full one). Upstream call
+counts are exposed at /_stats.
+
+Usage:
+    uv run python scripts/fake_harvia_server.py --devices 200 --latency-ms 80 --jitter-ms 40 --port 9100
+    HARVIA_ENDPOINTS_URL=http://127.0.0.1:9100/endpoints uv run python main.py
+"""
+import sys
+import argparse
+import asyncio
+import random
+import re
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# Add parent directory to path to import project modules
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# `d0: devicesGet(deviceId: "x")` or, with variables, `d0: devicesGet(deviceId: $d0)`
+DEVICES_GET = re.compile(r'(?:(\w+)\s*:\s*)?devicesGet\(\s*deviceId:\s*(?:"((?:[^"\\]|\\.)*)"|\$(\w+))\s*\)')
+
+
+class FakeHarviaConfig:
+    """Knobs for the fake server; all latencies are in milliseconds"""
+
+    def __init__(
+        self,
+        devices: int = 20,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.devices = devices
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.seed = seed
+
+
+def device_id(index: int) -> str:
+    return f"fake-{index:05d}"
+
+
+def _device(index: int, name: Optional[str] = None) -> Dict[str, Any]:
+    attr = [
+        {"key": "serialNumber", "value": f"25454C{index:04d}"},
+        {"key": "city", "value": ("Espoo", "Helsinki", "Tampere")[index % 3]},
+        {"key": "country", "value": "Finland"},
+        {"key": "connected", "value": "true" if index % 4 else "false"},
+        {"key": "lastActivity", "value": "2025-01-01T12:00:00Z"},
+        {"key": "brand", "value": "Harvia"},
+        {"key": "firmwareVersion", "value": "1.4.2"},
+    ]
+    if name:
+        attr.append({"key": "name", "value": name})
+    return {"id": device_id(index), "type": "Fenix", "attr": attr, "roles": ["owner"], "via": None}
+
+
+def create_app(config: Optional[FakeHarviaConfig] = None) -> FastAPI:
+    """Build the fake Harvia app; `app.state.calls` counts upstream calls per route"""
+    config = config or FakeHarviaConfig()
+    rng = random.Random(config.seed)
+    app = FastAPI(title="Fake Harvia Cloud API")
+    app.state.config = config
+    app.state.calls = Counter()
+    names: Dict[str, str] = {}
+    persisted: Dict[str, str] = {}
+    known = {device_id(i): i for i in range(config.devices)}
+
+    def base_url(request: Request) -> str:
+        return str(request.base_url).rstrip("/")
+
+    @app.middleware("http")
+    async def inject_latency_and_errors(request: Request, call_next):
+        if request.url.path.startswith("/_stats"):
+            return await call_next(request)
+        app.state.calls[f"{request.method} {request.url.path}"] += 1
+        delay = config.latency_ms + rng.uniform(-config.jitter_ms, config.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if config.error_rate and rng.random() < config.error_rate:
+            return JSONResponse(status_code=503, content={"message": "Injected upstream failure"})
+        return await call_next(request)
+
+    @app.get("/endpoints")
+    async def endpoints(request: Request):
+        base = base_url(request)
+        return {
+            "endpoints": {
+                "RestApi": {
+                    "generics": {"https": f"{base}/rest"},
+                    "device": {"https": f"{base}/device"},
+                    "data": {"https": f"{base}/data"},
+                },
+                "GraphQL": {
+                    "device": {"https": f"{base}/graphql/device"},
+                    "users": {"https": f"{base}/graphql/users"},
+                },
+            }
+        }
+
+    def tokens() -> Dict[str, Any]:
+        issued = int(time.time())
+        return {
+            "idToken": f"fake-id-token-{issued}",
+            "accessToken": f"fake-access-token-{issued}",
+            "refreshToken": "fake-refresh-token",
+            "expiresIn": 3600,
+        }
+
+    @app.post("/rest/auth/token")
+    async def auth_token(body: Dict[str, Any]):
+        if not body.get("username") or not body.get("password"):
+            return JSONResponse(status_code=401, content={"message": "Invalid credentials"})
+        return tokens()
+
+    @app.post("/rest/auth/refresh")
+    async def auth_refresh(body: Dict[str, Any]):
+        if not body.get("refreshToken"):
+            return JSONResponse(status_code=401, content={"message": "Invalid refresh token"})
+        result = tokens()
+        result.pop("refreshToken")
+        return result
+
+    @app.post("/graphql/device")
+    async def device_graphql(body: Dict[str, Any]):
+        query = body.get("query", "")
+        query_hash = ((body.get("extensions") or {}).get("persistedQuery") or {}).get("sha256Hash")
+        if query_hash:
+            if query:
+                persisted[query_hash] = query
+            elif query_hash in persisted:
+                query = persisted[query_hash]
+            else:
+                return {"errors": [{"message": "PersistedQueryNotFound", "extensions": {"code": "PERSISTED_QUERY_NOT_FOUND"}}]}
+        variables = body.get("variables") or {}
+        if "usersDevicesList" in query:
+            devices = [_device(i) for i in range(config.devices)]
+            for device in devices:
+                device["attr"] = [a for a in device["attr"] if a["key"] in ("serialNumber", "connected")]
+            return {"data": {"usersDevicesList": {"devices": devices, "nextToken": None}}}
+        if "devicesUpdate" in query:
+            target = variables.get("deviceId")
+            if target is None:
+                match = re.search(r'deviceId:\s*"([^"]+)"', query)
+                target = match.group(1) if match else None
+            name = None
+            for attribute in variables.get("attributes") or []:
+                if attribute.get("key") == "name":
+                    name = attribute.get("value")
+            if name is None:
+                match = re.search(r'key:\s*"name",\s*value:\s*"((?:[^"\\]|\\.)*)"', query)
+                name = match.group(1) if match else None
+            if target not in known:
+                return {"data": {"devicesUpdate": None}, "errors": [{"message": "Device not found"}]}
+            if name is not None:
+                names[target] = name
+            return {"data": {"devicesUpdate": _device(known[target], names.get(target))}}
+        if "devicesGet" in query:
+            data: Dict[str, Any] = {}
+            errors: List[Dict[str, Any]] = []
+            for alias, literal, variable in DEVICES_GET.findall(query):
+                field = alias or "devicesGet"
+                requested = literal if literal else variables.get(variable)
+                if requested in known:
+                    data[field] = _device(known[requested], names.get(requested))
+                else:
+                    data[field] = None
+                    errors.append({"path": [field], "message": "Unauthorized"})
+            result: Dict[str, Any] = {"data": data}
+            if errors:
+                result["errors"] = errors
+            return result
+        return JSONResponse(
+            status_code=400,
+            content={"errors": [{"errorType": "ValidationError", "message": "Unknown query"}]},
+        )
+
+    @app.post("/graphql/users")
+    async def users_graphql(body: Dict[str, Any]):
+        # Like upstream, the users schema has none of the alias queries we probe
+        return JSONResponse(
+            status_code=400,
+            content={"errors": [{"errorType": "ValidationError", "message": "FieldUndefined"}]},
+        )
+
+    @app.get("/device/devices/state")
+    async def device_state(deviceId: str):
+        if deviceId not in known:
+            return JSONResponse(status_code=404, content={"message": "Device not found"})
+        index = known[deviceId]
+        return {
+            "deviceId": deviceId,
+            "state": {"reported": {"active": index % 2 == 0, "targetTemp": 80 + index % 10}},
+            "timestamp": int(time.time()),
+        }
+
+    @app.get("/data/data/latest-data")
+    async def latest_data(deviceId: str):
+        if deviceId not in known:
+            return JSONResponse(status_code=404, content={"message": "Device not found"})
+        return {
+            "deviceId": deviceId,
+            "timestamp": int(time.time() * 1000),
+            "data": {"temperature": round(70 + rng.random() * 20, 1), "humidity": round(10 + rng.random() * 20, 1)},
+        }
+
+    @app.post("/device/devices/command")
+    async def device_command(body: Dict[str, Any]):
+        return {"success": True, "deviceId": body.get("deviceId")}
+
+    @app.patch("/device/devices/target")
+    async def device_target(body: Dict[str, Any]):
+        return {"success": True, "deviceId": body.get("deviceId")}
+
+    @app.get("/_stats")
+    async def stats():
+        return {"calls": dict(app.state.calls), "total": sum(app.state.calls.values())}
+
+    @app.post("/_stats/reset")
+    async def reset_stats():
+        app.state.calls.clear()
+        return {"success": True}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Harvia Cloud API")
+    parser.add_argument("--devices", type=int, default=20, help="Devices per account")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Base latency per upstream call")
+    parser.add_argument("--jitter-ms", type=float, default=20.0, help="Latency jitter (+/-)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with 503")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for jitter and errors")
+    parser.add_argument("--port", type=int, default=9100, help="Port to listen on")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    config = FakeHarviaConfig(args.devices, args.latency_ms, args.jitter_ms, args.error_rate, args.seed)
+    print(f"Fake Harvia API on http://127.0.0.1:{args.port}/endpoints ({args.devices} devices)")
+    uvicorn.run(create_app(config), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
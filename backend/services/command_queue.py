@@ -0,0 +1,373 @@
+"""
+Device Command Queue
+Per-device coalescing of target updates and de-duplication of repeated commands
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from services.harvia_api import harvia_service
+from services.identity import token_fingerprint
+from services.token_manager import token_manager
+
+logger = logging.getLogger(__name__)
+
+TargetSender = Callable[[str, str, Optional[float], Optional[float]], Awaitable[Dict[str, Any]]]
+CommandSender = Callable[[str, str, str, Optional[Dict[str, Any]]], Awaitable[Dict[str, Any]]]
+Identify = Callable[[str], str]
+
+
+class CommandTicket:
+    """
+    Handle returned to a caller for one target update or command.
+
+    `status` moves from "pending" to "sent" (its own upstream call, or one it
+    was coalesced into), "duplicate" (an identical request was already sent)
+    or "failed".
+    """
+
+    def __init__(self, owner: str, device_id: str, kind: str):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.device_id = device_id
+        self.kind = kind
+        self.status = "pending"
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.status_code: Optional[int] = None
+        self.coalesced = 1
+        self.created_at = time.time()
+        self._future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    @property
+    def done(self) -> bool:
+        return self.status != "pending"
+
+    def _resolve(self, status: str, result: Optional[Dict[str, Any]] = None, coalesced: int = 1) -> None:
+        self.status = status
+        self.result = result
+        self.coalesced = coalesced
+        if not self._future.done():
+            self._future.set_result(self)
+
+    def _fail(self, error: BaseException) -> None:
+        self.status = "failed"
+        self.error = getattr(error, "message", None) or str(error)
+        self.status_code = getattr(error, "status_code", None)
+        if not self._future.done():
+            self._future.set_result(self)
+
+    async def wait(self) -> "CommandTicket":
+        # Shielded: a caller going away does not cancel the upstream send
+        return await asyncio.shield(self._future)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "commandId": self.id,
+            "deviceId": self.device_id,
+            "kind": self.kind,
+            "status": self.status,
+            "coalesced": self.coalesced,
+            "data": self.result,
+            "error": self.error,
+            "statusCode": self.status_code,
+        }
+
+
+class _TargetBatch:
+    """Target updates for one device collected during one coalescing window"""
+
+    def __init__(self, token: str):
+        self.token = token
+        self.fields: Dict[str, float] = {}
+        self.tickets: List[CommandTicket] = []
+        self.task: Optional[asyncio.Future] = None
+
+
+class _TargetSlot:
+    def __init__(self):
+        self.pending: Optional[_TargetBatch] = None
+        self.sending: Optional[asyncio.Future] = None
+        self.last_fields: Optional[Dict[str, float]] = None
+        self.last_result: Optional[Dict[str, Any]] = None
+        self.last_sent_at = 0.0
+
+
+class DeviceCommandQueue:
+    """
+    Sits in front of `set_device_target` / `send_device_command`.
+
+    Target updates for the same caller and device arriving within
+    `window_seconds` of the first one are merged (latest value per field wins)
+    and sent as one upstream call, never overlapping a previous send for that
+    device. A merged update equal to the last one sent less than
+    `dedupe_seconds` ago is not sent again. A device's slot is dropped once
+    nothing is pending or sending for it and its dedupe window has passed.
+
+    Identical idempotent commands (same caller, device, command and
+    parameters) share one in-flight upstream call, and a repeat within
+    `dedupe_seconds` of a successful send reuses its result. A command is
+    idempotent if it is in `idempotent_commands` or the caller says so; every
+    other command is sent each time it is requested.
+
+    Callers are told apart by `identify(token)`, which should stay the same
+    across token refreshes (e.g. TokenManager.identity), so a caller keeps
+    access to its tickets after its token is refreshed.
+    """
+
+    def __init__(
+        self,
+        send_target: TargetSender,
+        send_command: CommandSender,
+        window_seconds: float = 0.3,
+        dedupe_seconds: float = 1.0,
+        max_tickets: int = 1000,
+        idempotent_commands: Iterable[str] = (),
+        identify: Identify = token_fingerprint,
+    ):
+        self._send_target = send_target
+        self._send_command = send_command
+        self._identify = identify
+        self.window_seconds = window_seconds
+        self.dedupe_seconds = dedupe_seconds
+        self.max_tickets = max_tickets
+        self.idempotent_commands = frozenset(idempotent_commands)
+        self._targets: Dict[Tuple[str, str], _TargetSlot] = {}
+        self._commands: Dict[Tuple[str, ...], Tuple[asyncio.Future, List[CommandTicket]]] = {}
+        self._recent_commands: Dict[Tuple[str, ...], Tuple[float, Dict[str, Any]]] = {}
+        self._tickets: "OrderedDict[str, CommandTicket]" = OrderedDict()
+        # Sends nothing else holds on to, kept referenced until they finish
+        self._tasks: Set[asyncio.Future] = set()
+        self.stats = {
+            "targetRequests": 0,
+            "targetSends": 0,
+            "commandRequests": 0,
+            "commandSends": 0,
+            "duplicates": 0,
+            "failures": 0,
+        }
+
+    @classmethod
+    def from_env(
+        cls,
+        send_target: TargetSender,
+        send_command: CommandSender,
+        identify: Identify = token_fingerprint,
+    ) -> "DeviceCommandQueue":
+        return cls(
+            send_target,
+            send_command,
+            identify=identify,
+            window_seconds=float(os.getenv("HARVIA_COMMAND_COALESCE_WINDOW", "0.3")),
+            dedupe_seconds=float(os.getenv("HARVIA_COMMAND_DEDUPE_WINDOW", "1.0")),
+            idempotent_commands=[
+                command.strip()
+                for command in os.getenv("HARVIA_IDEMPOTENT_COMMANDS", "").split(",")
+                if command.strip()
+            ],
+        )
+
+    def _track(self, ticket: CommandTicket) -> CommandTicket:
+        self._tickets[ticket.id] = ticket
+        while len(self._tickets) > self.max_tickets:
+            self._tickets.popitem(last=False)
+        return ticket
+
+    def get_ticket(self, ticket_id: str, token: str) -> Optional[CommandTicket]:
+        """A caller's ticket by ID (None if unknown, expired or someone else's)"""
+        ticket = self._tickets.get(ticket_id)
+        if ticket is None or ticket.owner != self._identify(token):
+            return None
+        return ticket
+
+    # -- target updates ---------------------------------------------------
+
+    def set_target(
+        self,
+        token: str,
+        device_id: str,
+        temperature: Optional[float] = None,
+        humidity: Optional[float] = None,
+    ) -> CommandTicket:
+        """Queue a target update; the returned ticket completes once it is sent"""
+        self.stats["targetRequests"] += 1
+        owner = self._identify(token)
+        loop = asyncio.get_running_loop()
+        key = (owner, device_id)
+        slot = self._targets.setdefault(key, _TargetSlot())
+
+        batch = slot.pending
+        if batch is None or batch.task is None or batch.task.get_loop() is not loop:
+            batch = _TargetBatch(token)
+            slot.pending = batch
+            batch.task = asyncio.ensure_future(self._flush_target(key, slot, batch))
+
+        batch.token = token
+        if temperature is not None:
+            batch.fields["temperature"] = temperature
+        if humidity is not None:
+            batch.fields["humidity"] = humidity
+        ticket = self._track(CommandTicket(owner, device_id, "target"))
+        batch.tickets.append(ticket)
+        return ticket
+
+    async def _flush_target(self, key: Tuple[str, str], slot: _TargetSlot, batch: _TargetBatch) -> None:
+        await asyncio.sleep(self.window_seconds)
+        # Keep sends for one device in order; updates keep merging meanwhile
+        previous = slot.sending
+        if previous is not None and not previous.done() and previous.get_loop() is asyncio.get_running_loop():
+            await asyncio.wait([previous])
+        if slot.pending is batch:
+            slot.pending = None
+        slot.sending = asyncio.current_task()
+        try:
+            await self._send_batch(key[1], slot, batch)
+        finally:
+            # Keep the slot through its dedupe window, then drop it if idle
+            asyncio.get_running_loop().call_later(self.dedupe_seconds, self._release_slot, key, slot)
+
+    def _release_slot(self, key: Tuple[str, str], slot: _TargetSlot) -> None:
+        if self._targets.get(key) is not slot or slot.pending is not None:
+            return
+        if slot.sending is not None and not slot.sending.done():
+            return
+        remaining = slot.last_sent_at + self.dedupe_seconds - time.monotonic()
+        if remaining > 0:
+            asyncio.get_running_loop().call_later(remaining, self._release_slot, key, slot)
+            return
+        del self._targets[key]
+
+    async def _send_batch(self, device_id: str, slot: _TargetSlot, batch: _TargetBatch) -> None:
+        count = len(batch.tickets)
+        fields = dict(batch.fields)
+        if (
+            slot.last_fields == fields
+            and time.monotonic() - slot.last_sent_at < self.dedupe_seconds
+        ):
+            self.stats["duplicates"] += 1
+            for ticket in batch.tickets:
+                ticket._resolve("duplicate", slot.last_result, count)
+            return
+
+        try:
+            self.stats["targetSends"] += 1
+            result = await self._send_target(
+                batch.token, device_id, fields.get("temperature"), fields.get("humidity")
+            )
+        except Exception as e:
+            self.stats["failures"] += 1
+            logger.warning("Target update for %s failed: %s", device_id, e)
+            for ticket in batch.tickets:
+                ticket.coalesced = count
+                ticket._fail(e)
+            return
+
+        slot.last_fields = fields
+        slot.last_result = result
+        slot.last_sent_at = time.monotonic()
+        if count > 1:
+            logger.debug("Coalesced %d target updates for %s into one call", count, device_id)
+        for ticket in batch.tickets:
+            ticket._resolve("sent", result, count)
+
+    # -- commands -----------------------------------------------------------
+
+    def send_command(
+        self,
+        token: str,
+        device_id: str,
+        command: str,
+        parameters: Optional[Dict[str, Any]] = None,
+        idempotent: bool = False,
+    ) -> CommandTicket:
+        """
+        Queue a command. Identical concurrent or repeated commands are sent once
+        if the command is idempotent (listed in `idempotent_commands`, or
+        `idempotent=True`); otherwise every call is sent.
+        """
+        self.stats["commandRequests"] += 1
+        owner = self._identify(token)
+        ticket = self._track(CommandTicket(owner, device_id, "command"))
+        if not (idempotent or command in self.idempotent_commands):
+            task = asyncio.ensure_future(self._run_command(None, token, device_id, command, parameters, [ticket]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return ticket
+
+        key = (owner, device_id, command, json.dumps(parameters, sort_keys=True, default=str))
+
+        recent = self._recent_commands.get(key)
+        if recent is not None and time.monotonic() - recent[0] < self.dedupe_seconds:
+            self.stats["duplicates"] += 1
+            ticket._resolve("duplicate", recent[1])
+            return ticket
+
+        in_flight = self._commands.get(key)
+        if in_flight is not None and not in_flight[0].done() and in_flight[0].get_loop() is asyncio.get_running_loop():
+            self.stats["duplicates"] += 1
+            in_flight[1].append(ticket)
+            return ticket
+
+        tickets = [ticket]
+        task = asyncio.ensure_future(self._run_command(key, token, device_id, command, parameters, tickets))
+        self._commands[key] = (task, tickets)
+        return ticket
+
+    async def _run_command(
+        self,
+        key: Optional[Tuple[str, ...]],
+        token: str,
+        device_id: str,
+        command: str,
+        parameters: Optional[Dict[str, Any]],
+        tickets: List[CommandTicket],
+    ) -> None:
+        try:
+            self.stats["commandSends"] += 1
+            result = await self._send_command(token, device_id, command, parameters)
+        except Exception as e:
+            self.stats["failures"] += 1
+            for ticket in tickets:
+                ticket._fail(e)
+            return
+        finally:
+            if key is not None and self._commands.get(key, (None,))[0] is asyncio.current_task():
+                del self._commands[key]
+
+        if key is None:
+            tickets[0]._resolve("sent", result)
+            return
+        now = time.monotonic()
+        self._recent_commands[key] = (now, result)
+        for stale in [k for k, (at, _) in self._recent_commands.items() if now - at >= self.dedupe_seconds]:
+            del self._recent_commands[stale]
+        for index, ticket in enumerate(tickets):
+            ticket._resolve("sent" if index == 0 else "duplicate", result, len(tickets))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "windowSeconds": self.window_seconds,
+            "dedupeSeconds": self.dedupe_seconds,
+            "devices": len(self._targets),
+            "pendingTargets": sum(1 for slot in self._targets.values() if slot.pending is not None),
+            "inFlightCommands": len(self._commands),
+            **self.stats,
+        }
+
+
+# Global queue used by the /api/harvia command and target routes
+device_command_queue = DeviceCommandQueue.from_env(
+    lambda id_token, device_id, temperature, humidity: harvia_service.set_device_target(
+        id_token, device_id, temperature, humidity
+    ),
+    lambda id_token, device_id, command, parameters: harvia_service.send_device_command(
+        id_token, device_id, command, parameters
+    ),
+    identify=token_manager.identity,
+)
@@ -0,0 +1,114 @@
+"""
+Concurrency helpers
+Bounded fan-out and single-flight coalescing for upstream Harvia calls
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence
+
+
+class FanOutResult:
+    """Outcome of `fan_out`, keyed by the index of each input item"""
+
+    def __init__(self):
+        self.results: Dict[int, Any] = {}
+        self.errors: Dict[int, BaseException] = {}
+        self.timed_out: List[int] = []
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.errors or self.timed_out)
+
+
+async def fan_out(
+    items: Sequence[Any],
+    worker: Callable[[Any], Awaitable[Any]],
+    limit: int,
+    deadline: Optional[float] = None,
+) -> FanOutResult:
+    """
+    Run `worker(item)` for every item with at most `limit` running at once.
+
+    Workers still running after `deadline` seconds are cancelled and reported
+    in `timed_out`; exceptions are collected per item instead of aborting the
+    whole batch, so callers always get whatever finished in time.
+    """
+    outcome = FanOutResult()
+    if not items:
+        return outcome
+
+    slots = asyncio.Semaphore(max(1, limit))
+
+    async def run(item: Any) -> Any:
+        async with slots:
+            return await worker(item)
+
+    tasks = {asyncio.ensure_future(run(item)): index for index, item in enumerate(items)}
+    try:
+        done, pending = await asyncio.wait(
+            tasks,
+            timeout=max(0.0, deadline) if deadline is not None else None,
+        )
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    for task in pending:
+        task.cancel()
+        outcome.timed_out.append(tasks[task])
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    for task in done:
+        index = tasks[task]
+        error = task.exception()
+        if error is not None:
+            outcome.errors[index] = error
+        else:
+            outcome.results[index] = task.result()
+
+    outcome.timed_out.sort()
+    return outcome
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key into one in-flight task.
+
+    The first caller starts `fn()`; callers arriving while it runs await the
+    same result (or exception). Callers are shielded from each other, so one
+    caller being cancelled does not cancel the shared task.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        task = self._inflight.get(key)
+        return (
+            task is not None
+            and not task.done()
+            and task.get_loop() is asyncio.get_running_loop()
+        )
+
+    def start(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """Return the in-flight task for `key`, starting `fn()` if there is none"""
+        loop = asyncio.get_running_loop()
+        task = self._inflight.get(key)
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+
+            def forget(finished: asyncio.Future) -> None:
+                if self._inflight.get(key) is finished:
+                    del self._inflight[key]
+                if not finished.cancelled():
+                    # Mark the exception as retrieved for fire-and-forget callers
+                    finished.exception()
+
+            task.add_done_callback(forget)
+        return task
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        return await asyncio.shield(self.start(key, fn))
@@ -0,0 +1,199 @@
+"""
+Device List Cache
+Per-caller cache of normalized Harvia device lists with stale-while-revalidate
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Set, Tuple
+
+from pydantic import BaseModel
+
+from services.concurrency import SingleFlight
+from services.etag import SerializedResponse
+
+logger = logging.getLogger(__name__)
+
+
+class _CacheEntry:
+    __slots__ = ("value", "stored_at")
+
+    def __init__(self, value: Any, stored_at: float):
+        self.value = value
+        self.stored_at = stored_at
+
+
+class DeviceListCache:
+    """
+    LRU cache of device lists keyed by a hash of the caller's token.
+
+    - Entries younger than `ttl_seconds` are served directly.
+    - Entries up to `stale_seconds` past the TTL are served immediately while a
+      background refresh replaces them.
+    - Older entries and misses are loaded in the foreground; concurrent misses
+      for the same key share one upstream load.
+    - At most `max_entries` callers are kept; the least recently used is evicted.
+    """
+
+    def __init__(self, ttl_seconds: float = 60.0, stale_seconds: float = 300.0, max_entries: int = 1000):
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._flight = SingleFlight()
+        self._background: Set[asyncio.Future] = set()
+        self.stats = {"hits": 0, "staleHits": 0, "misses": 0, "refreshes": 0, "refreshErrors": 0, "evictions": 0}
+
+    @classmethod
+    def from_env(cls) -> "DeviceListCache":
+        return cls(
+            ttl_seconds=float(os.getenv("HARVIA_DEVICE_CACHE_TTL", "60")),
+            stale_seconds=float(os.getenv("HARVIA_DEVICE_CACHE_STALE", "300")),
+            max_entries=int(os.getenv("HARVIA_DEVICE_CACHE_SIZE", "1000")),
+        )
+
+    def _store(self, key: str, value: Any) -> None:
+        self._entries[key] = _CacheEntry(value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def _load(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        cache_if: Callable[[Any], bool],
+    ) -> Any:
+        value = await loader()
+        if cache_if(value):
+            self._store(key, value)
+        return value
+
+    def _refresh_in_background(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        cache_if: Callable[[Any], bool],
+    ) -> None:
+        if self._flight.in_flight(key):
+            return
+        self.stats["refreshes"] += 1
+        task = self._flight.start(key, lambda: self._load(key, loader, cache_if))
+        self._background.add(task)
+
+        def done(finished: asyncio.Future) -> None:
+            self._background.discard(finished)
+            if not finished.cancelled() and finished.exception() is not None:
+                self.stats["refreshErrors"] += 1
+                logger.warning("Background device list refresh failed: %s", finished.exception())
+
+        task.add_done_callback(done)
+
+    async def get(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        cache_if: Callable[[Any], bool] = lambda value: True,
+    ) -> Any:
+        """
+        Return the cached value for `key`, calling `loader()` when needed.
+
+        `cache_if(value)` decides whether a freshly loaded value is stored
+        (e.g. partial results are returned but not cached).
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry.stored_at
+            if age < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry.value
+            if age < self.ttl_seconds + self.stale_seconds:
+                self._entries.move_to_end(key)
+                self.stats["staleHits"] += 1
+                self._refresh_in_background(key, loader, cache_if)
+                return entry.value
+            del self._entries[key]
+
+        self.stats["misses"] += 1
+        return await self._flight.do(key, lambda: self._load(key, loader, cache_if))
+
+    def invalidate(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Any], bool]) -> int:
+        """Drop every entry whose value matches `predicate`; returns how many"""
+        stale_keys = [key for key, entry in self._entries.items() if predicate(entry.value)]
+        for key in stale_keys:
+            del self._entries[key]
+        return len(stale_keys)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "maxEntries": self.max_entries,
+            "ttlSeconds": self.ttl_seconds,
+            "staleSeconds": self.stale_seconds,
+            **self.stats,
+        }
+
+
+class DeviceStateResponses:
+    """
+    LRU of the last serialized state response per device.
+
+    Device state is always read upstream, but it rarely changes between polls;
+    when the upstream state equals the cached one, the cached body and ETag are
+    reused, so a conditional request is answered without serializing again.
+    At most `max_entries` devices are kept; the least recently used is evicted.
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[Any, SerializedResponse]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @classmethod
+    def from_env(cls) -> "DeviceStateResponses":
+        return cls(max_entries=int(os.getenv("HARVIA_DEVICE_STATE_CACHE_SIZE", "1000")))
+
+    def get(self, device_id: str, state: Any, build: Callable[[], BaseModel]) -> SerializedResponse:
+        """Cached payload for `device_id` if `state` is unchanged, else `build()` serialized and stored"""
+        entry = self._entries.get(device_id)
+        if entry is not None and entry[0] == state:
+            self._entries.move_to_end(device_id)
+            self.stats["hits"] += 1
+            return entry[1]
+
+        self.stats["misses"] += 1
+        payload = SerializedResponse(build())
+        self._entries[device_id] = (state, payload)
+        self._entries.move_to_end(device_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+        return payload
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "maxEntries": self.max_entries,
+            **self.stats,
+        }
+
+
+# Global cache instance used by the /api/harvia/devices route
+device_list_cache = DeviceListCache.from_env()
+
+# Global instance used by the /api/harvia/devices/{device_id}/state route
+device_state_responses = DeviceStateResponses.from_env()
@@ -0,0 +1,231 @@
+"""
+Device Normalizer
+Declarative mapping from raw Harvia device payloads (GraphQL or REST) to Device models
+"""
+
+import os
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from schemas import Device
+
+# ---------------------------------------------------------------------------
+# Mapping table
+#
+# Each rule fills `target` from the first usable source field. `when` decides
+# whether the rule runs at all:
+#   "falsy"   - target is missing or empty
+#   "absent"  - target key is not present
+#   "always"  - overwrite whenever a source value is usable
+# A source value is usable when it is truthy (or merely present, for rules with
+# `accept_present`), and `convert` (if any) does not raise ValueError/TypeError.
+# ---------------------------------------------------------------------------
+
+TIMESTAMP_FIELDS = ("lastActivity", "lastConnectionTime", "lastSeen", "updatedAt", "createdAt")
+DISPLAY_NAME_FIELDS = ("name", "displayName", "alias", "deviceName")
+BATTERY_FIELDS = ("batteryLevel", "battery", "batteryPercent", "batteryPercentage")
+SIGNAL_FIELDS = ("signalStrength", "signal", "rssi", "wifiSignal", "wifiRSSI")
+COPIED_ATTRS = ("brand", "serialNumber", "organization", "country", "city", "espChip", "firmwareVersion")
+LOCATION_NAME_FIELDS = ("city", "location", "country")
+LATITUDE_FIELDS = ("latitude", "w_latitude")  # GPS first, then WiFi-based
+LONGITUDE_FIELDS = ("longitude", "w_longitude")
+
+
+def _to_bool(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() == "true"
+
+
+def _display_name(value: Any) -> str:
+    # Long values with dashes/underscores are serial numbers or device IDs, not names
+    if len(value) > 20 and ("-" in value or "_" in value):
+        raise ValueError("looks like a device ID/serial")
+    return value
+
+
+# (target, source fields, convert, when, accept_present)
+TOP_LEVEL_RULES = (
+    ("isConnected", ("connected",), _to_bool, "always", True),
+    ("lastSeen", TIMESTAMP_FIELDS, None, "falsy", False),
+)
+
+ATTR_RULES = (
+    ("displayName", DISPLAY_NAME_FIELDS, _display_name, "falsy", False),
+    ("isConnected", ("connected",), _to_bool, "absent", True),
+    ("lastSeen", TIMESTAMP_FIELDS, None, "falsy", False),
+    ("batteryLevel", BATTERY_FIELDS, float, "absent", True),
+    ("signalStrength", SIGNAL_FIELDS, float, "absent", True),
+) + tuple((field, (field,), None, "always", False) for field in COPIED_ATTRS)
+
+
+Rule = Callable[[Dict[str, Any], Dict[str, Any]], None]
+
+
+def _compile_rule(
+    target: str,
+    sources: Tuple[str, ...],
+    convert: Optional[Callable[[Any], Any]],
+    when: str,
+    accept_present: bool,
+) -> Rule:
+    """Turn one table row into a function `apply(device, source)`"""
+    if when == "falsy":
+        def should_run(device: Dict[str, Any]) -> bool:
+            return not device.get(target)
+    elif when == "absent":
+        def should_run(device: Dict[str, Any]) -> bool:
+            return target not in device
+    else:
+        def should_run(device: Dict[str, Any]) -> bool:
+            return True
+
+    def apply(device: Dict[str, Any], source: Dict[str, Any]) -> None:
+        if not should_run(device):
+            return
+        for field in sources:
+            if field not in source:
+                continue
+            value = source[field]
+            if not accept_present and not value:
+                continue
+            if convert is not None:
+                try:
+                    value = convert(value)
+                except (ValueError, TypeError):
+                    continue
+            device[target] = value
+            return
+
+    return apply
+
+
+# Compiled once at import
+_TOP_LEVEL: List[Rule] = [_compile_rule(*rule) for rule in TOP_LEVEL_RULES]
+_FROM_ATTRS: List[Rule] = [_compile_rule(*rule) for rule in ATTR_RULES]
+
+
+def _first_float(attrs: Dict[str, Any], fields: Tuple[str, ...]) -> Optional[float]:
+    for field in fields:
+        if attrs.get(field):
+            try:
+                return float(attrs[field])
+            except (ValueError, TypeError):
+                pass
+    return None
+
+
+def _fallback_display_name(device: Dict[str, Any], attrs: Dict[str, Any]) -> str:
+    """User-friendly name when no attribute carries one, e.g. "Fenix Espoo" """
+    device_type = device.get("type", "Device")
+    city = attrs.get("city")
+    serial = attrs.get("serialNumber")
+    if city:
+        return f"{device_type} {city}"
+    if serial and len(serial) < 15 and not serial.startswith("simulated"):
+        return f"{device_type} {serial}"
+    short_id = device.get("id", "")[-8:] if device.get("id") else ""
+    return f"{device_type} {short_id}" if short_id else device_type
+
+
+def _location(attrs: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Location from coordinates in attrs; None unless both coordinates parse"""
+    latitude = _first_float(attrs, LATITUDE_FIELDS)
+    longitude = _first_float(attrs, LONGITUDE_FIELDS)
+    if latitude is None or longitude is None:
+        return None
+    name = next((attrs[field] for field in LOCATION_NAME_FIELDS if attrs.get(field)), "Unknown Location")
+    return {"name": name, "latitude": latitude, "longitude": longitude}
+
+
+def normalize_device_data(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Map a raw device payload to Device fields (the input is not modified).
+
+    GraphQL payloads carry `id` and top-level fields; REST payloads use `name`
+    as the device ID and keep everything else in the `attr` key/value list.
+    """
+    device = dict(raw)
+    if "id" not in device and "name" in device:
+        device["id"] = device["name"]
+    if "name" not in device and "id" in device:
+        device["name"] = device["id"]
+
+    for rule in _TOP_LEVEL:
+        rule(device, raw)
+
+    attr_list = raw.get("attr")
+    if isinstance(attr_list, list):
+        attrs = {item["key"]: item["value"] for item in attr_list if "key" in item and "value" in item}
+        for rule in _FROM_ATTRS:
+            rule(device, attrs)
+        if not device.get("displayName"):
+            device["displayName"] = _fallback_display_name(device, attrs)
+        if not device.get("location"):
+            location = _location(attrs)
+            if location is not None:
+                device["location"] = location
+
+    return device
+
+
+def payload_key(raw: Dict[str, Any]) -> str:
+    """
+    Memo key for a raw payload: its repr, which the memo dict hashes.
+
+    repr is about twice as fast as a JSON encoding plus digest, and keeping the
+    full string (rather than a digest) means two payloads can never collide.
+    Upstream emits fields in a stable order, so reordered keys only cost a miss.
+    """
+    return repr(raw)
+
+
+class DeviceNormalizer:
+    """
+    Normalizes raw payloads into Device models, memoized by payload content.
+
+    An unchanged device costs one repr and a dictionary lookup. At most
+    `max_entries` results are kept (least recently used evicted). Cached
+    Device instances are shared between responses and must not be mutated.
+
+    Raw fields copied by the mapping are upstream data, so each payload is
+    validated into a Device once, on a memo miss; a malformed payload raises
+    pydantic's ValidationError. Render the models with services.fast_json
+    rather than model_dump_json.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Device]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @classmethod
+    def from_env(cls) -> "DeviceNormalizer":
+        return cls(max_entries=int(os.getenv("HARVIA_NORMALIZER_CACHE_SIZE", "4096")))
+
+    def normalize(self, raw: Dict[str, Any]) -> Device:
+        key = payload_key(raw)
+        device = self._entries.get(key)
+        if device is not None:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return device
+
+        self.stats["misses"] += 1
+        device = Device.model_validate(normalize_device_data(raw))
+        if self.max_entries > 0:
+            self._entries[key] = device
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return device
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), "maxEntries": self.max_entries, **self.stats}
+
+
+# Global normalizer used by the /api/harvia/devices route
+device_normalizer = DeviceNormalizer.from_env()
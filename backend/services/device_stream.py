@@ -0,0 +1,119 @@
+"""
+Device Stream
+Yields listed devices one by one as their enrichment finishes
+"""
+
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DetailsFetcher = Callable[[List[Dict[str, Any]]], Awaitable[Dict[str, Dict[str, Any]]]]
+AliasLookup = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class DeviceStream:
+    """
+    Enrichment pipeline for one device listing.
+
+    Summaries are split into chunks of `batch_size`; each chunk's details are
+    fetched with `fetch_details` and then every device in it gets its
+    `lookup_alias` call. A device is yielded as soon as its own lookups are done,
+    with at most `limit` upstream calls in flight across the whole pipeline.
+
+    At `deadline_at` (loop time) outstanding work is cancelled and the remaining
+    devices are yielded with whatever was fetched, at least their summary.
+    Once iteration ends, `timed_out`, `errors` and `partial` describe what was
+    not fully enriched.
+    """
+
+    def __init__(
+        self,
+        summaries: List[Dict[str, Any]],
+        fetch_details: Optional[DetailsFetcher] = None,
+        lookup_alias: Optional[AliasLookup] = None,
+        batch_size: int = 25,
+        limit: int = 8,
+        deadline_at: Optional[float] = None,
+    ):
+        self.summaries = summaries
+        self.fetch_details = fetch_details
+        self.lookup_alias = lookup_alias
+        self.batch_size = max(1, batch_size)
+        self.limit = limit
+        self.deadline_at = deadline_at
+        self.timed_out: List[str] = []
+        self.errors: List[Dict[str, Any]] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.summaries)
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.timed_out or self.errors)
+
+    async def items(self) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        """(index in the listing, device data) pairs, in completion order"""
+        if self.fetch_details is None and self.lookup_alias is None:
+            for index, device in enumerate(self.summaries):
+                yield index, device
+            return
+
+        loop = asyncio.get_running_loop()
+        current = list(self.summaries)
+        waiting = set(range(len(current)))
+        ready: "asyncio.Queue[int]" = asyncio.Queue()
+        slots = asyncio.Semaphore(max(1, self.limit))
+
+        async def lookup(index: int) -> None:
+            try:
+                async with slots:
+                    await self.lookup_alias(current[index])
+            except Exception as e:
+                logger.debug("Alias lookup failed for %s: %s", current[index].get("id"), e)
+            ready.put_nowait(index)
+
+        async def enrich(start: int, chunk: List[Dict[str, Any]]) -> None:
+            details: Dict[str, Dict[str, Any]] = {}
+            if self.fetch_details is not None:
+                try:
+                    async with slots:
+                        details = await self.fetch_details(chunk)
+                except Exception as e:
+                    # Fall back to the listing summaries for this chunk
+                    logger.warning("Batched devicesGet failed: %s", e)
+                    self.errors.append({"deviceIds": [summary["id"] for summary in chunk], "error": str(e)})
+            for offset, summary in enumerate(chunk):
+                current[start + offset] = details.get(summary["id"]) or summary
+            if self.lookup_alias is None:
+                for offset in range(len(chunk)):
+                    ready.put_nowait(start + offset)
+            else:
+                await asyncio.gather(*(lookup(start + offset) for offset in range(len(chunk))))
+
+        tasks = [
+            asyncio.ensure_future(enrich(start, current[start:start + self.batch_size]))
+            for start in range(0, len(current), self.batch_size)
+        ]
+        try:
+            while waiting:
+                timeout = None if self.deadline_at is None else self.deadline_at - loop.time()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    index = await asyncio.wait_for(ready.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                waiting.discard(index)
+                yield index, current[index]
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Deadline hit: hand out the rest with what was fetched so far
+        for index in sorted(waiting):
+            self.timed_out.append(current[index]["id"])
+            yield index, current[index]
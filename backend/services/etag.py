@@ -0,0 +1,56 @@
+"""
+Conditional Responses
+Pre-serialized JSON bodies with strong ETags, and If-None-Match handling
+"""
+
+import hashlib
+from typing import Optional
+
+from fastapi import Request, Response
+from pydantic import BaseModel
+
+from services.fast_json import dumps
+
+# Clients must revalidate, but may keep the body around and send If-None-Match
+CACHE_CONTROL = "private, no-cache"
+
+
+class SerializedResponse:
+    """
+    A response model serialized once to compact JSON bytes (services.fast_json,
+    so models built without validation render the same as validated ones).
+
+    The ETag is a digest of those bytes, so it is stable for as long as the
+    payload is unchanged and can be cached alongside it.
+    """
+
+    __slots__ = ("model", "body", "etag")
+
+    def __init__(self, model: BaseModel):
+        self.model = model
+        self.body = dumps(model)
+        self.etag = f'"{hashlib.blake2b(self.body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """True if an If-None-Match header value matches `etag` (weak comparison)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def conditional_response(request: Request, payload: SerializedResponse) -> Response:
+    """200 with the pre-serialized body, or 304 if the client already has it"""
+    headers = {"ETag": payload.etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), payload.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=payload.body, media_type="application/json", headers=headers)
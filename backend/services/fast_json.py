@@ -0,0 +1,75 @@
+"""
+Fast JSON
+Validation-free model construction and direct-to-bytes JSON rendering for trusted payloads
+"""
+
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from enum import Enum
+from typing import Any, Dict, Type, TypeVar
+from uuid import UUID
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # Optional dependency (the "fast-json" extra)
+    orjson = None
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+
+def construct(model_cls: Type[ModelT], data: Dict[str, Any]) -> ModelT:
+    """
+    Build `model_cls` from data we produced ourselves, skipping validation.
+
+    Nested values are kept as given (a dict stays a dict), so only use this for
+    payloads that already have the model's shape and hold no upstream values,
+    e.g. response envelopes around already validated models.
+    """
+    return model_cls.model_construct(**data)
+
+
+def model_fields(model: BaseModel) -> Dict[str, Any]:
+    """Field values in declaration order, then extras: what model_dump returns, unconverted"""
+    data = dict(model.__dict__)
+    extra = model.__pydantic_extra__
+    if extra:
+        data.update(extra)
+    return data
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return model_fields(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, UUID):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value: Any) -> bytes:
+    """
+    Compact UTF-8 JSON for plain data and models without aliases or custom
+    serializers. Uses orjson when installed, the json module otherwise; both
+    produce the same document for the payloads served here.
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with `dumps`, skipping jsonable_encoder"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
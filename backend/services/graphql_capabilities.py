@@ -0,0 +1,133 @@
+"""
+GraphQL Schema Capability Cache
+Remembers which query shapes an upstream GraphQL endpoint accepts or rejects
+"""
+
+import json
+import logging
+import os
+import time
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Error fragments GraphQL servers (AppSync included) use when a query does not
+# match the schema. Other failures (auth, throttling, 5xx) are not cached.
+SCHEMA_ERROR_MARKERS = (
+    "validation",
+    "fieldundefined",
+    "cannot query field",
+    "unknown field",
+    "unknown type",
+    "unknown argument",
+    "is not defined",
+)
+
+
+def is_schema_rejection(status_code: int, result: Optional[Dict[str, Any]]) -> bool:
+    """True if a GraphQL response says the query itself is invalid for the schema"""
+    if status_code == 400:
+        return True
+    if not isinstance(result, dict):
+        return False
+    for error in result.get("errors") or []:
+        text = f"{error.get('errorType', '')} {error.get('message', '')}".lower()
+        if any(marker in text for marker in SCHEMA_ERROR_MARKERS):
+            return True
+    return False
+
+
+class SchemaCapabilityCache:
+    """
+    Per-endpoint record of supported/rejected GraphQL operations.
+
+    Entries expire after `ttl_seconds` so a schema change upstream is picked up
+    eventually. When `path` is set the cache is loaded from and saved to that
+    JSON file, so known-bad probes stay skipped across restarts.
+    """
+
+    def __init__(self, ttl_seconds: float = 24 * 3600, path: Optional[str] = None):
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self._entries: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        if path:
+            self.load()
+
+    @classmethod
+    def from_env(cls) -> "SchemaCapabilityCache":
+        return cls(
+            ttl_seconds=float(os.getenv("HARVIA_CAPABILITY_TTL", str(24 * 3600))),
+            path=os.getenv("HARVIA_CAPABILITY_CACHE_PATH") or None,
+        )
+
+    def _entry(self, endpoint: str, operation: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(endpoint, {}).get(operation)
+        if entry is None:
+            return None
+        if time.time() - entry["checkedAt"] > self.ttl_seconds:
+            del self._entries[endpoint][operation]
+            return None
+        return entry
+
+    def is_supported(self, endpoint: str, operation: str) -> bool:
+        entry = self._entry(endpoint, operation)
+        return entry is not None and entry["supported"]
+
+    def is_rejected(self, endpoint: str, operation: str) -> bool:
+        entry = self._entry(endpoint, operation)
+        return entry is not None and not entry["supported"]
+
+    def _record(self, endpoint: str, operation: str, supported: bool) -> None:
+        previous = self._entry(endpoint, operation)
+        self._entries.setdefault(endpoint, {})[operation] = {
+            "supported": supported,
+            "checkedAt": time.time(),
+        }
+        if previous is None or previous["supported"] != supported:
+            self.save()
+
+    def mark_supported(self, endpoint: str, operation: str) -> None:
+        self._record(endpoint, operation, True)
+
+    def mark_rejected(self, endpoint: str, operation: str) -> None:
+        logger.info("GraphQL endpoint %s rejects operation %s, skipping it from now on", endpoint, operation)
+        self._record(endpoint, operation, False)
+
+    def load(self) -> None:
+        """Load persisted entries, ignoring a missing or unreadable file"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as handle:
+                data = json.load(handle)
+            self._entries = {
+                endpoint: dict(operations)
+                for endpoint, operations in data.get("endpoints", {}).items()
+            }
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning("Could not load GraphQL capability cache %s: %s", self.path, e)
+
+    def save(self) -> None:
+        """Persist entries atomically (write to a temp file, then rename)"""
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as handle:
+                json.dump({"endpoints": self._entries}, handle)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("Could not save GraphQL capability cache %s: %s", self.path, e)
+
+    def clear(self) -> None:
+        self._entries = {}
+        self.save()
+
+    def snapshot(self) -> Dict[str, Dict[str, bool]]:
+        return {
+            endpoint: {
+                operation: entry["supported"]
+                for operation, entry in operations.items()
+            }
+            for endpoint, operations in self._entries.items()
+        }
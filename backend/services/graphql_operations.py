@@ -0,0 +1,112 @@
+"""
+GraphQL Operations
+Named Harvia GraphQL documents, taking their inputs as variables and serialized once
+"""
+
+import hashlib
+import json
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+# Fields selected for every device document
+DEVICE_FIELDS = "id type attr { key value } roles via"
+
+# Error code/message servers use when a persisted-query hash is not registered
+PERSISTED_QUERY_NOT_FOUND = "PersistedQueryNotFound"
+
+
+class GraphQLOperation:
+    """
+    One named GraphQL document.
+
+    The document is whitespace-compacted and JSON-encoded once, together with
+    its operation name and persisted-query hash, so a request body is those
+    prebuilt bytes plus the encoded variables. `hash` is the SHA-256 hex digest
+    used by automatic persisted queries.
+    """
+
+    __slots__ = ("name", "document", "hash", "_full_prefix", "_persisted_prefix")
+
+    def __init__(self, name: str, document: str):
+        self.name = name
+        self.document = " ".join(document.split())
+        self.hash = hashlib.sha256(self.document.encode("utf-8")).hexdigest()
+        extensions = json.dumps({"persistedQuery": {"version": 1, "sha256Hash": self.hash}})
+        head = f'{{"operationName":{json.dumps(name)},"extensions":{extensions}'
+        self._persisted_prefix = f'{head},"variables":'.encode("utf-8")
+        self._full_prefix = f'{head},"query":{json.dumps(self.document)},"variables":'.encode("utf-8")
+
+    def body(self, variables: Optional[Dict[str, Any]] = None, persisted: bool = False) -> bytes:
+        """
+        JSON request body. With `persisted` the document is left out and only its
+        hash is sent; a server that does not know the hash answers with
+        PersistedQueryNotFound and the full body has to be sent instead.
+        """
+        prefix = self._persisted_prefix if persisted else self._full_prefix
+        return prefix + json.dumps(variables or {}, separators=(",", ":")).encode("utf-8") + b"}"
+
+
+def is_persisted_query_miss(result: Any) -> bool:
+    """True if a GraphQL response says the server does not know a persisted-query hash"""
+    if not isinstance(result, dict):
+        return False
+    for error in result.get("errors") or []:
+        code = (error.get("extensions") or {}).get("code") or error.get("message") or ""
+        if PERSISTED_QUERY_NOT_FOUND.lower() in str(code).replace("_", "").lower():
+            return True
+    return False
+
+
+LIST_DEVICES = GraphQLOperation("ListMyDevices", f"""
+query ListMyDevices {{
+  usersDevicesList {{
+    devices {{ {DEVICE_FIELDS} }}
+    nextToken
+  }}
+}}
+""")
+
+UPDATE_DEVICE_NAME = GraphQLOperation("UpdateDeviceName", """
+mutation UpdateDeviceName($deviceId: ID!, $attributes: [AttributeInput!]!) {
+  devicesUpdate(deviceId: $deviceId, attributes: $attributes) {
+    id
+    type
+    attr { key value }
+  }
+}
+""")
+
+# Query shapes tried against the users GraphQL service to find a device alias.
+# Most are not in the upstream schema; SchemaCapabilityCache keeps track of
+# which ones are, keyed by operation name.
+USERS_ALIAS_PROBES = (
+    GraphQLOperation("GetDeviceAlias", """
+    query GetDeviceAlias($deviceId: ID!) {
+      deviceAlias(deviceId: $deviceId)
+    }
+    """),
+    GraphQLOperation("GetDevicePreference", """
+    query GetDevicePreference($deviceId: ID!) {
+      devicePreference(deviceId: $deviceId) { alias displayName name }
+    }
+    """),
+    GraphQLOperation("GetUserDevice", """
+    query GetUserDevice($deviceId: ID!) {
+      userDevice(deviceId: $deviceId) { alias displayName name }
+    }
+    """),
+)
+
+
+@lru_cache(maxsize=None)
+def devices_get_batch(size: int) -> GraphQLOperation:
+    """
+    `GetDevices` for `size` devices: one aliased devicesGet field per device
+    (`d0: devicesGet(deviceId: $d0)`, ...), with the IDs passed as variables
+    named like the aliases. Built once per batch size.
+    """
+    params = ", ".join(f"$d{index}: ID!" for index in range(size))
+    fields = " ".join(
+        f"d{index}: devicesGet(deviceId: $d{index}) {{ {DEVICE_FIELDS} }}" for index in range(size)
+    )
+    return GraphQLOperation(f"GetDevices{size}", f"query GetDevices{size}({params}) {{ {fields} }}")
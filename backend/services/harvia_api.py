@@ -3,10 +3,40 @@ Harvia API Service
 Handles authentication and device operations with the Harvia Cloud API
 """
 
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import weakref
 import httpx
-from typing import Dict, Any, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 
+from logging_config import trace_enabled
+from services.concurrency import SingleFlight, fan_out
+from services.device_stream import DeviceStream
+from services.graphql_capabilities import SchemaCapabilityCache, is_schema_rejection
+from services.graphql_operations import (
+    LIST_DEVICES,
+    UPDATE_DEVICE_NAME,
+    USERS_ALIAS_PROBES,
+    GraphQLOperation,
+    devices_get_batch,
+    is_persisted_query_miss,
+)
+from services.http_pool import HTTPPool, HTTPPoolConfig
+from services.identity import token_fingerprint
+from services.rate_limit import RateLimiter, RateLimitExceeded
+from services.resilience import (
+    RETRYABLE_STATUS_CODES,
+    BreakerRegistry,
+    CircuitOpenError,
+    RetryPolicy,
+)
+
+logger = logging.getLogger(__name__)
+
 
 class HarviaAPIError(Exception):
     """Custom exception for Harvia API errors"""
@@ -19,38 +49,264 @@ class HarviaAPIError(Exception):
 class HarviaAPIService:
     """Service for interacting with Harvia Cloud API"""
     
-    ENDPOINTS_URL = "https://prod.api.harvia.io/endpoints"
+    ENDPOINTS_URL = os.getenv("HARVIA_ENDPOINTS_URL", "https://prod.api.harvia.io/endpoints")
+    # Per-device enrichment fan-out in _get_devices_graphql_users
+    ENRICH_CONCURRENCY = int(os.getenv("HARVIA_ENRICH_CONCURRENCY", "8"))
+    ENRICH_DEADLINE_SECONDS = float(os.getenv("HARVIA_ENRICH_DEADLINE", "8.0"))
+    # Devices per batched devicesGet document
+    DETAILS_BATCH_SIZE = int(os.getenv("HARVIA_DEVICES_BATCH_SIZE", "25"))
+    # Bulk per-device reads (GET /devices/state, /devices/telemetry)
+    BULK_CONCURRENCY = int(os.getenv("HARVIA_BULK_CONCURRENCY", "8"))
+    BULK_DEADLINE_SECONDS = float(os.getenv("HARVIA_BULK_DEADLINE", "10.0"))
+    # Send GraphQL operations as persisted-query hashes first (full document on a miss)
+    PERSISTED_QUERIES = os.getenv("HARVIA_GRAPHQL_PERSISTED_QUERIES", "false").lower() in ("1", "true", "yes")
+    # Endpoint configuration cache; set HARVIA_CONFIG_CACHE_PATH="" to disable persistence
+    CONFIG_TTL = timedelta(hours=1)
+    CONFIG_CACHE_PATH = os.getenv(
+        "HARVIA_CONFIG_CACHE_PATH",
+        os.path.join(tempfile.gettempdir(), "harvia_endpoints.json"),
+    )
     
-    def __init__(self):
+    def __init__(
+        self,
+        pool_config: Optional[HTTPPoolConfig] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
         self.endpoints_config: Optional[Dict[str, Any]] = None
         self.config_fetched_at: Optional[datetime] = None
+        self.config_cache_path: Optional[str] = self.CONFIG_CACHE_PATH or None
+        self._config_flight = SingleFlight()
+        self.enrich_concurrency = self.ENRICH_CONCURRENCY
+        self.enrich_deadline = self.ENRICH_DEADLINE_SECONDS
+        self.details_batch_size = self.DETAILS_BATCH_SIZE
+        self.bulk_concurrency = self.BULK_CONCURRENCY
+        self.bulk_deadline = self.BULK_DEADLINE_SECONDS
+        self.persisted_queries = self.PERSISTED_QUERIES
+        # GraphQL endpoints that answered a hash-only request with something other than a miss
+        self._persisted_unsupported: set = set()
+        # Which users-service alias queries the upstream schema accepts
+        self.capabilities = SchemaCapabilityCache.from_env()
+        # Probe locks per event loop; dropped with the loop they belong to
+        self._probe_locks: "weakref.WeakKeyDictionary[Any, Dict[Tuple[str, str], asyncio.Lock]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        # One pooled client per service instance (keep-alive, HTTP/2, per-host caps)
+        self.http = HTTPPool(pool_config, transport=transport)
+        # Retries for idempotent requests and a circuit breaker per upstream host
+        self.retry_policy = RetryPolicy.from_env()
+        self.breakers = BreakerRegistry.from_env()
+        self.retry_stats = {"retries": 0, "exhausted": 0}
+        # Token buckets smoothing our outbound rate (global and per caller token)
+        self.rate_limiter = RateLimiter.from_env()
+    
+    async def start(self) -> None:
+        """Open the shared HTTP client and warm the config cache (called on app startup)"""
+        await self.http.start()
+        if not self.endpoints_config and self._load_api_configuration():
+            logger.info("Loaded cached API configuration from %s", self.config_cache_path)
+    
+    async def close(self) -> None:
+        """Close the shared HTTP client (called on app shutdown)"""
+        await self.http.close()
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        """Connection pool usage counters"""
+        return self.http.stats()
+    
+    def resilience_stats(self) -> Dict[str, Any]:
+        """Circuit breaker state per upstream host plus retry counters"""
+        return {
+            "breakers": self.breakers.snapshot(),
+            "retry": {
+                "maxAttempts": self.retry_policy.max_attempts,
+                "baseDelaySeconds": self.retry_policy.base_delay,
+                "maxDelaySeconds": self.retry_policy.max_delay,
+                **self.retry_stats,
+            },
+        }
     
+    def rate_limit_stats(self) -> Dict[str, Any]:
+        """Outbound rate limiter queue depth, wait times and rejections"""
+        return self.rate_limiter.snapshot()
+    
+    @staticmethod
+    def _caller_key(headers: Optional[Dict[str, str]]) -> Optional[str]:
+        """Per-caller rate limit key: a hash of the bearer token, if any"""
+        authorization = (headers or {}).get("Authorization")
+        return token_fingerprint(authorization) if authorization else None
+    
+    async def _request(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """
+        Send an upstream request through the shared connection pool.
+        
+        Idempotent requests (GET) that hit a transport error or a 429/502/503/504
+        are retried with jittered exponential backoff. Transport errors and 5xx
+        responses count against the host's circuit breaker; while it is open the
+        request fails fast with a 503 HarviaAPIError instead of waiting out the
+        upstream timeout.
+        
+        Every attempt first takes a slot from the outbound rate limiter, waiting
+        briefly if needed; when the wait would be too long the request is
+        rejected with a 429 HarviaAPIError without reaching Harvia (and without
+        taking the breaker's half-open trial).
+        """
+        endpoint = httpx.URL(url).host
+        breaker = self.breakers.get(endpoint)
+        caller_key = self._caller_key(kwargs.get("headers"))
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                await self.rate_limiter.acquire(caller_key)
+            except RateLimitExceeded as e:
+                raise HarviaAPIError(f"Too many requests to Harvia API ({e.scope} limit), try again shortly", 429)
+            try:
+                trial = breaker.before_request()
+            except CircuitOpenError as e:
+                raise HarviaAPIError(
+                    f"Harvia API is unavailable ({endpoint}), retry in {e.retry_after:.0f}s",
+                    503
+                )
+            
+            try:
+                response = await self.http.request(method, url, **kwargs)
+            except httpx.TransportError:
+                breaker.record_failure()
+                if not self.retry_policy.should_retry(method, attempt):
+                    if attempt > 1:
+                        self.retry_stats["exhausted"] += 1
+                    raise
+            except BaseException:
+                # Cancelled (deadline, client disconnect) or failed locally:
+                # no verdict on the endpoint, but the trial slot must be freed
+                if trial:
+                    breaker.release_trial()
+                raise
+            else:
+                if response.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if (
+                    response.status_code not in RETRYABLE_STATUS_CODES
+                    or not self.retry_policy.should_retry(method, attempt)
+                ):
+                    if attempt > 1 and response.status_code in RETRYABLE_STATUS_CODES:
+                        self.retry_stats["exhausted"] += 1
+                    return response
+            
+            self.retry_stats["retries"] += 1
+            await asyncio.sleep(self.retry_policy.delay(attempt - 1))
+
+    async def _graphql(
+        self,
+        endpoint: str,
+        operation: GraphQLOperation,
+        variables: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> httpx.Response:
+        """
+        POST a registered GraphQL operation with its variables.
+
+        With persisted queries enabled only the document hash is sent at first;
+        on PersistedQueryNotFound (or an endpoint that does not understand
+        hash-only requests, which is then remembered) the full document follows.
+        """
+        headers = {"Content-Type": "application/json", **(kwargs.pop("headers", None) or {})}
+        if self.persisted_queries and endpoint not in self._persisted_unsupported:
+            response = await self._request(
+                "POST", endpoint, headers=headers, content=operation.body(variables, persisted=True), **kwargs
+            )
+            try:
+                result = response.json()
+            except ValueError:
+                result = None
+            if not is_persisted_query_miss(result):
+                if response.status_code == 200 and isinstance(result, dict) and "data" in result:
+                    return response
+                if response.status_code in (401, 403, 429) or response.status_code >= 500:
+                    return response
+                logger.info("GraphQL endpoint %s does not accept persisted queries", endpoint)
+                self._persisted_unsupported.add(endpoint)
+        return await self._request(
+            "POST", endpoint, headers=headers, content=operation.body(variables), **kwargs
+        )
+
     async def _get_api_configuration(self) -> Dict[str, Any]:
         """
         Fetch API configuration from Harvia endpoints.
         Caches the configuration for 1 hour to reduce unnecessary requests.
+        
+        Concurrent callers share a single in-flight fetch. Once the hour is up the
+        cached config keeps being served while one background fetch refreshes it,
+        and the last good config is persisted so a restart starts warm.
         """
-        # Return cached config if less than 1 hour old
-        if (
-            self.endpoints_config 
-            and self.config_fetched_at 
-            and datetime.now() - self.config_fetched_at < timedelta(hours=1)
-        ):
+        if self.endpoints_config:
+            # Return cached config if less than 1 hour old
+            if (
+                self.config_fetched_at
+                and datetime.now() - self.config_fetched_at < self.CONFIG_TTL
+            ):
+                return self.endpoints_config
+            # Stale: serve it and refresh in the background
+            if not self._config_flight.in_flight("endpoints"):
+                task = self._config_flight.start("endpoints", self._fetch_api_configuration)
+                task.add_done_callback(self._log_config_refresh)
             return self.endpoints_config
         
+        return await self._config_flight.do("endpoints", self._fetch_api_configuration)
+    
+    async def _fetch_api_configuration(self) -> Dict[str, Any]:
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(self.ENDPOINTS_URL)
-                response.raise_for_status()
-                
-                data = response.json()
-                self.endpoints_config = data.get("endpoints", {})
-                self.config_fetched_at = datetime.now()
-                
-                return self.endpoints_config
+            response = await self._request("GET", self.ENDPOINTS_URL)
+            response.raise_for_status()
+            
+            data = response.json()
+            self.endpoints_config = data.get("endpoints", {})
+            self.config_fetched_at = datetime.now()
+            self._save_api_configuration()
+            
+            return self.endpoints_config
         except httpx.HTTPError as e:
             raise HarviaAPIError(f"Failed to fetch API configuration: {str(e)}")
     
+    @staticmethod
+    def _log_config_refresh(task: asyncio.Future) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Background API configuration refresh failed, keeping stale config: %s", task.exception())
+    
+    def _load_api_configuration(self) -> bool:
+        """Warm the config cache from the persisted file; True if it was loaded"""
+        if not self.config_cache_path or not os.path.exists(self.config_cache_path):
+            return False
+        try:
+            with open(self.config_cache_path, "r", encoding="utf-8") as handle:
+                cached = json.load(handle)
+            if cached.get("source") != self.ENDPOINTS_URL or not cached.get("endpoints"):
+                return False
+            self.endpoints_config = cached["endpoints"]
+            self.config_fetched_at = datetime.fromisoformat(cached["fetchedAt"])
+            return True
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Could not load cached API configuration: %s", e)
+            return False
+    
+    def _save_api_configuration(self) -> None:
+        """Persist the last good config (temp file + rename, so readers never see half a file)"""
+        if not self.config_cache_path:
+            return
+        tmp_path = f"{self.config_cache_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as handle:
+                json.dump({
+                    "source": self.ENDPOINTS_URL,
+                    "fetchedAt": self.config_fetched_at.isoformat(),
+                    "endpoints": self.endpoints_config,
+                }, handle)
+            os.replace(tmp_path, self.config_cache_path)
+        except OSError as e:
+            logger.warning("Could not persist API configuration: %s", e)
+    
     async def authenticate(self, username: str, password: str) -> Dict[str, Any]:
         """
         Authenticate with Harvia API using username and password.
@@ -75,36 +331,36 @@ class HarviaAPIService:
                 raise HarviaAPIError("REST API endpoint not found in configuration")
             
             # Authenticate with Harvia API
-            print(f"🌐 DEBUG: Authenticating with Harvia API at: {rest_api_base}/auth/token")
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.post(
-                    f"{rest_api_base}/auth/token",
-                    headers={"Content-Type": "application/json"},
-                    json={"username": username, "password": password}
-                )
-                
-                print(f"📡 DEBUG: Harvia API response status: {response.status_code}")
-                print(f"📡 DEBUG: Harvia API response headers: {dict(response.headers)}")
-                
-                if response.status_code != 200:
-                    error_text = response.text
-                    print(f"❌ DEBUG: Harvia API error response body: {error_text[:500]}")
-                    try:
-                        error_data = response.json() if error_text else {}
-                        print(f"❌ DEBUG: Parsed error data: {error_data}")
-                        error_message = error_data.get("message") or error_data.get("error") or error_data.get("Message") or "Authentication failed"
-                    except Exception as parse_error:
-                        print(f"⚠️ DEBUG: Could not parse error JSON: {parse_error}")
-                        error_message = error_text[:200] if error_text else "Authentication failed"
-                    raise HarviaAPIError(error_message, response.status_code)
-                
-                tokens = response.json()
-                return {
-                    "idToken": tokens.get("idToken"),
-                    "accessToken": tokens.get("accessToken"),
-                    "refreshToken": tokens.get("refreshToken"),
-                    "expiresIn": tokens.get("expiresIn", 3600),
-                }
+            logger.debug("Authenticating with Harvia API at %s/auth/token", rest_api_base)
+            response = await self._request(
+                "POST",
+                f"{rest_api_base}/auth/token",
+                headers={"Content-Type": "application/json"},
+                json={"username": username, "password": password}
+            )
+            
+            logger.debug("Harvia auth response status: %d", response.status_code)
+            if trace_enabled(logger):
+                logger.debug("Harvia auth response headers", extra={"fields": {"headers": dict(response.headers)}})
+            
+            if response.status_code != 200:
+                error_text = response.text
+                logger.warning("Harvia auth failed with %d: %s", response.status_code, error_text[:500])
+                try:
+                    error_data = response.json() if error_text else {}
+                    error_message = error_data.get("message") or error_data.get("error") or error_data.get("Message") or "Authentication failed"
+                except Exception as parse_error:
+                    logger.debug("Could not parse auth error JSON: %s", parse_error)
+                    error_message = error_text[:200] if error_text else "Authentication failed"
+                raise HarviaAPIError(error_message, response.status_code)
+            
+            tokens = response.json()
+            return {
+                "idToken": tokens.get("idToken"),
+                "accessToken": tokens.get("accessToken"),
+                "refreshToken": tokens.get("refreshToken"),
+                "expiresIn": tokens.get("expiresIn", 3600),
+            }
         except httpx.HTTPError as e:
             raise HarviaAPIError(f"Authentication request failed: {str(e)}")
     
@@ -129,24 +385,24 @@ class HarviaAPIService:
             if not rest_api_base:
                 raise HarviaAPIError("REST API endpoint not found in configuration")
             
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.post(
-                    f"{rest_api_base}/auth/refresh",
-                    headers={"Content-Type": "application/json"},
-                    json={"refreshToken": refresh_token, "email": email}
-                )
-                
-                if response.status_code != 200:
-                    error_data = response.json() if response.text else {}
-                    error_message = error_data.get("message", "Token refresh failed")
-                    raise HarviaAPIError(error_message, response.status_code)
-                
-                tokens = response.json()
-                return {
-                    "idToken": tokens.get("idToken"),
-                    "accessToken": tokens.get("accessToken"),
-                    "expiresIn": tokens.get("expiresIn", 3600),
-                }
+            response = await self._request(
+                "POST",
+                f"{rest_api_base}/auth/refresh",
+                headers={"Content-Type": "application/json"},
+                json={"refreshToken": refresh_token, "email": email}
+            )
+            
+            if response.status_code != 200:
+                error_data = response.json() if response.text else {}
+                error_message = error_data.get("message", "Token refresh failed")
+                raise HarviaAPIError(error_message, response.status_code)
+            
+            tokens = response.json()
+            return {
+                "idToken": tokens.get("idToken"),
+                "accessToken": tokens.get("accessToken"),
+                "expiresIn": tokens.get("expiresIn", 3600),
+            }
         except httpx.HTTPError as e:
             raise HarviaAPIError(f"Token refresh request failed: {str(e)}")
     
@@ -170,207 +426,286 @@ class HarviaAPIService:
         
         # Try GraphQL first - usersDevicesList should work and has better data
         try:
-            print("🔍 DEBUG: Attempting GraphQL usersDevicesList query first...")
+            logger.debug("Listing devices with GraphQL usersDevicesList")
             return await self._get_devices_graphql_users(id_token, config)
         except HarviaAPIError as e:
-            print(f"⚠️ DEBUG: GraphQL failed: {e.message}, falling back to REST API...")
+            logger.warning("GraphQL device list failed, falling back to REST API: %s", e.message)
             # Fall back to REST API if GraphQL fails
             return await self._get_devices_rest(id_token, config)
     
+    async def stream_devices(self, id_token: str) -> DeviceStream:
+        """
+        Like `get_devices`, but returns once the device list is known and lets the
+        caller iterate devices as each one's enrichment finishes.
+        
+        Listing errors (auth, upstream failures) are raised here as HarviaAPIError,
+        before anything is yielded. With the REST fallback every device is ready at once.
+        """
+        config = await self._get_api_configuration()
+        try:
+            logger.debug("Listing devices with GraphQL usersDevicesList (streaming)")
+            return await self._open_graphql_device_stream(id_token, config)
+        except HarviaAPIError as e:
+            logger.warning("GraphQL device list failed, falling back to REST API: %s", e.message)
+            devices_data = await self._get_devices_rest(id_token, config)
+            if isinstance(devices_data, dict):
+                devices = devices_data.get("devices") or devices_data.get("data") or []
+            else:
+                devices = devices_data if isinstance(devices_data, list) else []
+            return DeviceStream(devices)
+    
     async def _get_devices_graphql_users(self, id_token: str, config: Dict[str, Any]) -> Dict[str, Any]:
         """
         Get devices using GraphQL: 
         1. First get list using usersDevicesList
-        2. Then query each device individually with devicesGet to get full details including display name
+        2. Then query devicesGet for all devices in batched, aliased documents
+           (`details_batch_size` devices per request) to get full details
+        3. Look up display-name aliases in the users service
+        
+        Steps 2 and 3 run concurrently (at most `enrich_concurrency` requests at a time);
+        a device's alias lookup starts as soon as its own batch is in. Devices not
+        fully enriched when `enrich_deadline` expires are returned with what was
+        fetched (at least their list summary) and reported in `timedOut`, with
+        `partial` set.
+        """
+        stream = await self._open_graphql_device_stream(id_token, config)
+        enriched: Dict[int, Dict[str, Any]] = {}
+        async for index, device_data in stream.items():
+            enriched[index] = device_data
+        enriched_devices = [enriched[index] for index in range(stream.count)]
+        
+        if stream.timed_out:
+            logger.warning("Enrichment deadline hit for %d devices, returning what was fetched", len(stream.timed_out))
+        logger.debug("Returning %d enriched devices", len(enriched_devices))
+        return {
+            "devices": enriched_devices,
+            "partial": stream.partial,
+            "timedOut": stream.timed_out,
+        }
+    
+    async def _open_graphql_device_stream(self, id_token: str, config: Dict[str, Any]) -> DeviceStream:
+        """
+        List devices with usersDevicesList and set up their enrichment (batched
+        devicesGet details, then users-service aliases) as a DeviceStream.
         """
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + self.enrich_deadline
         
         device_graphql_endpoint = config.get("GraphQL", {}).get("device", {}).get("https")
         
         if not device_graphql_endpoint:
             raise HarviaAPIError("GraphQL device endpoint not found in configuration")
         
-        print(f"🌐 DEBUG: Using GraphQL device endpoint: {device_graphql_endpoint}")
+        logger.debug("Using GraphQL device endpoint %s", device_graphql_endpoint)
         
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {id_token}",
-                "Accept": "application/json",
-            }
-            
-            # Step 1: Get list of devices using usersDevicesList
-            list_query = """
-            query ListMyDevices {
-              usersDevicesList {
-                devices {
-                  id
-                  type
-                  attr {
-                    key
-                    value
-                  }
-                  roles
-                  via
-                }
-                nextToken
-              }
-            }
-            """
-            
-            print(f"🔑 DEBUG: Step 1 - Sending usersDevicesList query...")
-            list_response = await client.post(
-                device_graphql_endpoint,
-                headers=headers,
-                json={"query": list_query}
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {id_token}",
+            "Accept": "application/json",
+        }
+        
+        # Step 1: Get list of devices using usersDevicesList
+        list_response = await self._graphql(
+            device_graphql_endpoint,
+            LIST_DEVICES,
+            headers=headers,
+            timeout=15.0
+        )
+        
+        logger.debug("usersDevicesList response status: %d", list_response.status_code)
+        
+        if list_response.status_code == 401:
+            error_text = list_response.text
+            logger.warning("usersDevicesList unauthorized: %s", error_text[:500])
+            raise HarviaAPIError(f"GraphQL Unauthorized (401) - Token may not have GraphQL access", 401)
+        elif list_response.status_code != 200:
+            error_text = list_response.text
+            logger.warning("usersDevicesList failed with %d: %s", list_response.status_code, error_text[:1000])
+            raise HarviaAPIError(f"GraphQL request failed: {list_response.status_code}", list_response.status_code)
+        
+        list_result = list_response.json()
+        
+        # Extract device IDs from list
+        if "data" in list_result and "usersDevicesList" in list_result["data"]:
+            device_list = list_result["data"]["usersDevicesList"].get("devices", [])
+            logger.debug("usersDevicesList returned %d devices", len(device_list))
+        elif "errors" in list_result:
+            error_msg = list_result["errors"][0].get("message", "Unknown GraphQL error")
+            logger.warning("usersDevicesList errors: %s", list_result["errors"])
+            raise HarviaAPIError(f"GraphQL error: {error_msg}")
+        else:
+            logger.warning("Unexpected usersDevicesList response structure: %.500s", list_result)
+            raise HarviaAPIError("Unexpected GraphQL response structure")
+        
+        # Step 2: Full details come from batched devicesGet documents (one aliased
+        # GraphQL document per chunk instead of one request per device), step 3 from
+        # the users service; both run as the stream is consumed, within a deadline
+        # for the whole listing.
+        users_graphql_endpoint = config.get("GraphQL", {}).get("users", {}).get("https")
+        
+        summaries = []
+        for device_summary in device_list:
+            if not device_summary.get("id"):
+                logger.debug("Skipping device without ID: %s", device_summary)
+                continue
+            summaries.append(device_summary)
+        
+        batch_size = max(1, self.details_batch_size)
+        logger.debug(
+            "Fetching details for %d devices in %d batched request(s)",
+            len(summaries), -(-len(summaries) // batch_size)
+        )
+        
+        async def fetch_details(chunk: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+            return await self._get_device_details_batch(chunk, headers, device_graphql_endpoint)
+        
+        # The display names like "HypeMen", "MiniSaunaFenx" might be stored as user preferences
+        async def lookup_alias(device_data: Dict[str, Any]) -> None:
+            await self._apply_users_alias(device_data, headers, users_graphql_endpoint)
+        
+        return DeviceStream(
+            summaries,
+            fetch_details=fetch_details,
+            lookup_alias=lookup_alias if users_graphql_endpoint else None,
+            batch_size=batch_size,
+            limit=self.enrich_concurrency,
+            deadline_at=deadline_at,
+        )
+    
+    async def _get_device_details_batch(
+        self,
+        device_summaries: List[Dict[str, Any]],
+        headers: Dict[str, str],
+        device_graphql_endpoint: str,
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Fetch full details for several devices in one GraphQL request.
+        
+        Each device gets an aliased field (`d0: devicesGet(deviceId: $d0)`, ...). Returns
+        details keyed by device ID; devices whose alias errored or resolved to null
+        are left out so the caller falls back to their summary.
+        """
+        device_response = await self._graphql(
+            device_graphql_endpoint,
+            devices_get_batch(len(device_summaries)),
+            {f"d{index}": device_summary["id"] for index, device_summary in enumerate(device_summaries)},
+            headers=headers,
+            timeout=15.0
+        )
+        
+        if device_response.status_code != 200:
+            raise HarviaAPIError(
+                f"Batched devicesGet failed: {device_response.status_code}",
+                device_response.status_code
             )
-            
-            print(f"📡 DEBUG: GraphQL list response status: {list_response.status_code}")
-            
-            if list_response.status_code == 401:
-                error_text = list_response.text
-                print(f"❌ DEBUG: GraphQL 401: {error_text[:500]}")
-                raise HarviaAPIError(f"GraphQL Unauthorized (401) - Token may not have GraphQL access", 401)
-            elif list_response.status_code != 200:
-                error_text = list_response.text
-                print(f"❌ DEBUG: GraphQL error response: {error_text[:1000]}")
-                raise HarviaAPIError(f"GraphQL request failed: {list_response.status_code}", list_response.status_code)
-            
-            list_result = list_response.json()
-            
-            # Extract device IDs from list
-            if "data" in list_result and "usersDevicesList" in list_result["data"]:
-                device_list = list_result["data"]["usersDevicesList"].get("devices", [])
-                print(f"✅ DEBUG: Found {len(device_list)} devices in list")
-            elif "errors" in list_result:
-                error_msg = list_result["errors"][0].get("message", "Unknown GraphQL error")
-                print(f"❌ DEBUG: GraphQL errors: {list_result['errors']}")
-                raise HarviaAPIError(f"GraphQL error: {error_msg}")
+        
+        device_result = device_response.json()
+        data = device_result.get("data") or {}
+        for error in device_result.get("errors") or []:
+            path = error.get("path") or ["?"]
+            logger.debug("devicesGet error for alias %s: %s", path[0], error.get("message"))
+        
+        details = {}
+        for index, device_summary in enumerate(device_summaries):
+            device_id = device_summary["id"]
+            device_data = data.get(f"d{index}")
+            if device_data:  # devicesGet can return None if unauthorized
+                details[device_id] = device_data
             else:
-                print(f"⚠️ DEBUG: Unexpected GraphQL response structure: {list_result}")
-                raise HarviaAPIError("Unexpected GraphQL response structure")
-            
-            # Step 2: Query each device individually to get full details including display name
-            # Also try to get device aliases/preferences from users service if available
-            users_graphql_endpoint = config.get("GraphQL", {}).get("users", {}).get("https")
-            enriched_devices = []
-            
-            for device_summary in device_list:
-                device_id = device_summary.get("id")
-                if not device_id:
-                    print(f"⚠️ DEBUG: Skipping device without ID: {device_summary}")
+                logger.debug("No details for %s (may be unauthorized), using summary", device_id)
+        logger.debug("Enriched %d/%d devices with full details", len(details), len(device_summaries))
+        return details
+    
+    async def _apply_users_alias(
+        self,
+        device_data: Dict[str, Any],
+        headers: Dict[str, str],
+        users_graphql_endpoint: str,
+    ) -> None:
+        """
+        Look up a device alias in the users service and set it as displayName.
+        
+        The users schema is not documented, so several query shapes are probed.
+        `self.capabilities` remembers which shapes the endpoint rejects (never sent
+        again) and which it accepts (tried first); the first accepted shape ends the
+        lookup, so each device costs at most one useful query.
+        """
+        device_id = device_data.get("id")
+        logger.debug("Checking users service for device alias: %s", device_id)
+        
+        probes = sorted(
+            (
+                probe for probe in USERS_ALIAS_PROBES
+                if not self.capabilities.is_rejected(users_graphql_endpoint, probe.name)
+            ),
+            key=lambda probe: not self.capabilities.is_supported(users_graphql_endpoint, probe.name),
+        )
+        
+        for probe in probes:
+            operation = probe.name
+            known = self.capabilities.is_supported(users_graphql_endpoint, operation)
+            # While a shape is unknown, let a single device probe it; the others wait
+            # for the verdict instead of all sending a query that may be rejected.
+            lock = None if known else self._probe_lock(users_graphql_endpoint, operation)
+            if lock is not None:
+                await lock.acquire()
+            try:
+                if self.capabilities.is_rejected(users_graphql_endpoint, operation):
                     continue
-                
-                print(f"🔍 DEBUG: Step 2 - Fetching full details for device: {device_id}")
-                
-                # Query individual device for full details
-                device_query = f"""
-                query GetDevice {{
-                  devicesGet(deviceId: "{device_id}") {{
-                    id
-                    type
-                    attr {{
-                      key
-                      value
-                    }}
-                    roles
-                    via
-                  }}
-                }}
-                """
-                
-                device_response = await client.post(
-                    device_graphql_endpoint,
+                users_response = await self._graphql(
+                    users_graphql_endpoint,
+                    probe,
+                    {"deviceId": device_id},
                     headers=headers,
-                    json={"query": device_query}
+                    timeout=5.0
                 )
+                try:
+                    users_result = users_response.json()
+                except ValueError:
+                    users_result = None
                 
-                device_data = None
-                if device_response.status_code == 200:
-                    device_result = device_response.json()
-                    if "data" in device_result and "devicesGet" in device_result["data"]:
-                        device_data = device_result["data"]["devicesGet"]
-                        if device_data:  # devicesGet can return None if unauthorized
-                            print(f"✅ DEBUG: Enriched device {device_id} with full details")
-                        else:
-                            print(f"⚠️ DEBUG: devicesGet returned None for {device_id} (may be unauthorized)")
-                            device_data = device_summary
-                    else:
-                        print(f"⚠️ DEBUG: Unexpected response for device {device_id}, using summary")
-                        device_data = device_summary
-                else:
-                    print(f"⚠️ DEBUG: Failed to get details for {device_id} (status {device_response.status_code}), using summary")
-                    device_data = device_summary
-                
-                # Step 3: Try to get device alias/display name from users service if available
-                # The display names like "HypeMen", "MiniSaunaFenx" might be stored as user preferences
-                if device_data and users_graphql_endpoint:
-                    try:
-                        print(f"🔍 DEBUG: Step 3 - Checking users service for device alias: {device_id}")
-                        # Try common queries for device preferences/aliases
-                        users_queries = [
-                            f"""
-                            query GetDeviceAlias {{
-                              deviceAlias(deviceId: "{device_id}")
-                            }}
-                            """,
-                            f"""
-                            query GetDevicePreference {{
-                              devicePreference(deviceId: "{device_id}") {{
-                                alias
-                                displayName
-                                name
-                              }}
-                            }}
-                            """,
-                            f"""
-                            query GetUserDevice {{
-                              userDevice(deviceId: "{device_id}") {{
-                                alias
-                                displayName
-                                name
-                              }}
-                            }}
-                            """
-                        ]
-                        
-                        for users_query in users_queries:
-                            try:
-                                users_response = await client.post(
-                                    users_graphql_endpoint,
-                                    headers=headers,
-                                    json={"query": users_query},
-                                    timeout=5.0
-                                )
-                                if users_response.status_code == 200:
-                                    users_result = users_response.json()
-                                    # Try to extract alias/displayName from response
-                                    if "data" in users_result:
-                                        for key, value in users_result["data"].items():
-                                            if value and isinstance(value, (str, dict)):
-                                                if isinstance(value, str) and value:
-                                                    # Direct string value (alias)
-                                                    if not device_data.get("displayName"):
-                                                        device_data["displayName"] = value
-                                                        print(f"✅ DEBUG: Found alias from users service: {value}")
-                                                        break
-                                                elif isinstance(value, dict):
-                                                    # Object with alias/displayName fields
-                                                    alias = value.get("alias") or value.get("displayName") or value.get("name")
-                                                    if alias and not device_data.get("displayName"):
-                                                        device_data["displayName"] = alias
-                                                        print(f"✅ DEBUG: Found alias from users service: {alias}")
-                                                        break
-                            except Exception as e:
-                                # Continue to next query if this one fails
-                                continue
-                    except Exception as e:
-                        print(f"⚠️ DEBUG: Could not query users service for alias: {e}")
+                if is_schema_rejection(users_response.status_code, users_result):
+                    self.capabilities.mark_rejected(users_graphql_endpoint, operation)
+                    continue
+                if users_response.status_code != 200:
+                    logger.debug("Users service returned %d for %s", users_response.status_code, operation)
+                    continue
                 
-                if device_data:
-                    enriched_devices.append(device_data)
-            
-            print(f"✅ DEBUG: Returning {len(enriched_devices)} enriched devices")
-            return {"devices": enriched_devices}
+                self.capabilities.mark_supported(users_graphql_endpoint, operation)
+                alias = self._extract_alias((users_result or {}).get("data"))
+                if alias and not device_data.get("displayName"):
+                    device_data["displayName"] = alias
+                    logger.debug("Found alias from users service: %s", alias)
+                return
+            except Exception as e:
+                # Continue to next query if this one fails
+                logger.debug("Could not query users service for alias (%s): %s", operation, e)
+                continue
+            finally:
+                if lock is not None:
+                    lock.release()
+    
+    def _probe_lock(self, endpoint: str, operation: str) -> asyncio.Lock:
+        locks = self._probe_locks.setdefault(asyncio.get_running_loop(), {})
+        lock = locks.get((endpoint, operation))
+        if lock is None:
+            lock = asyncio.Lock()
+            locks[(endpoint, operation)] = lock
+        return lock
+    
+    @staticmethod
+    def _extract_alias(data: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Pull an alias/displayName out of a users-service query result"""
+        for value in (data or {}).values():
+            if isinstance(value, str) and value:
+                # Direct string value (alias)
+                return value
+            if isinstance(value, dict):
+                # Object with alias/displayName fields
+                alias = value.get("alias") or value.get("displayName") or value.get("name")
+                if alias:
+                    return alias
+        return None
     
     async def _get_devices_graphql(self, id_token: str, config: Dict[str, Any]) -> Dict[str, Any]:
         """Get devices using GraphQL API - should have displayName and more complete data"""
@@ -385,9 +720,10 @@ class HarviaAPIService:
         if not graphql_endpoint:
             raise HarviaAPIError("GraphQL device endpoint not found in configuration")
         
-        print(f"🌐 DEBUG: Device GraphQL endpoint: {graphql_endpoint}")
-        print(f"🌐 DEBUG: Users GraphQL endpoint: {users_graphql_endpoint}")
-        print(f"📋 DEBUG: GraphQL schema URL: {schema_url}")
+        logger.debug(
+            "GraphQL endpoints: device=%s users=%s schema=%s",
+            graphql_endpoint, users_graphql_endpoint, schema_url
+        )
         
         # Try introspection query first to see what's available
         introspection_query = """
@@ -426,122 +762,119 @@ class HarviaAPIService:
         }
         """
         
-        print(f"🌐 DEBUG: Sending GraphQL query to: {graphql_endpoint}")
-        print(f"📝 DEBUG: Query: {query.strip()}")
         
         # First try introspection to see available queries
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            print(f"🔍 DEBUG: First attempting introspection query to see available queries...")
-            
-            # AWS AppSync might need additional headers
-            intro_headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {id_token}",
-                "Accept": "application/json",
-            }
-            
-            intro_response = await client.post(
-                graphql_endpoint,
-                headers=intro_headers,
-                json={"query": introspection_query}
-            )
-            
-            print(f"📡 DEBUG: Introspection response status: {intro_response.status_code}")
+        logger.debug("Sending introspection query to %s", graphql_endpoint)
+        
+        # AWS AppSync might need additional headers
+        intro_headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {id_token}",
+            "Accept": "application/json",
+        }
+        
+        intro_response = await self._request(
+            "POST",
+            graphql_endpoint,
+            headers=intro_headers,
+            json={"query": introspection_query},
+            timeout=15.0
+        )
+        
+        logger.debug("Introspection response status: %d", intro_response.status_code)
+        
+        if intro_response.status_code == 200:
+            intro_result = intro_response.json()
+            if "data" in intro_result and "__schema" in intro_result["data"]:
+                queries = intro_result["data"]["__schema"]["queryType"]["fields"]
+                logger.debug("Available queries: %s", [q["name"] for q in queries[:10]])
+        else:
+            error_text = intro_response.text
+            logger.debug("Introspection failed with %d: %s", intro_response.status_code, error_text[:500])
             
-            if intro_response.status_code == 200:
-                intro_result = intro_response.json()
-                print(f"✅ DEBUG: Introspection successful!")
-                if "data" in intro_result and "__schema" in intro_result["data"]:
-                    queries = intro_result["data"]["__schema"]["queryType"]["fields"]
-                    print(f"📋 DEBUG: Available queries: {[q['name'] for q in queries[:10]]}")
-            else:
-                error_text = intro_response.text
-                print(f"❌ DEBUG: Introspection failed with {intro_response.status_code}")
-                print(f"❌ DEBUG: Error: {error_text[:500]}")
-                
-                # Check if it's an introspection-disabled error vs auth error
-                if "introspection" in error_text.lower():
-                    print(f"💡 DEBUG: GraphQL introspection is disabled on this endpoint")
-                elif "401" in str(intro_response.status_code):
-                    print(f"💡 DEBUG: Authentication issue - token may not have GraphQL permissions")
-                    print(f"💡 DEBUG: Token type: JWT from Cognito")
-                    print(f"💡 DEBUG: Trying with different auth approaches...")
+            # Check if it's an introspection-disabled error vs auth error
+            if "introspection" in error_text.lower():
+                logger.debug("GraphQL introspection is disabled on this endpoint")
+            elif "401" in str(intro_response.status_code):
+                logger.debug("Introspection unauthorized - token may not have GraphQL permissions")
         
         # Now try the actual query with multiple auth approaches
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            # Try approach 1: Standard Bearer token (same as REST API)
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {id_token}",
-                "Accept": "application/json",
-            }
+        # Try approach 1: Standard Bearer token (same as REST API)
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {id_token}",
+            "Accept": "application/json",
+        }
+        
+        logger.debug("Sending listDevices query with Bearer token")
+        
+        response = await self._request(
+            "POST",
+            graphql_endpoint,
+            headers=headers,
+            json={"query": query},
+            timeout=15.0
+        )
+        
+        # If that fails, try the users GraphQL endpoint (display names might be there)
+        if response.status_code == 401 and users_graphql_endpoint:
+            logger.debug("Device endpoint returned 401, trying users GraphQL endpoint %s", users_graphql_endpoint)
             
-            print(f"🔑 DEBUG: Attempt 1 - Using Bearer token (same as working REST API)")
-            print(f"🔑 DEBUG: Token (first 30 chars): {id_token[:30]}...")
+            # Try a users-focused query
+            users_query = """
+            query GetUserDevices {
+              listUserDevices {
+                items {
+                  deviceId
+                  deviceName
+                  displayName
+                  alias
+                  name
+                }
+              }
+            }
+            """
             
-            response = await client.post(
-                graphql_endpoint,
+            response = await self._request(
+                "POST",
+                users_graphql_endpoint,
                 headers=headers,
-                json={"query": query}
+                json={"query": users_query},
+                timeout=15.0
             )
-            
-            # If that fails, try the users GraphQL endpoint (display names might be there)
-            if response.status_code == 401 and users_graphql_endpoint:
-                print(f"⚠️ DEBUG: Device endpoint returned 401, trying USERS GraphQL endpoint...")
-                print(f"🌐 DEBUG: Trying users endpoint: {users_graphql_endpoint}")
-                
-                # Try a users-focused query
-                users_query = """
-                query GetUserDevices {
-                  listUserDevices {
-                    items {
-                      deviceId
-                      deviceName
-                      displayName
-                      alias
-                      name
-                    }
-                  }
-                }
-                """
-                
-                response = await client.post(
-                    users_graphql_endpoint,
-                    headers=headers,
-                    json={"query": users_query}
-                )
-                print(f"📡 DEBUG: Users endpoint response status: {response.status_code}")
-            
-            print(f"📡 DEBUG: GraphQL response status: {response.status_code}")
-            print(f"📡 DEBUG: Response headers: {dict(response.headers)}")
-            
-            if response.status_code == 401:
-                error_text = response.text
-                print(f"❌ DEBUG: GraphQL 401 with Bearer prefix: {error_text[:500]}")
-                print(f"💡 DEBUG: This might be a permissions issue with the hackathon account")
-                print(f"💡 DEBUG: GraphQL endpoints may require elevated permissions not available in demo/hackathon tokens")
-                raise HarviaAPIError(f"GraphQL Unauthorized (401) - Hackathon account may not have GraphQL access")
-            elif response.status_code != 200:
-                error_text = response.text
-                print(f"❌ DEBUG: GraphQL error response: {error_text[:1000]}")
-                raise HarviaAPIError(f"GraphQL request failed: {response.status_code}")
-            
-            result = response.json()
-            print(f"✅ DEBUG: GraphQL response keys: {result.keys()}")
-            
-            # Extract devices from GraphQL response
-            if "data" in result and "listDevices" in result["data"]:
-                devices = result["data"]["listDevices"].get("items", [])
-                print(f"✅ DEBUG: Found {len(devices)} devices from GraphQL")
-                return {"devices": devices}
-            elif "errors" in result:
-                error_msg = result["errors"][0].get("message", "Unknown GraphQL error")
-                print(f"❌ DEBUG: GraphQL errors: {result['errors']}")
-                raise HarviaAPIError(f"GraphQL error: {error_msg}")
-            else:
-                print(f"⚠️ DEBUG: Unexpected GraphQL response structure: {result}")
-            
-            return {"devices": []}
+            logger.debug("Users endpoint response status: %d", response.status_code)
+        
+        logger.debug("GraphQL response status: %d", response.status_code)
+        if trace_enabled(logger):
+            logger.debug("GraphQL response headers", extra={"fields": {"headers": dict(response.headers)}})
+        
+        if response.status_code == 401:
+            error_text = response.text
+            logger.warning(
+                "GraphQL unauthorized; the account may lack GraphQL permissions: %s", error_text[:500]
+            )
+            raise HarviaAPIError(f"GraphQL Unauthorized (401) - Hackathon account may not have GraphQL access")
+        elif response.status_code != 200:
+            error_text = response.text
+            logger.warning("GraphQL request failed with %d: %s", response.status_code, error_text[:1000])
+            raise HarviaAPIError(f"GraphQL request failed: {response.status_code}")
+        
+        result = response.json()
+        logger.debug("GraphQL response keys: %s", list(result.keys()))
+        
+        # Extract devices from GraphQL response
+        if "data" in result and "listDevices" in result["data"]:
+            devices = result["data"]["listDevices"].get("items", [])
+            logger.debug("Found %d devices from GraphQL", len(devices))
+            return {"devices": devices}
+        elif "errors" in result:
+            error_msg = result["errors"][0].get("message", "Unknown GraphQL error")
+            logger.warning("GraphQL errors: %s", result["errors"])
+            raise HarviaAPIError(f"GraphQL error: {error_msg}")
+        else:
+            logger.warning("Unexpected GraphQL response structure: %.500s", result)
+        
+        return {"devices": []}
     
     async def _get_devices_rest(self, id_token: str, config: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -564,55 +897,56 @@ class HarviaAPIService:
             api_base = config.get("RestApi", {}).get(endpoint_key, {}).get("https")
             
             if not api_base:
-                print(f"⚠️ DEBUG: '{endpoint_key}' endpoint not found in config, skipping...")
+                logger.debug("%r endpoint not found in config, skipping", endpoint_key)
                 continue
             
             url = f"{api_base}{path}"
-            print(f"🌐 DEBUG: Trying REST API: {url}")
+            logger.debug("Trying REST API: %s", url)
             
             try:
-                async with httpx.AsyncClient(timeout=10.0) as client:
-                    # Add query parameters for pagination
-                    params = {"maxResults": 100}
-                    response = await client.get(
-                        url,
-                        params=params,
-                        headers={
-                            "Content-Type": "application/json",
-                            "Authorization": f"Bearer {id_token}"
-                        }
-                    )
-                    
-                    print(f"📡 DEBUG: Response status: {response.status_code}")
-                    print(f"📡 DEBUG: Response body: {response.text[:500]}")
-                    
-                    if response.status_code == 200:
-                        result = response.json()
-                        print(f"✅ DEBUG: Successfully fetched devices from {endpoint_key} endpoint!")
-                        # REST API might return devices with 'name' attribute in attr array
-                        # Check if any device has a name attribute
-                        devices = result.get("devices", [])
-                        if devices:
-                            for device in devices[:1]:  # Check first device
-                                attrs = device.get("attr", [])
-                                if attrs:
-                                    attr_dict = {item.get("key"): item.get("value") for item in attrs if item.get("key")}
-                                    if "name" in attr_dict:
-                                        print(f"✅ DEBUG: REST API has 'name' attributes! Found: {attr_dict.get('name')}")
-                        return result
-                    elif response.status_code in [401, 403]:
-                        error_data = response.json() if response.text else {}
-                        error_message = error_data.get("message", error_data.get("Message", f"HTTP {response.status_code}"))
-                        last_error = f"{endpoint_key}: {error_message}"
-                        print(f"⚠️ DEBUG: {last_error}")
-                        continue
-                    else:
-                        error_data = response.json() if response.text else {}
-                        error_message = error_data.get("message", error_data.get("Message", "Failed to fetch devices"))
-                        last_error = error_message
-                        continue
+                # Add query parameters for pagination
+                params = {"maxResults": 100}
+                response = await self._request(
+                    "GET",
+                    url,
+                    params=params,
+                    headers={
+                        "Content-Type": "application/json",
+                        "Authorization": f"Bearer {id_token}"
+                    }
+                )
+                
+                logger.debug("REST response status: %d", response.status_code)
+                if trace_enabled(logger):
+                    logger.debug("REST response body: %s", response.text[:500])
+                
+                if response.status_code == 200:
+                    result = response.json()
+                    logger.debug("Fetched devices from %s endpoint", endpoint_key)
+                    # REST API might return devices with 'name' attribute in attr array
+                    # Check if any device has a name attribute
+                    devices = result.get("devices", [])
+                    if devices:
+                        for device in devices[:1]:  # Check first device
+                            attrs = device.get("attr", [])
+                            if attrs:
+                                attr_dict = {item.get("key"): item.get("value") for item in attrs if item.get("key")}
+                                if "name" in attr_dict:
+                                    logger.debug("REST API has name attributes, e.g. %s", attr_dict.get("name"))
+                    return result
+                elif response.status_code in [401, 403]:
+                    error_data = response.json() if response.text else {}
+                    error_message = error_data.get("message", error_data.get("Message", f"HTTP {response.status_code}"))
+                    last_error = f"{endpoint_key}: {error_message}"
+                    logger.debug("REST endpoint refused: %s", last_error)
+                    continue
+                else:
+                    error_data = response.json() if response.text else {}
+                    error_message = error_data.get("message", error_data.get("Message", "Failed to fetch devices"))
+                    last_error = error_message
+                    continue
             except Exception as e:
-                print(f"❌ DEBUG: Exception calling {endpoint_key}: {str(e)}")
+                logger.warning("Exception calling %s REST endpoint: %s", endpoint_key, e)
                 last_error = str(e)
                 continue
         
@@ -645,25 +979,25 @@ class HarviaAPIService:
             if not device_api_base:
                 raise HarviaAPIError("Device API endpoint not found in configuration")
             
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(
-                    f"{device_api_base}/devices/state",
-                    params={"deviceId": device_id},
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {id_token}"
-                    }
-                )
-                
-                if response.status_code == 401:
-                    raise HarviaAPIError("Unauthorized - token may be expired", 401)
-                
-                if response.status_code != 200:
-                    error_data = response.json() if response.text else {}
-                    error_message = error_data.get("message", "Failed to fetch device state")
-                    raise HarviaAPIError(error_message, response.status_code)
-                
-                return response.json()
+            response = await self._request(
+                "GET",
+                f"{device_api_base}/devices/state",
+                params={"deviceId": device_id},
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {id_token}"
+                }
+            )
+            
+            if response.status_code == 401:
+                raise HarviaAPIError("Unauthorized - token may be expired", 401)
+            
+            if response.status_code != 200:
+                error_data = response.json() if response.text else {}
+                error_message = error_data.get("message", "Failed to fetch device state")
+                raise HarviaAPIError(error_message, response.status_code)
+            
+            return response.json()
         except httpx.HTTPError as e:
             raise HarviaAPIError(f"Device state request failed: {str(e)}")
     
@@ -688,28 +1022,62 @@ class HarviaAPIService:
             if not data_api_base:
                 raise HarviaAPIError("Data API endpoint not found in configuration")
             
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(
-                    f"{data_api_base}/data/latest-data",
-                    params={"deviceId": device_id},
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {id_token}"
-                    }
-                )
-                
-                if response.status_code == 401:
-                    raise HarviaAPIError("Unauthorized - token may be expired", 401)
-                
-                if response.status_code != 200:
-                    error_data = response.json() if response.text else {}
-                    error_message = error_data.get("message", "Failed to fetch telemetry data")
-                    raise HarviaAPIError(error_message, response.status_code)
-                
-                return response.json()
+            response = await self._request(
+                "GET",
+                f"{data_api_base}/data/latest-data",
+                params={"deviceId": device_id},
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {id_token}"
+                }
+            )
+            
+            if response.status_code == 401:
+                raise HarviaAPIError("Unauthorized - token may be expired", 401)
+            
+            if response.status_code != 200:
+                error_data = response.json() if response.text else {}
+                error_message = error_data.get("message", "Failed to fetch telemetry data")
+                raise HarviaAPIError(error_message, response.status_code)
+            
+            return response.json()
         except httpx.HTTPError as e:
             raise HarviaAPIError(f"Telemetry request failed: {str(e)}")
     
+    async def get_many(
+        self,
+        device_ids: List[str],
+        fetch: Callable[[str], Awaitable[Dict[str, Any]]],
+    ) -> List[Dict[str, Any]]:
+        """
+        Run a per-device read for many devices concurrently.
+        
+        At most `bulk_concurrency` reads run at once and the whole call is bounded
+        by `bulk_deadline`. One entry is returned per device, in input order:
+        `{"deviceId", "success": True, "data"}` or
+        `{"deviceId", "success": False, "error", "statusCode"}`.
+        
+        Args:
+            device_ids: Device identifiers
+            fetch: Coroutine function taking a device ID (e.g. a bound get_device_state)
+        """
+        outcome = await fan_out(device_ids, fetch, limit=self.bulk_concurrency, deadline=self.bulk_deadline)
+        
+        entries = []
+        for index, device_id in enumerate(device_ids):
+            if index in outcome.results:
+                entries.append({"deviceId": device_id, "success": True, "data": outcome.results[index]})
+                continue
+            error = outcome.errors.get(index)
+            if isinstance(error, HarviaAPIError):
+                message, status_code = error.message, error.status_code or 502
+            elif error is not None:
+                message, status_code = f"Upstream request failed: {error}", 502
+            else:
+                message, status_code = "Timed out waiting for Harvia API", 504
+            entries.append({"deviceId": device_id, "success": False, "error": message, "statusCode": status_code})
+        return entries
+    
     async def send_device_command(
         self, 
         id_token: str, 
@@ -746,25 +1114,25 @@ class HarviaAPIService:
             if parameters:
                 payload["parameters"] = parameters
             
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.post(
-                    f"{device_api_base}/devices/command",
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {id_token}"
-                    },
-                    json=payload
-                )
-                
-                if response.status_code == 401:
-                    raise HarviaAPIError("Unauthorized - token may be expired", 401)
-                
-                if response.status_code != 200:
-                    error_data = response.json() if response.text else {}
-                    error_message = error_data.get("message", "Failed to send command")
-                    raise HarviaAPIError(error_message, response.status_code)
-                
-                return response.json()
+            response = await self._request(
+                "POST",
+                f"{device_api_base}/devices/command",
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {id_token}"
+                },
+                json=payload
+            )
+            
+            if response.status_code == 401:
+                raise HarviaAPIError("Unauthorized - token may be expired", 401)
+            
+            if response.status_code != 200:
+                error_data = response.json() if response.text else {}
+                error_message = error_data.get("message", "Failed to send command")
+                raise HarviaAPIError(error_message, response.status_code)
+            
+            return response.json()
         except httpx.HTTPError as e:
             raise HarviaAPIError(f"Command request failed: {str(e)}")
     
@@ -793,48 +1161,30 @@ class HarviaAPIService:
                 raise HarviaAPIError("GraphQL device endpoint not found in configuration")
             
             # Use devicesUpdate mutation to set the "name" attribute
-            mutation = f"""
-            mutation UpdateDeviceName {{
-              devicesUpdate(
-                deviceId: "{device_id}"
-                attributes: [
-                  {{ key: "name", value: "{display_name}" }}
-                ]
-              ) {{
-                id
-                type
-                attr {{
-                  key
-                  value
-                }}
-              }}
-            }}
-            """
+            response = await self._graphql(
+                device_graphql_endpoint,
+                UPDATE_DEVICE_NAME,
+                {"deviceId": device_id, "attributes": [{"key": "name", "value": display_name}]},
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {id_token}"
+                }
+            )
             
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.post(
-                    device_graphql_endpoint,
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {id_token}"
-                    },
-                    json={"query": mutation}
-                )
-                
-                if response.status_code == 401:
-                    raise HarviaAPIError("Unauthorized - token may be expired", 401)
-                
-                if response.status_code != 200:
-                    error_data = response.json() if response.text else {}
-                    error_message = error_data.get("errors", [{}])[0].get("message", "Failed to update device name")
-                    raise HarviaAPIError(error_message, response.status_code)
-                
-                result = response.json()
-                if "errors" in result:
-                    error_msg = result["errors"][0].get("message", "Unknown GraphQL error")
-                    raise HarviaAPIError(f"GraphQL error: {error_msg}")
-                
-                return result.get("data", {}).get("devicesUpdate", {})
+            if response.status_code == 401:
+                raise HarviaAPIError("Unauthorized - token may be expired", 401)
+            
+            if response.status_code != 200:
+                error_data = response.json() if response.text else {}
+                error_message = error_data.get("errors", [{}])[0].get("message", "Failed to update device name")
+                raise HarviaAPIError(error_message, response.status_code)
+            
+            result = response.json()
+            if "errors" in result:
+                error_msg = result["errors"][0].get("message", "Unknown GraphQL error")
+                raise HarviaAPIError(f"GraphQL error: {error_msg}")
+            
+            return result.get("data", {}).get("devicesUpdate", {})
         except httpx.HTTPError as e:
             raise HarviaAPIError(f"Update device name request failed: {str(e)}")
     
@@ -873,25 +1223,25 @@ class HarviaAPIService:
             if humidity is not None:
                 payload["humidity"] = humidity
             
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.patch(
-                    f"{device_api_base}/devices/target",
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {id_token}"
-                    },
-                    json=payload
-                )
-                
-                if response.status_code == 401:
-                    raise HarviaAPIError("Unauthorized - token may be expired", 401)
-                
-                if response.status_code not in [200, 204]:
-                    error_data = response.json() if response.text else {}
-                    error_message = error_data.get("message", "Failed to set target")
-                    raise HarviaAPIError(error_message, response.status_code)
-                
-                return response.json() if response.text else {"success": True}
+            response = await self._request(
+                "PATCH",
+                f"{device_api_base}/devices/target",
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {id_token}"
+                },
+                json=payload
+            )
+            
+            if response.status_code == 401:
+                raise HarviaAPIError("Unauthorized - token may be expired", 401)
+            
+            if response.status_code not in [200, 204]:
+                error_data = response.json() if response.text else {}
+                error_message = error_data.get("message", "Failed to set target")
+                raise HarviaAPIError(error_message, response.status_code)
+            
+            return response.json() if response.text else {"success": True}
         except httpx.HTTPError as e:
             raise HarviaAPIError(f"Set target request failed: {str(e)}")
 
@@ -0,0 +1,291 @@
+"""
+HTTP Connection Pool
+Shared, lifecycle-managed httpx client used for all outbound Harvia traffic
+"""
+
+import asyncio
+import importlib.util
+import logging
+import os
+import time
+from typing import Dict, Any, Optional, Set
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+class HTTPPoolConfig:
+    """
+    Connection pool settings.
+
+    Every value can be overridden with a HARVIA_HTTP_* environment variable,
+    see `from_env`.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        max_connections_per_host: int = 20,
+        http2: bool = True,
+        timeout: float = 10.0,
+        connect_timeout: float = 5.0,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.max_connections_per_host = max_connections_per_host
+        self.http2 = http2
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+
+    @classmethod
+    def from_env(cls) -> "HTTPPoolConfig":
+        """Build a config from HARVIA_HTTP_* environment variables"""
+        return cls(
+            max_connections=_env_int("HARVIA_HTTP_MAX_CONNECTIONS", 100),
+            max_keepalive_connections=_env_int("HARVIA_HTTP_MAX_KEEPALIVE", 20),
+            keepalive_expiry=_env_float("HARVIA_HTTP_KEEPALIVE_EXPIRY", 30.0),
+            max_connections_per_host=_env_int("HARVIA_HTTP_MAX_PER_HOST", 20),
+            http2=_env_bool("HARVIA_HTTP2", True),
+            timeout=_env_float("HARVIA_HTTP_TIMEOUT", 10.0),
+            connect_timeout=_env_float("HARVIA_HTTP_CONNECT_TIMEOUT", 5.0),
+        )
+
+    @property
+    def http2_enabled(self) -> bool:
+        """HTTP/2 needs the optional `h2` package (installed via httpx[http2])"""
+        return self.http2 and importlib.util.find_spec("h2") is not None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "maxConnections": self.max_connections,
+            "maxKeepaliveConnections": self.max_keepalive_connections,
+            "keepaliveExpiry": self.keepalive_expiry,
+            "maxConnectionsPerHost": self.max_connections_per_host,
+            "http2": self.http2_enabled,
+            "timeout": self.timeout,
+            "connectTimeout": self.connect_timeout,
+        }
+
+
+class PoolMetrics:
+    """Counters describing how the shared pool is being used"""
+
+    def __init__(self):
+        self.clients_created = 0
+        self.requests_total = 0
+        self.errors_total = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.host_waits = 0
+        self.host_wait_seconds = 0.0
+        self.per_host: Dict[str, Dict[str, int]] = {}
+
+    def _host(self, host: str) -> Dict[str, int]:
+        if host not in self.per_host:
+            self.per_host[host] = {"requests": 0, "inFlight": 0, "errors": 0}
+        return self.per_host[host]
+
+    def request_started(self, host: str) -> None:
+        self.requests_total += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        host_stats = self._host(host)
+        host_stats["requests"] += 1
+        host_stats["inFlight"] += 1
+
+    def request_finished(self, host: str, failed: bool = False) -> None:
+        self.in_flight -= 1
+        host_stats = self._host(host)
+        host_stats["inFlight"] -= 1
+        if failed:
+            self.errors_total += 1
+            host_stats["errors"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "clientsCreated": self.clients_created,
+            "requestsTotal": self.requests_total,
+            "errorsTotal": self.errors_total,
+            "inFlight": self.in_flight,
+            "peakInFlight": self.peak_in_flight,
+            "hostSlotWaits": self.host_waits,
+            "hostSlotWaitSeconds": round(self.host_wait_seconds, 6),
+            "hosts": {host: dict(stats) for host, stats in self.per_host.items()},
+        }
+
+
+class HTTPPool:
+    """
+    Owns a single keep-alive httpx.AsyncClient.
+
+    The client is created by `start()` (called on app startup) and closed by
+    `close()` (called on shutdown). If a request arrives before `start()` or on
+    a different event loop (e.g. TestClient without a lifespan), a client is
+    created lazily for that loop and the previous client is closed.
+
+    httpx only caps the total number of connections, so concurrent requests
+    are additionally limited per host with a semaphore.
+    """
+
+    def __init__(
+        self,
+        config: Optional[HTTPPoolConfig] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.config = config or HTTPPoolConfig.from_env()
+        self.metrics = PoolMetrics()
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._retiring: Set[asyncio.Future] = set()
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(
+            max_connections=self.config.max_connections,
+            max_keepalive_connections=self.config.max_keepalive_connections,
+            keepalive_expiry=self.config.keepalive_expiry,
+        )
+        timeout = httpx.Timeout(self.config.timeout, connect=self.config.connect_timeout)
+        self.metrics.clients_created += 1
+        if self._transport is not None:
+            return httpx.AsyncClient(transport=self._transport, timeout=timeout)
+        return httpx.AsyncClient(
+            limits=limits,
+            timeout=timeout,
+            http2=self.config.http2_enabled,
+        )
+
+    async def start(self) -> None:
+        """Create the shared client for the running event loop"""
+        self._ensure_client()
+
+    async def close(self) -> None:
+        """Close the shared client and drop all pooled connections"""
+        client = self._client
+        self._client = None
+        self._loop = None
+        self._host_slots = {}
+        if client is not None:
+            await client.aclose()
+
+    @property
+    def is_started(self) -> bool:
+        return self._client is not None
+
+    def _ensure_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            # Connections belong to the loop that opened them, so a client
+            # from another (possibly closed) loop cannot be reused.
+            if self._client is not None:
+                self._retire(self._client, self._loop)
+            self._client = self._build_client()
+            self._loop = loop
+            self._host_slots = {}
+        return self._client
+
+    def _retire(self, client: httpx.AsyncClient, loop: Optional[asyncio.AbstractEventLoop]) -> None:
+        """Close a client left behind on another event loop, without waiting for it"""
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._close_quietly(client), loop)
+            return
+        # Its loop is gone: close what can still be closed from this one
+        task = asyncio.ensure_future(self._close_quietly(client))
+        self._retiring.add(task)
+        task.add_done_callback(self._retiring.discard)
+
+    @staticmethod
+    async def _close_quietly(client: httpx.AsyncClient) -> None:
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.debug("Closing a client from a previous event loop failed: %s", e)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self._ensure_client()
+
+    def _host_slot(self, host: str) -> asyncio.Semaphore:
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = asyncio.Semaphore(self.config.max_connections_per_host)
+            self._host_slots[host] = slot
+        return slot
+
+    async def request(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """Send a request through the shared client, respecting the per-host cap"""
+        client = self._ensure_client()
+        host = httpx.URL(url).host or "unknown"
+        slot = self._host_slot(host)
+
+        if slot.locked():
+            self.metrics.host_waits += 1
+            wait_started = time.perf_counter()
+            await slot.acquire()
+            self.metrics.host_wait_seconds += time.perf_counter() - wait_started
+        else:
+            await slot.acquire()
+
+        self.metrics.request_started(host)
+        failed = False
+        try:
+            return await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            failed = True
+            raise
+        finally:
+            self.metrics.request_finished(host, failed=failed)
+            slot.release()
+
+    def _connection_stats(self) -> Dict[str, Any]:
+        """
+        Open, idle and active connection counts.
+
+        httpx has no public API for its connection pool, so the counts are read
+        from httpcore's pool (its `connections` list and `is_idle()`) when it
+        has that shape. Otherwise (another httpx/httpcore release, or a custom
+        transport) only `active` is reported, counted from our own requests in
+        flight. `source` says which of the two the numbers come from.
+        """
+        try:
+            connections = list(self._client._transport._pool.connections)
+            idle = sum(1 for conn in connections if conn.is_idle())
+        except Exception:
+            return {"active": self.metrics.in_flight, "source": "requests"}
+        return {
+            "open": len(connections),
+            "idle": idle,
+            "active": len(connections) - idle,
+            "source": "pool",
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool configuration, usage counters and live connection counts"""
+        return {
+            "started": self.is_started,
+            "config": self.config.as_dict(),
+            "connections": self._connection_stats(),
+            **self.metrics.snapshot(),
+        }
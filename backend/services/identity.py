@@ -0,0 +1,16 @@
+"""
+Caller Identity Helpers
+Stable, non-reversible keys derived from caller credentials
+"""
+
+import hashlib
+
+
+def token_fingerprint(token: str) -> str:
+    """
+    SHA-256 hex digest of a bearer token.
+
+    Used to key per-caller caches and limits without keeping raw tokens around
+    in memory or in logs.
+    """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
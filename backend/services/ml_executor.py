@@ -0,0 +1,206 @@
+"""
+ML Executor
+Runs model training and bulk prediction on a bounded worker pool, off the event loop
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+
+class MLExecutorError(Exception):
+    """A job could not be run or finished"""
+
+
+class MLExecutorBusy(MLExecutorError):
+    """Every worker and queue slot is taken"""
+
+
+class MLJobTimeout(MLExecutorError):
+    """The job did not finish within its timeout"""
+
+
+class MLJobCancelled(MLExecutorError):
+    """The client disconnected before the job finished"""
+
+
+class MLExecutor:
+    """
+    Thread or process pool for CPU-bound ML work.
+
+    At most `max_workers` jobs run and `max_queue` more wait; further
+    submissions fail right away with MLExecutorBusy instead of piling up.
+    A job that exceeds `timeout_seconds`, or whose client disconnects, is
+    dropped if it has not started yet. A job that is already running cannot be
+    interrupted: its result is discarded ("abandoned") and it keeps its worker
+    until it returns, so saturation always reflects real pool occupancy.
+
+    `kind="process"` sidesteps the GIL but pickles arguments and results
+    (including fitted models) across processes; jobs must be module-level
+    functions.
+    """
+
+    def __init__(
+        self,
+        kind: str = "thread",
+        max_workers: int = 2,
+        max_queue: int = 8,
+        timeout_seconds: float = 30.0,
+        disconnect_poll_seconds: float = 0.25,
+    ):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown executor kind '{kind}' (expected 'thread' or 'process')")
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.timeout_seconds = timeout_seconds
+        self.disconnect_poll_seconds = disconnect_poll_seconds
+        self._pool: Optional[concurrent.futures.Executor] = None
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "timedOut": 0,
+            "cancelled": 0,
+            "abandoned": 0,
+        }
+
+    @classmethod
+    def from_env(cls) -> "MLExecutor":
+        return cls(
+            kind=os.getenv("ML_EXECUTOR", "thread").lower(),
+            max_workers=int(os.getenv("ML_EXECUTOR_WORKERS", "2")),
+            max_queue=int(os.getenv("ML_EXECUTOR_QUEUE", "8")),
+            timeout_seconds=float(os.getenv("ML_JOB_TIMEOUT", "30")),
+        )
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    def _executor(self) -> concurrent.futures.Executor:
+        with self._lock:
+            if self._pool is None:
+                if self.kind == "process":
+                    self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+                else:
+                    self._pool = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix="ml-worker"
+                    )
+            return self._pool
+
+    def _finished(self, future: concurrent.futures.Future) -> None:
+        # Runs in a pool thread (or the process pool's manager thread)
+        with self._lock:
+            self._inflight -= 1
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                self.stats["failed"] += 1
+            else:
+                self.stats["completed"] += 1
+
+    def _abandon(self, future: concurrent.futures.Future, job: asyncio.Future, reason: str) -> None:
+        started = not future.cancel()
+        job.cancel()
+        with self._lock:
+            self.stats[reason] += 1
+            if started and not future.done():
+                self.stats["abandoned"] += 1
+
+    async def _watch_disconnect(self, request: Request) -> None:
+        while not await request.is_disconnected():
+            await asyncio.sleep(self.disconnect_poll_seconds)
+
+    async def run(
+        self,
+        fn: Callable[..., Any],
+        *args: Any,
+        timeout: Optional[float] = None,
+        request: Optional[Request] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        Run `fn(*args, **kwargs)` on the pool and return its result (or raise
+        its exception). With `request`, the job is cancelled when that client
+        disconnects.
+        """
+        with self._lock:
+            if self._inflight >= self.capacity:
+                self.stats["rejected"] += 1
+                raise MLExecutorBusy(
+                    f"ML workers are busy ({self._inflight} jobs running or queued); retry shortly"
+                )
+            self._inflight += 1
+            self.stats["submitted"] += 1
+
+        try:
+            future = self._executor().submit(functools.partial(fn, *args, **kwargs))
+        except Exception:
+            with self._lock:
+                self._inflight -= 1
+            raise
+        future.add_done_callback(self._finished)
+
+        job = asyncio.wrap_future(future)
+        waiting = {job}
+        watcher = None
+        if request is not None:
+            watcher = asyncio.ensure_future(self._watch_disconnect(request))
+            waiting.add(watcher)
+
+        timeout = self.timeout_seconds if timeout is None else timeout
+        try:
+            done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            self._abandon(future, job, "cancelled")
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+
+        if job in done:
+            return job.result()
+        if not done:
+            self._abandon(future, job, "timedOut")
+            raise MLJobTimeout(f"ML job did not finish within {timeout:g}s")
+        self._abandon(future, job, "cancelled")
+        logger.info("Client disconnected; cancelled ML job %s", getattr(fn, "__name__", fn))
+        raise MLJobCancelled("Client disconnected")
+
+    def shutdown(self) -> None:
+        """Stop the pool without waiting for running jobs (called on app shutdown)"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            inflight = self._inflight
+            stats = dict(self.stats)
+        return {
+            "kind": self.kind,
+            "workers": self.max_workers,
+            "maxQueue": self.max_queue,
+            "timeoutSeconds": self.timeout_seconds,
+            "running": min(inflight, self.max_workers),
+            "queued": max(0, inflight - self.max_workers),
+            "saturation": round(inflight / self.capacity, 3),
+            **stats,
+        }
+
+
+# Global executor shared by the ML routes
+ml_executor = MLExecutor.from_env()
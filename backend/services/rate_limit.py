@@ -0,0 +1,166 @@
+"""
+Outbound Rate Limiter
+Token buckets (global and per caller token) for requests to the Harvia API
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request would have to wait longer than the limiter allows"""
+
+    def __init__(self, scope: str, wait: float):
+        self.scope = scope
+        self.wait = wait
+        super().__init__(f"Rate limit exceeded ({scope}), would wait {wait:.2f}s")
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens/second up to `burst`.
+
+    Callers reserve a token up front and may drive the balance negative; the
+    deficit is the time they (and everyone queued behind them) have to wait.
+    Reservations are granted in arrival order, so waiting is FIFO without any
+    loop-bound lock.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, now: float) -> float:
+        """Take one token and return how long the caller must wait for it"""
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self) -> None:
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class RateLimiter:
+    """
+    Global bucket plus one bucket per caller (keyed by token hash).
+
+    `acquire` waits up to `max_wait` seconds for both buckets; if either would
+    need longer the reservation is returned and RateLimitExceeded is raised.
+    A rate of 0 disables that bucket. Idle per-caller buckets are dropped once
+    more than `max_keys` are tracked.
+    """
+
+    def __init__(
+        self,
+        rate: float = 50.0,
+        burst: float = 100.0,
+        per_key_rate: float = 10.0,
+        per_key_burst: float = 40.0,
+        max_wait: float = 2.0,
+        max_keys: int = 10000,
+    ):
+        self.global_bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.per_key_rate = per_key_rate
+        self.per_key_burst = per_key_burst
+        self.max_wait = max_wait
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self.waiting = 0
+        self.stats = {
+            "admitted": 0,
+            "rejected": 0,
+            "delayed": 0,
+            "maxQueueDepth": 0,
+            "totalWaitSeconds": 0.0,
+            "longestWaitSeconds": 0.0,
+        }
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        return cls(
+            rate=float(os.getenv("HARVIA_RATE_LIMIT_RPS", "50")),
+            burst=float(os.getenv("HARVIA_RATE_LIMIT_BURST", "100")),
+            per_key_rate=float(os.getenv("HARVIA_TOKEN_RATE_LIMIT_RPS", "10")),
+            per_key_burst=float(os.getenv("HARVIA_TOKEN_RATE_LIMIT_BURST", "40")),
+            max_wait=float(os.getenv("HARVIA_RATE_LIMIT_MAX_WAIT", "2.0")),
+        )
+
+    def _bucket_for(self, key: str, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.per_key_rate, self.per_key_burst)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        for stale_key in [k for k, b in self._buckets.items() if b.is_idle(now)]:
+            del self._buckets[stale_key]
+
+    async def acquire(self, key: Optional[str] = None) -> float:
+        """Wait for a slot; returns the time waited in seconds"""
+        now = time.monotonic()
+        reserved = []
+        wait = 0.0
+        scopes = [("global", self.global_bucket)]
+        if key is not None and self.per_key_rate > 0:
+            scopes.append(("token", self._bucket_for(key, now)))
+
+        for scope, bucket in scopes:
+            if bucket is None:
+                continue
+            bucket_wait = bucket.reserve(now)
+            reserved.append(bucket)
+            if bucket_wait > self.max_wait:
+                for taken in reserved:
+                    taken.refund()
+                self.stats["rejected"] += 1
+                raise RateLimitExceeded(scope, bucket_wait)
+            wait = max(wait, bucket_wait)
+
+        self.stats["admitted"] += 1
+        if wait > 0:
+            self.stats["delayed"] += 1
+            self.stats["totalWaitSeconds"] += wait
+            self.stats["longestWaitSeconds"] = max(self.stats["longestWaitSeconds"], wait)
+            self.waiting += 1
+            self.stats["maxQueueDepth"] = max(self.stats["maxQueueDepth"], self.waiting)
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                for taken in reserved:
+                    taken.refund()
+                raise
+            finally:
+                self.waiting -= 1
+        return wait
+
+    def snapshot(self) -> Dict[str, Any]:
+        delayed = self.stats["delayed"]
+        return {
+            "globalRate": self.global_bucket.rate if self.global_bucket else None,
+            "globalBurst": self.global_bucket.burst if self.global_bucket else None,
+            "perTokenRate": self.per_key_rate or None,
+            "perTokenBurst": self.per_key_burst if self.per_key_rate else None,
+            "maxWaitSeconds": self.max_wait,
+            "queueDepth": self.waiting,
+            "trackedTokens": len(self._buckets),
+            "averageWaitSeconds": round(self.stats["totalWaitSeconds"] / delayed, 4) if delayed else 0.0,
+            **self.stats,
+        }
@@ -0,0 +1,168 @@
+"""
+Upstream Resilience
+Jittered retries for idempotent requests and per-endpoint circuit breakers
+"""
+
+import logging
+import os
+import random
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Methods that are safe to send more than once
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+# Upstream statuses worth retrying (throttled or transiently unavailable)
+RETRYABLE_STATUS_CODES = frozenset({429, 502, 503, 504})
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while an endpoint's breaker is open"""
+
+    def __init__(self, endpoint: str, retry_after: float):
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        super().__init__(f"Circuit open for {endpoint}, retry in {retry_after:.1f}s")
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: the delay before retry `n` (0-based)
+    is uniform in [0, min(max_delay, base_delay * 2**n)].
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        return cls(
+            max_attempts=int(os.getenv("HARVIA_RETRY_ATTEMPTS", "3")),
+            base_delay=float(os.getenv("HARVIA_RETRY_BASE_DELAY", "0.2")),
+            max_delay=float(os.getenv("HARVIA_RETRY_MAX_DELAY", "2.0")),
+        )
+
+    def should_retry(self, method: str, attempt: int) -> bool:
+        """`attempt` is the 1-based number of the attempt that just failed"""
+        return method.upper() in IDEMPOTENT_METHODS and attempt < self.max_attempts
+
+    def delay(self, retry: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry)))
+
+
+class CircuitBreaker:
+    """
+    Classic three-state breaker for one upstream endpoint.
+
+    - closed: requests flow; `failure_threshold` consecutive failures open it.
+    - open: requests fail fast with CircuitOpenError for `reset_timeout` seconds.
+    - half_open: a single trial request is let through; success closes the
+      breaker, failure opens it again. A trial that ends without a verdict
+      (cancelled, or failed before reaching upstream) is released with
+      `release_trial` so the next request can try.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, endpoint: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.endpoint = endpoint
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self.stats = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def before_request(self) -> bool:
+        """
+        Raise CircuitOpenError if the request must not be sent. Returns True if
+        this request is the half-open trial; its caller must then end it with
+        record_success, record_failure or release_trial.
+        """
+        if self.state == self.OPEN:
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(self.endpoint, remaining)
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(self.endpoint, 0.0)
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def release_trial(self) -> None:
+        """Give up the half-open trial without judging the endpoint"""
+        self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        self.stats["successes"] += 1
+        self.consecutive_failures = 0
+        self._trial_in_flight = False
+        if self.state != self.CLOSED:
+            logger.info("Circuit for %s closed", self.endpoint)
+        self.state = self.CLOSED
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.stats["failures"] += 1
+        self.consecutive_failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.stats["opened"] += 1
+                logger.warning(
+                    "Circuit for %s opened after %d consecutive failures",
+                    self.endpoint, self.consecutive_failures,
+                )
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        retry_after = None
+        if self.state == self.OPEN and self.opened_at is not None:
+            retry_after = round(max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 3)
+        return {
+            "state": self.state,
+            "consecutiveFailures": self.consecutive_failures,
+            "retryAfterSeconds": retry_after,
+            **self.stats,
+        }
+
+
+class BreakerRegistry:
+    """One CircuitBreaker per upstream endpoint, created on first use"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    @classmethod
+    def from_env(cls) -> "BreakerRegistry":
+        return cls(
+            failure_threshold=int(os.getenv("HARVIA_BREAKER_THRESHOLD", "5")),
+            reset_timeout=float(os.getenv("HARVIA_BREAKER_RESET", "30.0")),
+        )
+
+    def get(self, endpoint: str) -> CircuitBreaker:
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(endpoint, self.failure_threshold, self.reset_timeout)
+            self._breakers[endpoint] = breaker
+        return breaker
+
+    def reset(self) -> None:
+        self._breakers.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {endpoint: breaker.snapshot() for endpoint, breaker in self._breakers.items()}
@@ -0,0 +1,56 @@
+"""
+Session Data
+Columnar loading of sauna session metrics for the ML routes
+"""
+
+import itertools
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+import numpy as np
+from sqlmodel import Session, select
+
+from db_models import SaunaSession
+
+
+class SessionColumns(NamedTuple):
+    """One user's session metrics, one array element per session"""
+
+    duration_seconds: np.ndarray
+    average_temperature: np.ndarray
+
+    @property
+    def size(self) -> int:
+        """Number of sessions"""
+        return len(self.duration_seconds)
+
+
+def load_session_columns(
+    session: Session,
+    user_id: int,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: Optional[int] = None,
+) -> SessionColumns:
+    """
+    Duration and average temperature of a user's sessions as float64 arrays.
+
+    Only the two columns are selected and rows are read straight off the
+    result cursor into one array, so no ORM objects are built. `since`/`until`
+    bound `created_at` (inclusive/exclusive); with `limit` the most recent
+    sessions are kept.
+    """
+    statement = select(SaunaSession.duration_seconds, SaunaSession.average_temperature).where(
+        SaunaSession.user_id == user_id
+    )
+    if since is not None:
+        statement = statement.where(SaunaSession.created_at >= since)
+    if until is not None:
+        statement = statement.where(SaunaSession.created_at < until)
+    if limit is not None:
+        statement = statement.order_by(SaunaSession.created_at.desc(), SaunaSession.id.desc()).limit(limit)
+
+    result = session.connection().execute(statement)
+    values = np.fromiter(itertools.chain.from_iterable(result), dtype=np.float64)
+    values = values.reshape(-1, 2)
+    return SessionColumns(values[:, 0], values[:, 1])
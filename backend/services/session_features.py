@@ -0,0 +1,69 @@
+"""
+Session Features
+Vectorized features, category labels and summary statistics for sauna sessions
+"""
+
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from services.session_data import SessionColumns
+
+# Session categories used as KNN labels
+QUICK_COOL = 0
+BALANCED = 1
+LONG_HOT = 2
+
+CATEGORY_NAMES = {QUICK_COOL: "quick & efficient", BALANCED: "balanced", LONG_HOT: "extended & intense"}
+
+# Category thresholds (minutes, Celsius)
+SHORT_MINUTES = 30
+LONG_MINUTES = 60
+COOL_TEMPERATURE = 75
+HOT_TEMPERATURE = 85
+
+
+class SessionSummary(NamedTuple):
+    sessions: int
+    mean_duration_minutes: float
+    mean_temperature: float
+
+
+def feature_matrix(columns: SessionColumns) -> np.ndarray:
+    """(n, 2) float64 matrix of [duration in minutes, average temperature]"""
+    features = np.empty((columns.size, 2), dtype=np.float64)
+    np.divide(columns.duration_seconds, 60, out=features[:, 0])
+    features[:, 1] = columns.average_temperature
+    return features
+
+
+def categorize(features: np.ndarray) -> np.ndarray:
+    """
+    Category of each session: quick/cool if it is short or cool, otherwise
+    long/hot if it is long or hot, otherwise balanced
+    """
+    minutes = features[:, 0]
+    temperature = features[:, 1]
+    labels = np.full(len(features), BALANCED, dtype=np.int64)
+    labels[(minutes > LONG_MINUTES) | (temperature > HOT_TEMPERATURE)] = LONG_HOT
+    labels[(minutes < SHORT_MINUTES) | (temperature < COOL_TEMPERATURE)] = QUICK_COOL
+    return labels
+
+
+def mode(values: np.ndarray) -> int:
+    """Most frequent value; ties go to the smallest"""
+    values = np.asarray(values)
+    if values.dtype.kind in "iub" and len(values) and values.min() >= 0:
+        return int(np.bincount(values).argmax())
+    unique, counts = np.unique(values, return_counts=True)
+    return unique[counts.argmax()].item()
+
+
+def summarize(features: np.ndarray, mask: Optional[np.ndarray] = None) -> SessionSummary:
+    """Count and mean duration/temperature, over the rows selected by `mask` if given"""
+    if mask is not None:
+        features = features[mask]
+    if len(features) == 0:
+        return SessionSummary(0, 0.0, 0.0)
+    means = features.mean(axis=0)
+    return SessionSummary(len(features), float(means[0]), float(means[1]))
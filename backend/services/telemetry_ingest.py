@@ -0,0 +1,349 @@
+"""
+Telemetry Ingest
+Batched telemetry pushes from gateways and simulators: bulk validation, a
+latest-value table and batched writes to the database
+"""
+
+import asyncio
+import collections
+import hmac
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
+from sqlalchemy import insert
+
+from database import engine as database_engine
+from db_models import TelemetrySample
+
+logger = logging.getLogger(__name__)
+
+# Per-sample errors returned to the pusher; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+# Sample fields copied into the latest reading (same keys as DeviceReading)
+READING_FIELDS = ("temperature", "humidity", "heating", "targetTemp")
+EMPTY_READING = {"temperature": None, "humidity": None, "timestamp": None, "heating": None, "targetTemp": None}
+
+
+class PushedSample(BaseModel):
+    """One reading in a telemetry push; unknown keys are ignored"""
+
+    model_config = ConfigDict(extra="ignore")
+
+    deviceId: str = Field(..., min_length=1, max_length=255)
+    timestamp: Optional[datetime] = Field(None, description="Time of the reading; defaults to receipt time")
+    temperature: Optional[float] = Field(None, ge=-50, le=200)
+    humidity: Optional[float] = Field(None, ge=0, le=100)
+    targetTemp: Optional[float] = Field(None, ge=0, le=150)
+    heating: Optional[bool] = None
+
+
+_samples_adapter = TypeAdapter(List[PushedSample])
+
+
+def _as_utc(value: datetime) -> datetime:
+    """Naive timestamps are taken to be UTC"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _seed_reading(base: Dict[str, Any]) -> Dict[str, Any]:
+    """A latest-table entry started from a reading the device already has"""
+    reading = {key: base.get(key) for key in EMPTY_READING}
+    timestamp = reading["timestamp"]
+    reading["timestamp"] = _as_utc(timestamp) if isinstance(timestamp, datetime) else None
+    return reading
+
+
+def validate_samples(raw: List[Any]) -> "tuple[List[tuple[int, PushedSample]], List[Dict[str, Any]]]":
+    """
+    Validate a whole push in one pass. Returns the valid samples with their
+    index in the push, and one error entry per invalid sample; a bad sample
+    does not reject the rest.
+    """
+    try:
+        return list(enumerate(_samples_adapter.validate_python(raw))), []
+    except ValidationError as e:
+        problems: Dict[int, List[str]] = {}
+        for error in e.errors(include_url=False):
+            loc = error.get("loc") or ()
+            if not loc or not isinstance(loc[0], int):
+                raise
+            field = ".".join(str(part) for part in loc[1:])
+            problems.setdefault(loc[0], []).append(f"{field}: {error['msg']}" if field else error["msg"])
+
+    good = [index for index in range(len(raw)) if index not in problems]
+    samples = _samples_adapter.validate_python([raw[index] for index in good])
+    errors = [{"index": index, "error": "; ".join(messages)} for index, messages in sorted(problems.items())]
+    return list(zip(good, samples)), errors
+
+
+class TelemetryIngestor:
+    """
+    Accepts pushed telemetry for many devices at once.
+
+    Each accepted sample updates `latest`, a per-device table of the newest
+    reading (fields missing from a sample keep their previous value; samples
+    older than the stored reading do not replace it), and is queued for the
+    `telemetry_samples` table. A background task writes the queue every
+    `flush_interval_seconds`, or as soon as `batch_size` rows are waiting, in
+    transactions of at most `batch_size` rows run on a worker thread.
+
+    While the database is unavailable rows stay queued (at most `max_pending`,
+    oldest dropped first) and writes are retried with exponential backoff.
+
+    Pushes need `ingest_key` unless `allow_open` is set. `latest` holds at most
+    `max_devices` devices; samples for further devices are rejected.
+    """
+
+    def __init__(
+        self,
+        engine: Any = None,
+        batch_size: int = 500,
+        flush_interval_seconds: float = 1.0,
+        max_pending: int = 50000,
+        max_samples_per_push: int = 5000,
+        ingest_key: str = "",
+        allow_open: bool = False,
+        max_devices: int = 10000,
+        max_backoff_seconds: float = 60.0,
+    ):
+        self.engine = engine
+        self.batch_size = max(1, batch_size)
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending = max_pending
+        self.max_samples_per_push = max_samples_per_push
+        self.ingest_key = ingest_key
+        self.allow_open = allow_open
+        self.max_devices = max_devices
+        self.max_backoff_seconds = max_backoff_seconds
+        self.latest: Dict[str, Dict[str, Any]] = {}
+        self._pending: Deque[Dict[str, Any]] = collections.deque()
+        self._flusher: Optional[asyncio.Future] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flushing = False
+        self._stopping = False
+        self._backoff = 0.0
+        self.last_error: Optional[str] = None
+        self.stats = {
+            "pushes": 0,
+            "accepted": 0,
+            "rejected": 0,
+            "stale": 0,
+            "overDeviceLimit": 0,
+            "written": 0,
+            "flushes": 0,
+            "writeErrors": 0,
+            "dropped": 0,
+        }
+
+    @classmethod
+    def from_env(cls, engine: Any = None) -> "TelemetryIngestor":
+        if os.getenv("TELEMETRY_INGEST_PERSIST", "true").lower() in ("0", "false", "no"):
+            engine = None
+        return cls(
+            engine=engine,
+            batch_size=int(os.getenv("TELEMETRY_INGEST_BATCH_SIZE", "500")),
+            flush_interval_seconds=float(os.getenv("TELEMETRY_INGEST_FLUSH_INTERVAL", "1.0")),
+            max_pending=int(os.getenv("TELEMETRY_INGEST_MAX_PENDING", "50000")),
+            max_samples_per_push=int(os.getenv("TELEMETRY_INGEST_MAX_SAMPLES", "5000")),
+            ingest_key=os.getenv("TELEMETRY_INGEST_KEY", ""),
+            allow_open=os.getenv("TELEMETRY_INGEST_OPEN", "false").lower() in ("1", "true", "yes"),
+            max_devices=int(os.getenv("TELEMETRY_INGEST_MAX_DEVICES", "10000")),
+        )
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def enabled(self) -> bool:
+        """Pushes are accepted only with a key configured, or when explicitly open"""
+        return bool(self.ingest_key) or self.allow_open
+
+    def authorize(self, key: Optional[str]) -> bool:
+        """True if `key` matches, or no key is configured and pushes are explicitly open"""
+        if not self.ingest_key:
+            return self.allow_open
+        return key is not None and hmac.compare_digest(key.encode("utf-8"), self.ingest_key.encode("utf-8"))
+
+    def ingest(
+        self,
+        raw: List[Any],
+        seed: Optional[Callable[[str], Optional[Dict[str, Any]]]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Validate and apply one push. Returns accepted/rejected counts, the
+        per-sample errors (first MAX_REPORTED_ERRORS) and `updated`, the new
+        latest reading of every device whose reading changed. Samples for a new
+        device are rejected once `max_devices` devices are tracked.
+
+        `seed` returns the reading a device already has elsewhere (or None);
+        a device's first pushed sample is merged into it, so fields the sample
+        leaves out keep that value.
+        """
+        received = datetime.now(timezone.utc)
+        samples, errors = validate_samples(raw)
+        updated: Dict[str, Dict[str, Any]] = {}
+        received_at = received.replace(tzinfo=None)
+
+        accepted = 0
+        over_limit = 0
+        for index, sample in samples:
+            if sample.deviceId not in self.latest and len(self.latest) >= self.max_devices:
+                over_limit += 1
+                errors.append({"index": index, "error": f"deviceId: at most {self.max_devices} devices are tracked"})
+                continue
+            accepted += 1
+            recorded = _as_utc(sample.timestamp) if sample.timestamp is not None else received
+            self._queue_row({
+                "device_id": sample.deviceId,
+                "recorded_at": recorded.replace(tzinfo=None),
+                "temperature": sample.temperature,
+                "humidity": sample.humidity,
+                "target_temp": sample.targetTemp,
+                "heating": sample.heating,
+                "received_at": received_at,
+            })
+
+            current = self.latest.get(sample.deviceId)
+            if current is None and seed is not None:
+                base = seed(sample.deviceId)
+                current = _seed_reading(base) if base else None
+            if current is not None and current["timestamp"] is not None and current["timestamp"] > recorded:
+                self.stats["stale"] += 1
+                continue
+            reading = dict(current if current is not None else EMPTY_READING)
+            for field in READING_FIELDS:
+                value = getattr(sample, field)
+                if value is not None:
+                    reading[field] = value
+            reading["timestamp"] = recorded
+            self.latest[sample.deviceId] = reading
+            updated[sample.deviceId] = reading
+
+        if over_limit:
+            errors.sort(key=lambda error: error["index"])
+        self.stats["pushes"] += 1
+        self.stats["accepted"] += accepted
+        self.stats["rejected"] += len(errors)
+        self.stats["overDeviceLimit"] += over_limit
+        if accepted:
+            self._ensure_flusher()
+
+        return {
+            "accepted": accepted,
+            "rejected": len(errors),
+            "errors": errors[:MAX_REPORTED_ERRORS],
+            "updated": updated,
+        }
+
+    def update_reading(self, device_id: str, fields: Dict[str, Any]) -> None:
+        """Apply a change made outside a push (e.g. a new target) to a device's latest reading"""
+        reading = self.latest.get(device_id)
+        if reading is None:
+            return
+        for field in READING_FIELDS:
+            if field in fields:
+                reading[field] = fields[field]
+
+    def _queue_row(self, row: Dict[str, Any]) -> None:
+        if self.engine is None:
+            return
+        self._pending.append(row)
+        if len(self._pending) > self.max_pending:
+            self._pending.popleft()
+            self.stats["dropped"] += 1
+
+    def _ensure_flusher(self) -> None:
+        if self.engine is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # No loop (e.g. a script): rows wait for an explicit flush()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.ensure_future(self._run())
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        wakeup = self._wakeup
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(wakeup.wait(), self.flush_interval_seconds + self._backoff)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            await self.flush()
+
+    def _write_batch(self, rows: List[Dict[str, Any]]) -> None:
+        # One transaction and one executemany per batch
+        with self.engine.begin() as connection:
+            connection.execute(insert(TelemetrySample.__table__), rows)
+
+    async def flush(self) -> int:
+        """Write queued rows in batches; returns how many were written"""
+        if self.engine is None or self._flushing:
+            return 0
+        self._flushing = True
+        written = 0
+        try:
+            while self._pending:
+                count = min(self.batch_size, len(self._pending))
+                rows = [self._pending.popleft() for _ in range(count)]
+                try:
+                    await asyncio.to_thread(self._write_batch, rows)
+                except Exception as e:
+                    # Put the batch back in front and retry later
+                    self._pending.extendleft(reversed(rows))
+                    while len(self._pending) > self.max_pending:
+                        self._pending.popleft()
+                        self.stats["dropped"] += 1
+                    self.stats["writeErrors"] += 1
+                    self.last_error = str(e)
+                    self._backoff = min(max(self._backoff * 2, self.flush_interval_seconds), self.max_backoff_seconds)
+                    logger.warning("Telemetry batch write failed (%d rows queued): %s", len(self._pending), e)
+                    break
+                written += count
+                self.stats["written"] += count
+                self.stats["flushes"] += 1
+                self._backoff = 0.0
+                self.last_error = None
+        finally:
+            self._flushing = False
+        return written
+
+    async def close(self) -> None:
+        """Stop the background writer and write what is queued (called on app shutdown)"""
+        flusher = self._flusher
+        if flusher is not None and not flusher.done() and flusher.get_loop() is asyncio.get_running_loop():
+            # Let a batch that is being written finish rather than cancel it mid-transaction
+            self._stopping = True
+            self._wakeup.set()
+            await asyncio.gather(flusher, return_exceptions=True)
+        self._flusher = None
+        self._stopping = False
+        await self.flush()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "persist": self.engine is not None,
+            "batchSize": self.batch_size,
+            "flushIntervalSeconds": self.flush_interval_seconds,
+            "devices": len(self.latest),
+            "maxDevices": self.max_devices,
+            "pending": len(self._pending),
+            "backoffSeconds": self._backoff,
+            "lastError": self.last_error,
+            **self.stats,
+        }
+
+
+# Global ingestor shared by the /api/v1 telemetry and reading routes
+telemetry_ingestor = TelemetryIngestor.from_env(database_engine)
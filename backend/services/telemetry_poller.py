@@ -0,0 +1,213 @@
+"""
+Telemetry Poller
+Shared background polling of Harvia telemetry with fan-out to many viewers
+"""
+
+import asyncio
+import logging
+import os
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from services.harvia_api import harvia_service
+from services.identity import token_fingerprint
+
+logger = logging.getLogger(__name__)
+
+TelemetryFetch = Callable[[str, str], Awaitable[Dict[str, Any]]]
+
+
+class _DeviceWatch:
+    """Polling state and subscribers for one device"""
+
+    def __init__(self, device_id: str, token: str):
+        self.device_id = device_id
+        self.token = token
+        # Token fingerprint -> loop time until which it may read shared samples
+        self.authorized: Dict[str, float] = {}
+        self.latest: Optional[Dict[str, Any]] = None
+        self.latest_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.lease_until = 0.0
+        # Stream queue -> fingerprint of the token it subscribed with
+        self.subscribers: Dict[asyncio.Queue, str] = {}
+        self.task: Optional[asyncio.Future] = None
+
+    def publish(self, sample: Dict[str, Any], at: float) -> None:
+        self.latest = sample
+        self.latest_at = at
+        self.last_error = None
+        for queue in self.subscribers:
+            # Slow viewers only ever need the newest sample
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(sample)
+
+
+class TelemetryPoller:
+    """
+    Polls each watched device once per `interval_seconds` and shares the
+    latest sample with every viewer, so upstream load scales with the number
+    of devices rather than the number of viewers.
+
+    A device is watched while it has stream subscribers, or for
+    `lease_seconds` after the last `get_latest` call (HTTP polling clients do
+    not hold a connection open). Polling stops once nobody is watching.
+
+    Each token is checked against the device with its own upstream fetch
+    before it is served shared samples, and again every `auth_ttl_seconds`
+    (streams included), so viewers never see data for a device their
+    credentials cannot read, and an expired or revoked token stops being
+    served within that time. A stream's check is dropped when it unsubscribes.
+    """
+
+    def __init__(
+        self,
+        fetch: TelemetryFetch,
+        interval_seconds: float = 1.0,
+        lease_seconds: float = 15.0,
+        auth_ttl_seconds: float = 60.0,
+    ):
+        self._fetch = fetch
+        self.interval_seconds = interval_seconds
+        self.lease_seconds = lease_seconds
+        self.auth_ttl_seconds = auth_ttl_seconds
+        self._watches: Dict[str, _DeviceWatch] = {}
+        self.stats = {"upstreamFetches": 0, "sharedReads": 0, "pollErrors": 0}
+
+    @classmethod
+    def from_env(cls, fetch: TelemetryFetch) -> "TelemetryPoller":
+        return cls(
+            fetch,
+            interval_seconds=float(os.getenv("HARVIA_TELEMETRY_POLL_INTERVAL", "1.0")),
+            lease_seconds=float(os.getenv("HARVIA_TELEMETRY_LEASE", "15.0")),
+            auth_ttl_seconds=float(os.getenv("HARVIA_TELEMETRY_AUTH_TTL", "60.0")),
+        )
+
+    @property
+    def max_age_seconds(self) -> float:
+        """Samples older than this are not served (the poller is failing or stalled)"""
+        return self.interval_seconds * 5
+
+    async def _fetch_direct(self, watch: _DeviceWatch, token: str) -> Dict[str, Any]:
+        self.stats["upstreamFetches"] += 1
+        sample = await self._fetch(token, watch.device_id)
+        now = asyncio.get_running_loop().time()
+        # Lapsed checks are dropped here, so the table only holds recent viewers
+        for lapsed in [key for key, until in watch.authorized.items() if until <= now]:
+            del watch.authorized[lapsed]
+        watch.authorized[token_fingerprint(token)] = now + self.auth_ttl_seconds
+        watch.publish(sample, now)
+        return sample
+
+    def _is_authorized(self, watch: _DeviceWatch, token: str) -> bool:
+        until = watch.authorized.get(token_fingerprint(token))
+        return until is not None and asyncio.get_running_loop().time() < until
+
+    def _watch(self, device_id: str, token: str) -> _DeviceWatch:
+        watch = self._watches.get(device_id)
+        if watch is None:
+            watch = _DeviceWatch(device_id, token)
+            self._watches[device_id] = watch
+        return watch
+
+    def _ensure_polling(self, watch: _DeviceWatch, token: str) -> None:
+        loop = asyncio.get_running_loop()
+        # Poll with the most recent viewer's token; it is the least likely to expire
+        watch.token = token
+        if watch.task is None or watch.task.done() or watch.task.get_loop() is not loop:
+            watch.task = asyncio.ensure_future(self._poll(watch))
+
+    async def _poll(self, watch: _DeviceWatch) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await asyncio.sleep(self.interval_seconds)
+                if not watch.subscribers and loop.time() >= watch.lease_until:
+                    break
+                try:
+                    self.stats["upstreamFetches"] += 1
+                    sample = await self._fetch(watch.token, watch.device_id)
+                    watch.publish(sample, loop.time())
+                except Exception as e:
+                    self.stats["pollErrors"] += 1
+                    watch.last_error = str(e)
+                    logger.warning("Telemetry poll failed for %s: %s", watch.device_id, e)
+        finally:
+            if self._watches.get(watch.device_id) is watch and watch.task is asyncio.current_task():
+                del self._watches[watch.device_id]
+
+    def _is_fresh(self, watch: _DeviceWatch) -> bool:
+        return (
+            watch.latest is not None
+            and watch.latest_at is not None
+            and asyncio.get_running_loop().time() - watch.latest_at <= self.max_age_seconds
+        )
+
+    async def get_latest(self, token: str, device_id: str) -> Dict[str, Any]:
+        """
+        Latest telemetry sample for a device, renewing the caller's watch lease.
+
+        Raises whatever `fetch` raises (e.g. HarviaAPIError) when the caller's
+        own token has to be used and the upstream call fails.
+        """
+        loop = asyncio.get_running_loop()
+        watch = self._watch(device_id, token)
+        watch.lease_until = loop.time() + self.lease_seconds
+
+        if not self._is_authorized(watch, token) or not self._is_fresh(watch):
+            sample = await self._fetch_direct(watch, token)
+            self._ensure_polling(watch, token)
+            return sample
+
+        self._ensure_polling(watch, token)
+        self.stats["sharedReads"] += 1
+        return watch.latest
+
+    async def subscribe(self, token: str, device_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """Yield every new sample for a device until the consumer stops iterating"""
+        first = await self.get_latest(token, device_id)
+        watch = self._watch(device_id, token)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        fingerprint = token_fingerprint(token)
+        watch.subscribers[queue] = fingerprint
+        self._ensure_polling(watch, token)
+        try:
+            yield first
+            while True:
+                sample = await queue.get()
+                if not self._is_authorized(watch, token):
+                    # Re-check this viewer's access; an upstream error ends the stream
+                    sample = await self._fetch_direct(watch, token)
+                yield sample
+        finally:
+            watch.subscribers.pop(queue, None)
+            if fingerprint not in watch.subscribers.values():
+                watch.authorized.pop(fingerprint, None)
+
+    async def close(self) -> None:
+        """Stop all polling tasks (called on app shutdown)"""
+        loop = asyncio.get_running_loop()
+        tasks = [
+            watch.task for watch in self._watches.values()
+            if watch.task is not None and watch.task.get_loop() is loop
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._watches.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "intervalSeconds": self.interval_seconds,
+            "leaseSeconds": self.lease_seconds,
+            "authTtlSeconds": self.auth_ttl_seconds,
+            "watchedDevices": len(self._watches),
+            "streamSubscribers": sum(len(watch.subscribers) for watch in self._watches.values()),
+            **self.stats,
+        }
+
+
+# Global poller instance shared by the telemetry routes
+telemetry_poller = TelemetryPoller.from_env(
+    lambda id_token, device_id: harvia_service.get_latest_telemetry(id_token, device_id)
+)
@@ -0,0 +1,264 @@
+"""
+Token Manager
+Keeps Harvia ID tokens fresh by refreshing sessions shortly before they expire
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from services.harvia_api import HarviaAPIError, harvia_service
+from services.identity import token_fingerprint
+
+logger = logging.getLogger(__name__)
+
+Refresher = Callable[[str, str], Awaitable[Dict[str, Any]]]
+
+# Refresh failures meaning the refresh token itself is no longer accepted
+REVOKED_STATUS_CODES = {400, 401, 403}
+
+
+class _Session:
+    """One login: its refresh token, current tokens and its current and previous ID token"""
+
+    def __init__(self, key: str, email: str, refresh_token: str):
+        self.key = key
+        self.email = email
+        self.refresh_token = refresh_token
+        self.id_token = ""
+        self.access_token = ""
+        self.expires_at = 0.0
+        self.last_used = 0.0
+        self.aliases: List[str] = []
+        self.refreshing: Optional[asyncio.Future] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class TokenManager:
+    """
+    Tracks logged-in sessions and refreshes their tokens before expiry.
+
+    Sessions are registered from the login/refresh routes, keyed by refresh
+    token. `resolve` maps a session's current ID token, or the one it replaced
+    for `grace_seconds` after a refresh, to the current one with a dictionary
+    lookup; the refresh itself runs on a timer `margin_seconds` ahead of
+    expiry (or, if that timer was missed, in the background on the first
+    request inside the margin). A token is never resolved past its own expiry,
+    so the manager does not extend what a caller's token can do. Unknown,
+    expired and superseded tokens are passed through as-is for the upstream
+    call to accept or reject.
+
+    Only sessions in use are kept fresh: a session not resolved for
+    `idle_seconds` is no longer refreshed and is dropped with its aliases.
+    """
+
+    def __init__(
+        self,
+        refresh: Refresher,
+        margin_seconds: float = 300.0,
+        max_sessions: int = 10000,
+        idle_seconds: float = 3600.0,
+        grace_seconds: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._refresh = refresh
+        self.margin_seconds = margin_seconds
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.grace_seconds = grace_seconds
+        self._clock = clock
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        # ID token fingerprint -> (session key, time the token stops being resolved)
+        self._aliases: Dict[str, Tuple[str, float]] = {}
+        self.stats = {
+            "resolved": 0,
+            "unmanaged": 0,
+            "expiredTokens": 0,
+            "refreshes": 0,
+            "proactiveRefreshes": 0,
+            "refreshFailures": 0,
+            "expiredSessions": 0,
+            "idleSessions": 0,
+        }
+
+    @classmethod
+    def from_env(cls, refresh: Refresher) -> "TokenManager":
+        return cls(
+            refresh,
+            margin_seconds=float(os.getenv("HARVIA_TOKEN_REFRESH_MARGIN", "300")),
+            max_sessions=int(os.getenv("HARVIA_TOKEN_MAX_SESSIONS", "10000")),
+            idle_seconds=float(os.getenv("HARVIA_TOKEN_IDLE_TIMEOUT", "3600")),
+            grace_seconds=float(os.getenv("HARVIA_TOKEN_ALIAS_GRACE", "60")),
+        )
+
+    def register(self, email: str, refresh_token: Optional[str], tokens: Dict[str, Any]) -> None:
+        """Start (or update) tracking the session that `tokens` were issued to"""
+        if not refresh_token or not tokens.get("idToken"):
+            return
+        key = token_fingerprint(refresh_token)
+        session = self._sessions.get(key)
+        if session is None:
+            session = _Session(key, email, refresh_token)
+            self._sessions[key] = session
+            while len(self._sessions) > self.max_sessions:
+                self._drop(next(iter(self._sessions.values())))
+        self._sessions.move_to_end(key)
+        session.last_used = self._clock()
+        self._apply(session, tokens)
+
+    def _apply(self, session: _Session, tokens: Dict[str, Any]) -> None:
+        now = self._clock()
+        session.id_token = tokens["idToken"]
+        session.access_token = tokens.get("accessToken") or session.access_token
+        session.expires_at = now + float(tokens.get("expiresIn") or 3600)
+        alias = token_fingerprint(session.id_token)
+
+        # Keep the replaced token resolvable for a short grace window; older ones go
+        previous = session.aliases[-1] if session.aliases else None
+        for stale in session.aliases[:-1]:
+            self._aliases.pop(stale, None)
+        session.aliases = []
+        entry = self._aliases.get(previous) if previous is not None else None
+        if previous != alias and entry is not None:
+            self._aliases[previous] = (session.key, min(entry[1], now + self.grace_seconds))
+            session.aliases.append(previous)
+        session.aliases.append(alias)
+        self._aliases[alias] = (session.key, session.expires_at)
+        self._schedule(session)
+
+    def _schedule(self, session: _Session) -> None:
+        if session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        # Wake up to refresh, or to drop the session if it has gone idle by then
+        wake_at = min(session.expires_at - self.margin_seconds, session.last_used + self.idle_seconds)
+        session.timer = loop.call_later(max(0.0, wake_at - self._clock()), self._on_timer, session)
+
+    def _on_timer(self, session: _Session) -> None:
+        session.timer = None
+        if self._sessions.get(session.key) is not session:
+            return
+        now = self._clock()
+        if now - session.last_used >= self.idle_seconds:
+            self._drop_idle(session)
+        elif now >= session.expires_at - self.margin_seconds:
+            self._refresh_in_background(session)
+        else:
+            # Used since this timer was set; check again at its new idle deadline
+            self._schedule(session)
+
+    def _drop_idle(self, session: _Session) -> None:
+        self.stats["idleSessions"] += 1
+        self._drop(session)
+
+    def _evict_idle(self, now: float) -> None:
+        # Sessions are kept least recently used first
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used < self.idle_seconds:
+                break
+            self._drop_idle(session)
+
+    def _drop(self, session: _Session) -> None:
+        if session.timer is not None:
+            session.timer.cancel()
+        for alias in session.aliases:
+            self._aliases.pop(alias, None)
+        self._sessions.pop(session.key, None)
+
+    async def resolve(self, id_token: str) -> str:
+        """
+        The current ID token for the session `id_token` belongs to, or
+        `id_token` itself if it is unknown, expired or superseded
+        """
+        now = self._clock()
+        self._evict_idle(now)
+        session = self._session_for(id_token, now)
+        if session is None:
+            return id_token
+
+        self.stats["resolved"] += 1
+        session.last_used = now
+        self._sessions.move_to_end(session.key)
+        if now >= session.expires_at - self.margin_seconds:
+            self._refresh_in_background(session)
+        return session.id_token
+
+    def identity(self, id_token: str) -> str:
+        """
+        A caller key that survives refreshes: the session key while `id_token`
+        resolves to a session, otherwise the token's own fingerprint
+        """
+        fingerprint = token_fingerprint(id_token)
+        entry = self._aliases.get(fingerprint)
+        if entry is not None and entry[0] in self._sessions and self._clock() < entry[1]:
+            return entry[0]
+        return fingerprint
+
+    def _session_for(self, id_token: str, now: float) -> Optional[_Session]:
+        entry = self._aliases.get(token_fingerprint(id_token))
+        session = self._sessions.get(entry[0]) if entry is not None else None
+        if session is None:
+            self.stats["unmanaged"] += 1
+            return None
+        if now >= entry[1]:
+            self.stats["expiredTokens"] += 1
+            return None
+        return session
+
+    def _refresh_in_background(self, session: _Session) -> None:
+        if self._sessions.get(session.key) is not session or self._in_flight(session):
+            return
+        self.stats["proactiveRefreshes"] += 1
+        session.refreshing = asyncio.ensure_future(self._run_refresh(session))
+        # Failures are counted and logged in _run_refresh
+        session.refreshing.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def _in_flight(self, session: _Session) -> bool:
+        refreshing = session.refreshing
+        return (
+            refreshing is not None
+            and not refreshing.done()
+            and refreshing.get_loop() is asyncio.get_running_loop()
+        )
+
+    async def _run_refresh(self, session: _Session) -> str:
+        self.stats["refreshes"] += 1
+        try:
+            tokens = await self._refresh(session.refresh_token, session.email)
+        except Exception as e:
+            self.stats["refreshFailures"] += 1
+            if isinstance(e, HarviaAPIError) and e.status_code in REVOKED_STATUS_CODES:
+                logger.info("Dropping session whose refresh token was rejected (status %s)", e.status_code)
+                self.stats["expiredSessions"] += 1
+                self._drop(session)
+            else:
+                logger.warning("Token refresh failed: %s", e)
+            raise
+        if self._sessions.get(session.key) is session:
+            self._apply(session, tokens)
+        return tokens["idToken"]
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = self._clock()
+        return {
+            "sessions": len(self._sessions),
+            "marginSeconds": self.margin_seconds,
+            "idleSeconds": self.idle_seconds,
+            "graceSeconds": self.grace_seconds,
+            "expiredUnrefreshed": sum(1 for s in self._sessions.values() if now >= s.expires_at),
+            **self.stats,
+        }
+
+
+# Global token manager used by the /api/harvia routes
+token_manager = TokenManager.from_env(
+    lambda refresh_token, email: harvia_service.refresh_token(refresh_token, email)
+)
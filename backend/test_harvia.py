@@ -0,0 +1,968 @@
+import asyncio
+import gc
+import json
+import re
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+import routes.harvia as harvia_routes
+from main import app
+from services.command_queue import DeviceCommandQueue, device_command_queue
+from scripts.fake_harvia_server import FakeHarviaConfig, create_app, device_id as fake_device_id
+from services.device_cache import DeviceListCache, device_list_cache, device_state_responses
+from services.device_normalizer import DeviceNormalizer
+from services.device_stream import DeviceStream
+from services.harvia_api import HarviaAPIError, HarviaAPIService, harvia_service
+from services.graphql_capabilities import SchemaCapabilityCache
+from services.graphql_operations import UPDATE_DEVICE_NAME, devices_get_batch
+from services.http_pool import HTTPPool, HTTPPoolConfig
+from services.identity import token_fingerprint
+from services.rate_limit import RateLimiter
+from services.resilience import CircuitBreaker, RetryPolicy
+from services.telemetry_poller import TelemetryPoller
+from services.token_manager import TokenManager
+
+client = TestClient(app)
+
+ENDPOINTS = {
+    "endpoints": {
+        "RestApi": {
+            "generics": {"https": "https://rest.harvia.test"},
+            "device": {"https": "https://device.harvia.test"},
+            "data": {"https": "https://data.harvia.test"},
+        },
+        "GraphQL": {
+            "device": {"https": "https://graphql.harvia.test/device"},
+            "users": {"https": "https://graphql.harvia.test/users"},
+        },
+    }
+}
+
+
+@pytest.fixture
+def metrics_headers(monkeypatch):
+    """Headers that pass the /metrics routes' key check"""
+    monkeypatch.setattr(harvia_routes, "METRICS_KEY", "test-metrics-key")
+    return {"X-Metrics-Key": "test-metrics-key"}
+
+
+def make_service(upstream, **config):
+    """
+    HarviaAPIService whose upstream traffic is answered by `upstream`, either an
+    httpx handler function or a transport (e.g. an ASGITransport to the fake server)
+    """
+    transport = upstream if isinstance(upstream, httpx.AsyncBaseTransport) else httpx.MockTransport(upstream)
+    service = HarviaAPIService(pool_config=HTTPPoolConfig(**config), transport=transport)
+    service.config_cache_path = None
+    service.retry_policy = RetryPolicy(max_attempts=3, base_delay=0.0)
+    return service
+
+
+@pytest.fixture
+def run_service():
+    """
+    Run `scenario(service)` on a fresh event loop against `make_service(upstream, **config)`
+    and return its result; the service is closed afterwards.
+    """
+    def run(upstream, scenario, **config):
+        async def main():
+            service = make_service(upstream, **config)
+            try:
+                return await scenario(service)
+            finally:
+                await service.close()
+
+        return asyncio.run(main())
+
+    return run
+
+
+def test_pool_closes_client_left_on_a_previous_loop():
+    pool = HTTPPool(HTTPPoolConfig(), transport=httpx.MockTransport(lambda request: httpx.Response(204)))
+
+    async def first():
+        await pool.request("GET", "https://device.harvia.test/ping")
+        return pool.client
+
+    async def second():
+        await pool.request("GET", "https://device.harvia.test/ping")
+        await asyncio.sleep(0)
+        return pool.client
+
+    old = asyncio.run(first())
+    new = asyncio.run(second())
+    assert new is not old and old.is_closed and not new.is_closed
+    assert pool.metrics.clients_created == 2
+
+
+def test_pool_reuses_one_client_across_calls(run_service):
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/endpoints":
+            return httpx.Response(200, json=ENDPOINTS)
+        return httpx.Response(200, json={"deviceId": request.url.params["deviceId"]})
+
+    async def scenario(service):
+        await service.start()
+        await service.get_device_state("token", "dev-1")
+        await service.get_latest_telemetry("token", "dev-1")
+        return service.pool_stats()
+
+    stats = run_service(handler, scenario)
+    assert stats["clientsCreated"] == 1
+    assert stats["requestsTotal"] == 3
+    assert stats["inFlight"] == 0
+    assert stats["hosts"]["device.harvia.test"]["requests"] == 1
+
+
+def test_pool_caps_concurrent_requests_per_host(run_service):
+    active = {"now": 0, "peak": 0}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        active["now"] += 1
+        active["peak"] = max(active["peak"], active["now"])
+        await asyncio.sleep(0.01)
+        active["now"] -= 1
+        return httpx.Response(200, json={})
+
+    async def scenario(service):
+        await asyncio.gather(*(
+            service.http.request("GET", "https://device.harvia.test/devices/state")
+            for _ in range(6)
+        ))
+        return service.pool_stats()
+
+    stats = run_service(handler, scenario, max_connections_per_host=2)
+    assert active["peak"] == 2
+    assert stats["hostSlotWaits"] > 0
+
+
+def test_pool_metrics_route(metrics_headers, monkeypatch):
+    response = client.get("/api/harvia/metrics/pool", headers=metrics_headers)
+    assert response.status_code == 200
+    pool = response.json()["pool"]
+    assert {"config", "requestsTotal", "inFlight", "hosts"} <= pool.keys()
+    assert pool["connections"]["source"] in ("pool", "requests")
+
+    assert client.get("/api/harvia/metrics/pool", headers={"X-Metrics-Key": "wrong"}).status_code == 401
+    monkeypatch.setattr(harvia_routes, "METRICS_KEY", "")
+    assert client.get("/api/harvia/metrics/pool").status_code == 403
+    monkeypatch.setattr(harvia_routes, "METRICS_OPEN", True)
+    assert client.get("/api/harvia/metrics/pool").status_code == 200
+
+
+def test_pool_connection_stats_fall_back_to_request_counts():
+    pool = HTTPPool(HTTPPoolConfig(), transport=httpx.MockTransport(lambda request: httpx.Response(204)))
+    # MockTransport has no httpcore pool to read
+    assert pool._connection_stats() == {"active": 0, "source": "requests"}
+
+
+def device_summary(device_id):
+    return {"id": device_id, "type": "Fenix", "attr": [{"key": "city", "value": "Espoo"}], "roles": [], "via": None}
+
+
+def test_device_enrichment_runs_concurrently_within_limit(run_service):
+    active = {"now": 0, "peak": 0}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/endpoints":
+            return httpx.Response(200, json=ENDPOINTS)
+        query = request.read().decode()
+        if "usersDevicesList" in query:
+            devices = [device_summary(f"dev-{i}") for i in range(6)]
+            return httpx.Response(200, json={"data": {"usersDevicesList": {"devices": devices}}})
+        if "devicesGet" in query:
+            active["now"] += 1
+            active["peak"] = max(active["peak"], active["now"])
+            await asyncio.sleep(0.02)
+            active["now"] -= 1
+            return httpx.Response(200, json={"data": {"devicesGet": None}})
+        return httpx.Response(400, json={"errors": [{"message": "unknown field"}]})
+
+    async def scenario(service):
+        service.enrich_concurrency = 3
+        service.details_batch_size = 1
+        return await service.get_devices("token")
+
+    result = run_service(handler, scenario)
+    assert len(result["devices"]) == 6
+    assert result["partial"] is False
+    assert 1 < active["peak"] <= 3
+
+
+def test_device_enrichment_returns_partial_results_at_deadline(run_service):
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/endpoints":
+            return httpx.Response(200, json=ENDPOINTS)
+        query = request.read().decode()
+        if "usersDevicesList" in query:
+            devices = [device_summary("fast"), device_summary("slow")]
+            return httpx.Response(200, json={"data": {"usersDevicesList": {"devices": devices}}})
+        if "devicesGet" in query and "slow" in query:
+            await asyncio.sleep(1)
+        return httpx.Response(200, json={"data": {}})
+
+    async def scenario(service):
+        service.enrich_deadline = 0.1
+        service.details_batch_size = 1
+        return await service.get_devices("token")
+
+    result = run_service(handler, scenario)
+    assert [device["id"] for device in result["devices"]] == ["fast", "slow"]
+    assert result["partial"] is True
+    assert result["timedOut"] == ["slow"]
+
+
+def test_device_details_are_fetched_in_batched_documents(run_service):
+    detail_requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/endpoints":
+            return httpx.Response(200, json=ENDPOINTS)
+        body = json.loads(request.content)
+        query = body["query"]
+        if "usersDevicesList" in query:
+            devices = [device_summary(f"dev-{i}") for i in range(5)]
+            return httpx.Response(200, json={"data": {"usersDevicesList": {"devices": devices}}})
+        if "devicesGet" in query:
+            detail_requests.append(query)
+            data = {}
+            errors = []
+            for alias, variable in re.findall(r'(d\d+): devicesGet\(deviceId: \$(\w+)\)', query):
+                device_id = body["variables"][variable]
+                if device_id == "dev-3":
+                    data[alias] = None
+                    errors.append({"message": "Not authorized", "path": [alias]})
+                else:
+                    data[alias] = {**device_summary(device_id), "type": "Detailed"}
+            return httpx.Response(200, json={"data": data, "errors": errors})
+        return httpx.Response(400, json={"errors": [{"message": "unknown field"}]})
+
+    async def scenario(service):
+        service.details_batch_size = 2
+        return await service.get_devices("token")
+
+    result = run_service(handler, scenario)
+    assert len(detail_requests) == 3
+    types = {device["id"]: device["type"] for device in result["devices"]}
+    assert types == {
+        "dev-0": "Detailed",
+        "dev-1": "Detailed",
+        "dev-2": "Detailed",
+        "dev-3": "Fenix",
+        "dev-4": "Detailed",
+    }
+
+
+def test_users_alias_probes_skip_rejected_query_shapes(tmp_path, run_service):
+    users_queries = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/endpoints":
+            return httpx.Response(200, json=ENDPOINTS)
+        query = json.loads(request.content)["query"]
+        if "usersDevicesList" in query:
+            devices = [device_summary(f"dev-{i}") for i in range(4)]
+            return httpx.Response(200, json={"data": {"usersDevicesList": {"devices": devices}}})
+        if "devicesGet" in query:
+            return httpx.Response(200, json={"data": {}})
+        users_queries.append(query)
+        if "userDevice" in query:
+            return httpx.Response(200, json={"data": {"userDevice": {"alias": "HypeMen"}}})
+        return httpx.Response(400, json={"errors": [{"errorType": "ValidationError", "message": "FieldUndefined"}]})
+
+    cache_path = str(tmp_path / "capabilities.json")
+
+    async def scenario(service):
+        service.capabilities = SchemaCapabilityCache(path=cache_path)
+        first = await service.get_devices("token")
+        first_queries = len(users_queries)
+        second = await service.get_devices("token")
+        assert len(service._probe_locks) == 1
+        return service, first, first_queries, second
+
+    service, first, first_queries, second = run_service(handler, scenario)
+    # Probe locks go away with the event loop they were made for
+    gc.collect()
+    assert len(service._probe_locks) == 0
+    assert first_queries == 2 + 4
+    assert len(users_queries) - first_queries == 4
+    assert all("userDevice" in query for query in users_queries[first_queries:])
+    assert {device["displayName"] for device in second["devices"]} == {"HypeMen"}
+
+    reloaded = SchemaCapabilityCache(path=cache_path)
+    users_endpoint = ENDPOINTS["endpoints"]["GraphQL"]["users"]["https"]
+    assert reloaded.is_rejected(users_endpoint, "GetDeviceAlias")
+    assert reloaded.is_supported(users_endpoint, "GetUserDevice")
+
+
+def test_device_list_cache_serves_stale_while_refreshing():
+    loads = []
+
+    async def loader():
+        loads.append(len(loads))
+        return len(loads)
+
+    async def scenario():
+        cache = DeviceListCache(ttl_seconds=0.05, stale_seconds=10, max_entries=2)
+        first, coalesced = await asyncio.gather(cache.get("a", loader), cache.get("a", loader))
+        cached = await cache.get("a", loader)
+        await asyncio.sleep(0.06)
+        stale = await cache.get("a", loader)
+        await asyncio.sleep(0.01)
+        refreshed = await cache.get("a", loader)
+        await cache.get("b", loader)
+        await cache.get("c", loader)
+        return first, coalesced, cached, stale, refreshed, cache.snapshot()
+
+    first, coalesced, cached, stale, refreshed, stats = asyncio.run(scenario())
+    assert (first, coalesced, cached, stale, refreshed) == (1, 1, 1, 1, 2)
+    assert stats["staleHits"] == 1 and stats["refreshes"] == 1
+    assert stats["entries"] == 2 and stats["evictions"] == 1
+
+
+def test_devices_route_caches_per_token_and_invalidates_on_rename(monkeypatch):
+    calls = []
+
+    async def fake_get_devices(token):
+        calls.append(token)
+        return {"devices": [device_summary("dev-1")]}
+
+    async def fake_update_device_name(token, device_id, display_name):
+        return {"id": device_id}
+
+    monkeypatch.setattr(harvia_service, "get_devices", fake_get_devices)
+    monkeypatch.setattr(harvia_service, "update_device_name", fake_update_device_name)
+    device_list_cache.clear()
+
+    headers = {"Authorization": "Bearer token-a"}
+    assert client.get("/api/harvia/devices", headers=headers).json()["count"] == 1
+    client.get("/api/harvia/devices", headers=headers)
+    client.get("/api/harvia/devices", headers={"Authorization": "Bearer token-b"})
+    assert calls == ["token-a", "token-b"]
+
+    response = client.patch("/api/harvia/devices/dev-1/name", params={"display_name": "Sauna"}, headers=headers)
+    assert response.status_code == 200
+    client.get("/api/harvia/devices", headers=headers)
+    client.get("/api/harvia/devices", headers={"Authorization": "Bearer token-b"})
+    assert calls == ["token-a", "token-b", "token-a", "token-b"]
+    device_list_cache.clear()
+
+
+def test_api_configuration_is_single_flight_stale_while_revalidate_and_persisted(tmp_path, run_service):
+    fetches = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        fetches.append(request.url.path)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json=ENDPOINTS)
+
+    cache_path = str(tmp_path / "endpoints.json")
+
+    async def scenario(service):
+        service.config_cache_path = cache_path
+        configs = await asyncio.gather(*(service._get_api_configuration() for _ in range(5)))
+        assert len(fetches) == 1 and all(config == ENDPOINTS["endpoints"] for config in configs)
+
+        service.config_fetched_at -= service.CONFIG_TTL
+        stale = await service._get_api_configuration()
+        assert stale == ENDPOINTS["endpoints"] and len(fetches) == 1
+        await asyncio.sleep(0.05)
+        assert len(fetches) == 2
+        await service.close()
+
+        restarted = make_service(handler)
+        restarted.config_cache_path = cache_path
+        await restarted.start()
+        warm = await restarted._get_api_configuration()
+        await restarted.close()
+        return warm
+
+    assert run_service(handler, scenario) == ENDPOINTS["endpoints"]
+    assert len(fetches) == 2
+
+
+def test_telemetry_poller_shares_samples_between_viewers():
+    fetches = []
+
+    async def fetch(token, device_id):
+        fetches.append(token)
+        if token == "stranger":
+            raise HarviaAPIError("Forbidden", 403)
+        return {"temperature": 80 + len(fetches)}
+
+    async def scenario():
+        poller = TelemetryPoller(fetch, interval_seconds=0.02, lease_seconds=0.05)
+        await poller.get_latest("phone-1", "sauna")
+        samples = await asyncio.gather(*(poller.get_latest("phone-1", "sauna") for _ in range(10)))
+        assert len(fetches) == 1 and all(sample == samples[0] for sample in samples)
+
+        await poller.get_latest("phone-2", "sauna")
+        await poller.get_latest("phone-2", "sauna")
+        assert fetches == ["phone-1", "phone-2"]
+
+        try:
+            await poller.get_latest("stranger", "sauna")
+            raise AssertionError("unauthorized viewer was served a shared sample")
+        except HarviaAPIError as e:
+            assert e.status_code == 403
+
+        await asyncio.sleep(0.03)
+        assert len(fetches) > 3
+        await asyncio.sleep(0.1)
+        stopped_at = len(fetches)
+        await asyncio.sleep(0.05)
+        return stopped_at, poller.snapshot()
+
+    stopped_at, stats = asyncio.run(scenario())
+    assert len(fetches) == stopped_at
+    assert stats["watchedDevices"] == 0
+    assert stats["sharedReads"] >= 10
+
+
+def test_telemetry_poller_rechecks_viewer_access_and_prunes_on_unsubscribe():
+    revoked = set()
+
+    async def fetch(token, device_id):
+        if token in revoked:
+            raise HarviaAPIError("Forbidden", 403)
+        return {"temperature": 80}
+
+    async def scenario():
+        poller = TelemetryPoller(fetch, interval_seconds=0.01, lease_seconds=0.05, auth_ttl_seconds=0.03)
+        watching = poller.subscribe("viewer", "sauna")
+        await watching.__anext__()
+        await poller.get_latest("phone", "sauna")
+        watch = poller._watches["sauna"]
+        assert len(watch.authorized) == 2
+
+        # Access is re-checked once the TTL lapses; a revoked token ends the stream
+        revoked.add("viewer")
+        try:
+            for _ in range(10):
+                await watching.__anext__()
+            raise AssertionError("revoked viewer kept receiving samples")
+        except HarviaAPIError as e:
+            assert e.status_code == 403
+        # The stream's entry went with it, and the lapsed phone check was pruned
+        assert watch.subscribers == {}
+        await poller.get_latest("other", "sauna")
+        assert list(watch.authorized) == [token_fingerprint("other")]
+        await poller.close()
+
+    asyncio.run(scenario())
+
+
+def test_bulk_state_route_reports_per_device_results(monkeypatch):
+    async def fake_get_device_state(token, device_id):
+        if device_id == "locked":
+            raise HarviaAPIError("Forbidden", 403)
+        return {"deviceId": device_id, "active": True}
+
+    monkeypatch.setattr(harvia_service, "get_device_state", fake_get_device_state)
+
+    response = client.get(
+        "/api/harvia/devices/state",
+        params={"ids": "sauna-1,locked,sauna-1, sauna-2"},
+        headers={"Authorization": "Bearer token"},
+    )
+    assert response.status_code == 200
+    payload = response.json()
+    assert payload["count"] == 3 and payload["failed"] == 1
+    assert [entry["deviceId"] for entry in payload["results"]] == ["sauna-1", "locked", "sauna-2"]
+    assert payload["results"][1] == {
+        "deviceId": "locked", "success": False, "data": None, "error": "Forbidden", "statusCode": 403
+    }
+
+    empty = client.get("/api/harvia/devices/telemetry", params={"ids": " , "}, headers={"Authorization": "Bearer token"})
+    assert empty.status_code == 400
+
+
+def test_idempotent_requests_retry_transient_failures(run_service):
+    calls = {"state": 0, "command": 0}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/endpoints":
+            return httpx.Response(200, json=ENDPOINTS)
+        if request.method == "GET":
+            calls["state"] += 1
+            if calls["state"] == 1:
+                raise httpx.ConnectError("connection reset", request=request)
+            if calls["state"] == 2:
+                return httpx.Response(503, json={"message": "busy"})
+            return httpx.Response(200, json={"deviceId": "dev-1"})
+        calls["command"] += 1
+        return httpx.Response(503, json={"message": "busy"})
+
+    async def scenario(service):
+        state = await service.get_device_state("token", "dev-1")
+        assert state == {"deviceId": "dev-1"}
+        # Commands are not idempotent: exactly one attempt
+        try:
+            await service.send_device_command("token", "dev-1", "SAUNA")
+            raise AssertionError("expected the 503 to surface")
+        except HarviaAPIError as e:
+            assert e.status_code == 503
+        return service.resilience_stats()
+
+    stats = run_service(handler, scenario)
+    assert calls == {"state": 3, "command": 1}
+    assert stats["retry"]["retries"] == 2
+
+
+def test_circuit_breaker_fails_fast_while_open_and_recovers(metrics_headers, run_service):
+    upstream = {"healthy": False, "calls": 0}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/endpoints":
+            return httpx.Response(200, json=ENDPOINTS)
+        upstream["calls"] += 1
+        if not upstream["healthy"]:
+            return httpx.Response(502, json={"message": "bad gateway"})
+        return httpx.Response(200, json={"deviceId": "dev-1"})
+
+    async def scenario(service):
+        service.retry_policy = RetryPolicy(max_attempts=1)
+        service.breakers.failure_threshold = 2
+        service.breakers.reset_timeout = 60.0
+        for _ in range(2):
+            try:
+                await service.get_device_state("token", "dev-1")
+            except HarviaAPIError as e:
+                assert e.status_code == 502
+        calls_when_opened = upstream["calls"]
+
+        try:
+            await service.get_device_state("token", "dev-1")
+            raise AssertionError("expected the open breaker to reject the request")
+        except HarviaAPIError as e:
+            assert e.status_code == 503
+        assert upstream["calls"] == calls_when_opened
+        breaker = service.breakers.get("device.harvia.test")
+        assert breaker.snapshot()["state"] == CircuitBreaker.OPEN
+
+        # After the reset timeout a single trial request closes it again
+        upstream["healthy"] = True
+        breaker.opened_at -= 61.0
+        assert await service.get_device_state("token", "dev-1") == {"deviceId": "dev-1"}
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    run_service(handler, scenario)
+
+    response = client.get("/api/harvia/metrics/breakers", headers=metrics_headers)
+    assert response.status_code == 200
+    assert "breakers" in response.json()["resilience"]
+
+
+def test_cancelled_half_open_trial_does_not_wedge_the_breaker(run_service):
+    upstream = {"slow": True}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/endpoints":
+            return httpx.Response(200, json=ENDPOINTS)
+        if upstream["slow"]:
+            await asyncio.sleep(5)
+        return httpx.Response(200, json={"deviceId": "dev-1"})
+
+    async def scenario(service):
+        await service._get_api_configuration()
+        breaker = service.breakers.get("device.harvia.test")
+        breaker.record_failure()
+        breaker.state = CircuitBreaker.OPEN
+        breaker.opened_at = -1e9
+
+        # The trial request is cut off by a deadline
+        try:
+            await asyncio.wait_for(service.get_device_state("token", "dev-1"), 0.1)
+            raise AssertionError("expected the trial to time out")
+        except asyncio.TimeoutError:
+            pass
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+
+        upstream["slow"] = False
+        assert await service.get_device_state("token", "dev-1") == {"deviceId": "dev-1"}
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    run_service(handler, scenario)
+
+
+def test_rate_limiter_queues_briefly_then_rejects_per_token(run_service):
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/endpoints":
+            return httpx.Response(200, json=ENDPOINTS)
+        return httpx.Response(200, json={"deviceId": request.url.params["deviceId"]})
+
+    async def scenario(service):
+        service.rate_limiter = RateLimiter(
+            rate=0, per_key_rate=20.0, per_key_burst=2.0, max_wait=0.1
+        )
+        results = await asyncio.gather(
+            *(service.get_device_state("busy-token", f"dev-{i}") for i in range(6)),
+            return_exceptions=True,
+        )
+        # Another caller has its own bucket and is not held up by the busy one
+        other = await service.get_device_state("other-token", "dev-9")
+        return results, other, service.rate_limit_stats()
+
+    results, other, stats = run_service(handler, scenario)
+    rejected = [r for r in results if isinstance(r, HarviaAPIError)]
+    # Burst of 2, plus 2 more within the 0.1s queue budget at 20/s
+    assert len(rejected) == 2
+    assert all(r.status_code == 429 for r in rejected)
+    assert other == {"deviceId": "dev-9"}
+    assert stats["rejected"] == 2 and stats["delayed"] == 2
+    assert stats["maxQueueDepth"] == 2 and stats["queueDepth"] == 0
+    assert 0 < stats["longestWaitSeconds"] <= 0.1
+
+
+def test_device_normalizer_maps_rest_attrs_and_memoizes_by_content():
+    normalizer = DeviceNormalizer(max_entries=2)
+    raw = {
+        "name": "dev-1",
+        "type": "Fenix",
+        "attr": [
+            {"key": "name", "value": "a-very-long-serial-like-value_0001"},
+            {"key": "city", "value": "Espoo"},
+            {"key": "connected", "value": "true"},
+            {"key": "rssi", "value": "-60"},
+            {"key": "w_latitude", "value": "60.2"},
+            {"key": "w_longitude", "value": "24.6"},
+            {"key": "updatedAt", "value": "2025-01-01T00:00:00Z"},
+        ],
+    }
+
+    device = normalizer.normalize(raw)
+    assert device.id == "dev-1" and device.name == "dev-1"
+    assert device.displayName == "Fenix Espoo"
+    assert device.isConnected is True
+    assert device.signalStrength == -60.0
+    assert device.lastSeen == "2025-01-01T00:00:00Z"
+    assert (device.location.name, device.location.latitude) == ("Espoo", 60.2)
+    assert "id" not in raw  # input is left untouched
+
+    assert normalizer.normalize(dict(raw)) is device
+    changed = {**raw, "type": "SaunaSensor"}
+    assert normalizer.normalize(changed).displayName == "SaunaSensor Espoo"
+    assert normalizer.snapshot()["hits"] == 1 and normalizer.snapshot()["misses"] == 2
+
+    # Upstream values are still validated: a malformed payload is rejected
+    with pytest.raises(ValidationError):
+        normalizer.normalize({**raw, "type": ["not", "a", "type"]})
+
+
+def test_device_routes_answer_if_none_match_with_304(monkeypatch):
+    state = {"temperature": 80}
+
+    async def fake_get_devices(token):
+        return {"devices": [device_summary("dev-1")]}
+
+    async def fake_get_device_state(token, device_id):
+        return dict(state)
+
+    monkeypatch.setattr(harvia_service, "get_devices", fake_get_devices)
+    monkeypatch.setattr(harvia_service, "get_device_state", fake_get_device_state)
+    device_list_cache.clear()
+    headers = {"Authorization": "Bearer token-etag"}
+
+    first = client.get("/api/harvia/devices", headers=headers)
+    etag = first.headers["ETag"]
+    assert first.status_code == 200 and first.json()["count"] == 1
+    assert b": " not in first.content  # compact JSON
+
+    cached = client.get("/api/harvia/devices", headers={**headers, "If-None-Match": etag})
+    assert cached.status_code == 304 and cached.content == b""
+    assert cached.headers["ETag"] == etag
+    assert client.get("/api/harvia/devices", headers={**headers, "If-None-Match": '"other"'}).status_code == 200
+    device_list_cache.clear()
+    device_state_responses.clear()
+    before = dict(device_state_responses.stats)
+
+    state_etag = client.get("/api/harvia/devices/dev-1/state", headers=headers).headers["ETag"]
+    unchanged = client.get("/api/harvia/devices/dev-1/state", headers={**headers, "If-None-Match": f"W/{state_etag}"})
+    assert unchanged.status_code == 304
+    # The unchanged state reused the serialized body and ETag
+    assert device_state_responses.stats["hits"] == before["hits"] + 1
+    assert device_state_responses.stats["misses"] == before["misses"] + 1
+    state["temperature"] = 85
+    changed = client.get("/api/harvia/devices/dev-1/state", headers={**headers, "If-None-Match": state_etag})
+    assert changed.status_code == 200 and changed.json()["state"] == {"temperature": 85}
+    assert changed.headers["ETag"] != state_etag
+    assert device_state_responses.stats["misses"] == before["misses"] + 2
+    device_state_responses.clear()
+
+
+def test_service_against_fake_harvia_server(run_service):
+    fake = create_app(FakeHarviaConfig(devices=7, seed=1))
+
+    async def scenario(service):
+        service.ENDPOINTS_URL = "http://fake-harvia.local/endpoints"
+        service.details_batch_size = 3
+        tokens = await service.authenticate("user@example.com", "secret")
+        devices = await service.get_devices(tokens["idToken"])
+        state = await service.get_device_state(tokens["idToken"], fake_device_id(2))
+        telemetry = await service.get_latest_telemetry(tokens["idToken"], fake_device_id(2))
+        return devices, state, telemetry
+
+    devices, state, telemetry = run_service(httpx.ASGITransport(app=fake), scenario)
+    assert [d["id"] for d in devices["devices"]] == [fake_device_id(i) for i in range(7)]
+    # Full details (city etc.) came from the batched devicesGet documents
+    assert all(any(a["key"] == "city" for a in d["attr"]) for d in devices["devices"])
+    assert state["deviceId"] == telemetry["deviceId"] == fake_device_id(2)
+    calls = fake.state.calls
+    assert calls["POST /graphql/device"] == 1 + 3  # list + ceil(7 / 3) batches
+    # Each alias probe shape is rejected once, then skipped for the other devices
+    assert calls["POST /graphql/users"] == 3
+
+
+def test_command_queue_coalesces_target_updates_and_dedupes_commands():
+    sent = {"targets": [], "commands": []}
+
+    async def send_target(token, device_id, temperature, humidity):
+        sent["targets"].append((token, device_id, temperature, humidity))
+        await asyncio.sleep(0.01)
+        if temperature == 999:
+            raise HarviaAPIError("Rejected", 400)
+        return {"temperature": temperature, "humidity": humidity}
+
+    async def send_command(token, device_id, command, parameters):
+        sent["commands"].append(command)
+        await asyncio.sleep(0.01)
+        return {"command": command}
+
+    async def scenario():
+        queue = DeviceCommandQueue(
+            send_target, send_command, window_seconds=0.02, dedupe_seconds=0.05, idempotent_commands=["start"]
+        )
+        # A slider drag: 20 updates in quick succession, plus one humidity change
+        tickets = [queue.set_target("token", "sauna", temperature=70 + i) for i in range(20)]
+        tickets.append(queue.set_target("token", "sauna", humidity=30))
+        other = queue.set_target("other-user", "sauna", temperature=60)
+        await asyncio.gather(*(ticket.wait() for ticket in tickets + [other]))
+        assert sent["targets"] == [("token", "sauna", 89, 30), ("other-user", "sauna", 60, None)]
+        assert all(t.status == "sent" and t.coalesced == 21 and t.result["temperature"] == 89 for t in tickets)
+
+        repeat = await queue.set_target("token", "sauna", temperature=89, humidity=30).wait()
+        assert repeat.status == "duplicate" and len(sent["targets"]) == 2
+        failed = await queue.set_target("token", "sauna", temperature=999).wait()
+        assert failed.status == "failed" and failed.status_code == 400
+
+        first = queue.send_command("token", "sauna", "start", {"a": 1, "b": 2})
+        second = queue.send_command("token", "sauna", "start", {"b": 2, "a": 1})
+        different = queue.send_command("token", "sauna", "stop")
+        await asyncio.gather(first.wait(), second.wait(), different.wait())
+        assert (first.status, second.status, different.status) == ("sent", "duplicate", "sent")
+        assert sent["commands"] == ["start", "stop"]
+        await asyncio.sleep(0.06)
+        await queue.send_command("token", "sauna", "start", {"a": 1, "b": 2}).wait()
+        assert sent["commands"] == ["start", "stop", "start"]
+
+        # Commands not known to be idempotent are sent every time unless flagged
+        toggles = [queue.send_command("token", "sauna", "toggle_light") for _ in range(2)]
+        await asyncio.gather(*(ticket.wait() for ticket in toggles))
+        assert [t.status for t in toggles] == ["sent", "sent"]
+        flagged = [queue.send_command("token", "sauna", "toggle_fan", idempotent=True) for _ in range(2)]
+        await asyncio.gather(*(ticket.wait() for ticket in flagged))
+        assert [t.status for t in flagged] == ["sent", "duplicate"]
+        assert sent["commands"][3:] == ["toggle_light", "toggle_light", "toggle_fan"]
+
+        # Idle device slots are dropped once their dedupe window has passed
+        assert queue.snapshot()["devices"] == 0
+        return queue.snapshot()
+
+    stats = asyncio.run(scenario())
+    assert stats["targetRequests"] == 24 and stats["targetSends"] == 3
+    assert stats["commandRequests"] == 8 and stats["commandSends"] == 6
+
+
+def test_command_routes_return_queue_status(monkeypatch, metrics_headers):
+    async def fake_set_device_target(token, device_id, temperature, humidity):
+        return {"deviceId": device_id, "temperature": temperature}
+
+    monkeypatch.setattr(harvia_service, "set_device_target", fake_set_device_target)
+    monkeypatch.setattr(device_command_queue, "window_seconds", 0.0)
+    headers = {"Authorization": "Bearer token-commands"}
+
+    response = client.patch(
+        "/api/harvia/devices/target", json={"deviceId": "route-sauna", "temperature": 75}, headers=headers
+    )
+    assert response.status_code == 200
+    payload = response.json()
+    assert payload["data"] == {"deviceId": "route-sauna", "temperature": 75.0}
+    assert payload["status"] == "sent" and payload["coalesced"] == 1
+
+    status = client.get(f"/api/harvia/commands/{payload['commandId']}", headers=headers)
+    assert status.json()["command"]["status"] == "sent"
+    assert client.get(
+        f"/api/harvia/commands/{payload['commandId']}", headers={"Authorization": "Bearer someone-else"}
+    ).status_code == 404
+    assert client.get("/api/harvia/metrics/commands", headers=metrics_headers).json()["commands"]["targetSends"] >= 1
+
+
+def test_command_tickets_stay_with_their_owner_across_token_refresh():
+    async def refresh(refresh_token, email):
+        return {"idToken": "id-1", "expiresIn": 3600}
+
+    async def send(*args):
+        return {"ok": True}
+
+    async def scenario():
+        manager = TokenManager(refresh, margin_seconds=300)
+        queue = DeviceCommandQueue(send, send, identify=manager.identity)
+        manager.register("user@example.com", "refresh-1", {"idToken": "id-0", "expiresIn": 3600})
+        ticket = await queue.send_command("id-0", "sauna", "start").wait()
+        manager.register("user@example.com", "refresh-1", await refresh("refresh-1", "user@example.com"))
+        return ticket, queue, manager
+
+    ticket, queue, manager = asyncio.run(scenario())
+    assert queue.get_ticket(ticket.id, "id-1") is ticket
+    assert queue.get_ticket(ticket.id, "someone-else") is None
+
+
+def test_token_manager_refreshes_ahead_of_expiry_and_coalesces():
+    now = [0.0]
+    refreshes = []
+
+    async def refresh(refresh_token, email):
+        refreshes.append(refresh_token)
+        await asyncio.sleep(0.01)
+        if refresh_token == "revoked":
+            raise HarviaAPIError("Invalid refresh token", 401)
+        return {"idToken": f"id-{len(refreshes)}", "accessToken": "access", "expiresIn": 3600}
+
+    async def scenario():
+        manager = TokenManager(refresh, margin_seconds=300, idle_seconds=10000, clock=lambda: now[0])
+        manager.register("user@example.com", "refresh-1", {"idToken": "id-0", "expiresIn": 3600})
+        assert await manager.resolve("id-0") == "id-0"
+        assert await manager.resolve("someone-else") == "someone-else"
+
+        # Inside the margin: the still-valid token is returned and refreshed in the background
+        now[0] = 3400
+        assert await manager.resolve("id-0") == "id-0"
+        await asyncio.sleep(0.02)
+        assert refreshes == ["refresh-1"]
+        # The replaced token maps to the new one during the grace window
+        assert await manager.resolve("id-0") == await manager.resolve("id-1") == "id-1"
+
+        # Concurrent requests inside the margin share one refresh
+        now[0] = 6800
+        tokens = await asyncio.gather(*(manager.resolve("id-1") for _ in range(5)))
+        assert tokens == ["id-1"] * 5
+        await asyncio.sleep(0.02)
+        assert len(refreshes) == 2 and await manager.resolve("id-1") == "id-2"
+
+        # Tokens more than one refresh old, past the grace window or expired are not resolved
+        assert await manager.resolve("id-0") == "id-0"
+        now[0] = 6800 + 61
+        assert await manager.resolve("id-1") == "id-1"
+        now[0] = 6800 + 3600
+        assert await manager.resolve("id-2") == "id-2"
+        assert len(refreshes) == 2
+        assert [len(session.aliases) for session in manager._sessions.values()] == [2]
+
+        manager.register("other@example.com", "revoked", {"idToken": "id-x", "expiresIn": 60})
+        now[0] += 30
+        assert await manager.resolve("id-x") == "id-x"
+        await asyncio.sleep(0.02)
+        return manager.snapshot()
+
+    stats = asyncio.run(scenario())
+    assert stats["sessions"] == 1 and stats["expiredSessions"] == 1
+    assert stats["proactiveRefreshes"] == 3 and stats["refreshes"] == 3
+    assert stats["expiredTokens"] == 2 and stats["unmanaged"] == 2
+
+
+def test_token_manager_stops_refreshing_and_drops_idle_sessions():
+    refreshes = []
+
+    async def refresh(refresh_token, email):
+        refreshes.append(refresh_token)
+        return {"idToken": f"{refresh_token}-id-{len(refreshes)}", "expiresIn": 0.4}
+
+    async def scenario():
+        manager = TokenManager(refresh, margin_seconds=0.1, idle_seconds=0.1)
+        manager.register("idle@example.com", "idle", {"idToken": "idle-id", "expiresIn": 0.4})
+        manager.register("busy@example.com", "busy", {"idToken": "busy-id", "expiresIn": 0.4})
+        # Only the busy session is used; both would be due a refresh at 0.3s
+        token = "busy-id"
+        for _ in range(14):
+            await asyncio.sleep(0.03)
+            token = await manager.resolve(token)
+        assert refreshes == ["busy"]
+        assert token == "busy-id-1"
+        assert await manager.resolve("idle-id") == "idle-id"
+        return manager
+
+    manager = asyncio.run(scenario())
+    assert list(manager._sessions.values())[0].email == "busy@example.com"
+    assert len(manager._aliases) == 2
+    stats = manager.snapshot()
+    assert stats["sessions"] == 1 and stats["idleSessions"] == 1 and stats["unmanaged"] == 1
+
+
+def test_graphql_operations_use_variables_and_persisted_queries(run_service):
+    batch = devices_get_batch(2)
+    assert devices_get_batch(2) is batch
+    body = json.loads(batch.body({"d0": "a", "d1": 'b"'}))
+    assert body["operationName"] == "GetDevices2" and body["variables"] == {"d0": "a", "d1": 'b"'}
+    assert "$d1: ID!" in body["query"] and '"a"' not in body["query"]
+    assert "query" not in json.loads(UPDATE_DEVICE_NAME.body({"deviceId": "x"}, persisted=True))
+
+    fake = create_app(FakeHarviaConfig(devices=3, seed=1))
+    sent = []
+
+    class RecordingTransport(httpx.ASGITransport):
+        async def handle_async_request(self, request):
+            if request.url.path == "/graphql/device":
+                sent.append(json.loads(request.content))
+            return await super().handle_async_request(request)
+
+    async def scenario(service):
+        service.ENDPOINTS_URL = "http://fake-harvia.local/endpoints"
+        service.persisted_queries = True
+        first = await service.get_devices("token")
+        second = await service.get_devices("token")
+        renamed = await service.update_device_name("token", fake_device_id(1), 'Sauna "Lakeside"')
+        return first, second, renamed
+
+    first, second, renamed = run_service(RecordingTransport(app=fake), scenario)
+    assert first == second
+    assert {"key": "name", "value": 'Sauna "Lakeside"'} in renamed["attr"]
+    # First run: each hash misses and the full document follows; second run: hashes only
+    assert ["query" in request for request in sent] == [False, True, False, True, False, False, False, True]
+
+
+def test_devices_route_streams_ndjson_as_devices_finish(monkeypatch):
+    async def fetch_details(chunk):
+        if any(summary["id"] == "dev-2" for summary in chunk):
+            raise HarviaAPIError("Batch failed", 502)
+        return {summary["id"]: {**summary, "type": "Detailed"} for summary in chunk}
+
+    async def lookup_alias(device):
+        delay = {"dev-0": 0.05, "dev-4": 1.0}.get(device["id"], 0.0)
+        await asyncio.sleep(delay)
+        device["displayName"] = f"Sauna {device['id']}"
+
+    async def fake_stream_devices(token):
+        summaries = [device_summary(f"dev-{i}") for i in range(5)]
+        deadline_at = asyncio.get_running_loop().time() + 0.3
+        return DeviceStream(summaries, fetch_details, lookup_alias, batch_size=2, limit=4, deadline_at=deadline_at)
+
+    monkeypatch.setattr(harvia_service, "stream_devices", fake_stream_devices)
+
+    response = client.get("/api/harvia/devices", params={"stream": 1}, headers={"Authorization": "Bearer token"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    devices, trailer = lines[:-1], lines[-1]
+    order = [line["device"]["id"] for line in devices]
+    # Fast devices first, the slow alias lookup is cut off by the deadline and sent last
+    assert set(order) == {f"dev-{i}" for i in range(5)} and order.index("dev-0") > order.index("dev-1")
+    assert order[-1] == "dev-4" and devices[-1]["device"]["displayName"] != "Sauna dev-4"
+    assert trailer["type"] == "end" and trailer["count"] == trailer["total"] == 5
+    assert trailer["partial"] and trailer["timedOut"] == ["dev-4"]
+    assert trailer["errors"] == [{"deviceIds": ["dev-2", "dev-3"], "error": "Batch failed"}]
+
+    same = client.get("/api/harvia/devices", headers={"Authorization": "Bearer token", "Accept": "application/x-ndjson"})
+    assert same.text.splitlines()[-1].startswith('{"type":"end"')
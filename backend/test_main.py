@@ -1,3 +1,5 @@
+import json
+
 from fastapi.testclient import TestClient
 
 from main import app
@@ -21,6 +23,67 @@ def test_health_check():
     assert body["service"] == "backend"
 
 
+def test_request_id_is_echoed_or_generated():
+    response = client.get("/health", headers={"X-Request-ID": "req-123"})
+    assert response.headers["X-Request-ID"] == "req-123"
+    generated = client.get("/health").headers["X-Request-ID"]
+    assert generated and generated != "req-123"
+    # IDs that could smuggle text into log records are replaced
+    for unsafe in ["req 1\" injected", "x" * 65, ""]:
+        replaced = client.get("/health", headers={"X-Request-ID": unsafe}).headers["X-Request-ID"]
+        assert replaced != unsafe and len(replaced) == 32
+
+
+def test_request_id_stays_set_while_streaming_a_response():
+    from fastapi import FastAPI
+    from fastapi.responses import StreamingResponse
+
+    from logging_config import CorrelationIdMiddleware, correlation_id
+
+    streaming_app = FastAPI()
+    streaming_app.add_middleware(CorrelationIdMiddleware)
+
+    @streaming_app.get("/stream")
+    async def stream():
+        async def body():
+            for _ in range(2):
+                yield correlation_id.get() + "\n"
+        return StreamingResponse(body(), media_type="application/x-ndjson")
+
+    response = TestClient(streaming_app).get("/stream", headers={"X-Request-ID": "req-stream"})
+    assert response.text.splitlines() == ["req-stream", "req-stream"]
+    assert response.headers["X-Request-ID"] == "req-stream"
+
+
+def test_debug_traces_follow_request_sampling():
+    import json
+    import logging
+
+    from logging_config import ContextFilter, JSONFormatter, _trace_sampled, correlation_id, trace_enabled
+
+    logger = logging.getLogger("test.sampling")
+    logger.setLevel(logging.DEBUG)
+    context_filter = ContextFilter()
+
+    id_token = correlation_id.set("req-1")
+    sampled_token = _trace_sampled.set(False)
+    try:
+        assert not trace_enabled(logger)
+        debug = logger.makeRecord(logger.name, logging.DEBUG, __file__, 1, "payload", None, None)
+        warning = logger.makeRecord(logger.name, logging.WARNING, __file__, 1, "slow %s", ("upstream",), None,
+                                    extra={"fields": {"durationMs": 12}})
+        assert not context_filter.filter(debug)
+        assert context_filter.filter(warning)
+    finally:
+        _trace_sampled.reset(sampled_token)
+        correlation_id.reset(id_token)
+
+    entry = json.loads(JSONFormatter().format(warning))
+    assert entry["message"] == "slow upstream"
+    assert entry["correlationId"] == "req-1"
+    assert entry["durationMs"] == 12
+
+
 def test_ping():
     response = client.get("/api/v1/ping")
     assert response.status_code == 200
@@ -36,6 +99,18 @@ def test_get_devices():
     assert payload["count"] >= 1
 
 
+def test_device_responses_render_the_same_with_or_without_orjson(monkeypatch):
+    from fastapi.encoders import jsonable_encoder
+
+    from routes.sauna_backend import devices
+    from services import fast_json
+
+    expected = client.get("/api/v1/devices").content
+    assert json.loads(expected)["data"] == jsonable_encoder(devices)
+    monkeypatch.setattr(fast_json, "orjson", None)
+    assert client.get("/api/v1/devices").content == expected
+
+
 def test_get_devices_filtered():
     response = client.get("/api/v1/devices", params={"type": "fenix"})
     assert response.status_code == 200
@@ -82,6 +157,99 @@ def test_update_device_target():
     assert payload["data"]["currentReading"]["targetTemp"] == current_target
 
 
+def test_telemetry_push_updates_reading_and_writes_batches(tmp_path, monkeypatch):
+    import asyncio
+
+    from sqlalchemy import create_engine, select
+
+    from db_models import TelemetrySample
+    from services.telemetry_ingest import TelemetryIngestor, telemetry_ingestor
+
+    # Refused while no key is configured, then only with the right key
+    sample = {"samples": [{"deviceId": "push-gateway-1", "temperature": 60}]}
+    monkeypatch.setattr(telemetry_ingestor, "ingest_key", "")
+    assert client.post("/api/v1/telemetry", json=sample).status_code == 403
+    monkeypatch.setattr(telemetry_ingestor, "ingest_key", "gateway-key")
+    assert client.post("/api/v1/telemetry", json=sample, headers={"X-Ingest-Key": "wrong"}).status_code == 401
+
+    response = client.post("/api/v1/telemetry", headers={"X-Ingest-Key": "gateway-key"}, json={"samples": [
+        {"deviceId": "push-gateway-1", "timestamp": "2025-11-15T12:00:05Z", "temperature": 80.5, "humidity": 20},
+        {"deviceId": "push-gateway-1", "timestamp": "2025-11-15T12:00:00Z", "temperature": 70.0},
+        {"deviceId": "push-gateway-1", "timestamp": "2025-11-15T12:00:10Z", "heating": True},
+        {"deviceId": "push-gateway-2", "temperature": "hot"},
+        {"temperature": 75.0},
+    ]})
+    assert response.status_code == 202
+    payload = response.json()
+    assert (payload["accepted"], payload["rejected"], payload["devices"]) == (3, 2, 1)
+    assert [error["index"] for error in payload["errors"]] == [3, 4]
+
+    # Newest sample wins; fields it leaves out keep their last pushed value
+    reading = client.get("/api/v1/devices/push-gateway-1/reading").json()["data"]
+    assert reading["temperature"] == 80.5
+    assert reading["humidity"] == 20
+    assert reading["heating"] is True
+    assert reading["timestamp"].startswith("2025-11-15T12:00:10")
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'telemetry.db'}")
+    TelemetrySample.__table__.create(engine)
+    ingestor = TelemetryIngestor(engine=engine, batch_size=2)
+    ingestor.ingest([{"deviceId": f"sim-{index}", "temperature": 60 + index} for index in range(5)])
+
+    assert asyncio.run(ingestor.flush()) == 5
+    assert ingestor.stats["flushes"] == 3
+    with engine.connect() as connection:
+        rows = connection.execute(select(TelemetrySample.__table__.c.device_id)).all()
+    assert sorted(row[0] for row in rows) == [f"sim-{index}" for index in range(5)]
+
+
+def test_telemetry_ingest_caps_tracked_devices():
+    from services.telemetry_ingest import TelemetryIngestor
+
+    ingestor = TelemetryIngestor(max_devices=2)
+    result = ingestor.ingest([
+        {"deviceId": "gw-1", "temperature": 60},
+        {"deviceId": "gw-2", "temperature": 61},
+        {"deviceId": "gw-3", "temperature": 62},
+        {"deviceId": "gw-1", "temperature": 63},
+        {"deviceId": "gw-4", "temperature": "hot"},
+    ])
+    assert (result["accepted"], result["rejected"]) == (3, 2)
+    assert [error["index"] for error in result["errors"]] == [2, 4]
+    assert sorted(ingestor.latest) == ["gw-1", "gw-2"]
+    assert ingestor.latest["gw-1"]["temperature"] == 63
+    assert ingestor.snapshot()["overDeviceLimit"] == 1
+
+
+def test_telemetry_push_merges_into_device_reading(monkeypatch):
+    from routes.sauna_backend import _find_device
+    from services.telemetry_ingest import telemetry_ingestor
+
+    device = _find_device("junction-sauna-2")
+    monkeypatch.setitem(device, "currentReading", dict(device["currentReading"]))
+    monkeypatch.setattr(telemetry_ingestor, "latest", {})
+    monkeypatch.setattr(telemetry_ingestor, "ingest_key", "gateway-key")
+    headers = {"X-Ingest-Key": "gateway-key"}
+    humidity = device["currentReading"]["humidity"]
+
+    # A first push with only a temperature keeps the device's other fields
+    response = client.post("/api/v1/telemetry", headers=headers, json={"samples": [
+        {"deviceId": "junction-sauna-2", "temperature": 70.0},
+    ]})
+    assert response.status_code == 202
+    reading = client.get("/api/v1/devices/junction-sauna-2/reading").json()["data"]
+    assert reading["temperature"] == 70.0
+    assert reading["humidity"] == humidity and reading["targetTemp"] == 80.0
+
+    # A target set between pushes survives the next push
+    assert client.put("/api/v1/devices/junction-sauna-2/target", json={"targetTemp": 90}).status_code == 200
+    client.post("/api/v1/telemetry", headers=headers, json={"samples": [
+        {"deviceId": "junction-sauna-2", "temperature": 71.0},
+    ]})
+    reading = client.get("/api/v1/devices/junction-sauna-2/reading").json()["data"]
+    assert reading["temperature"] == 71.0 and reading["targetTemp"] == 90.0 and reading["heating"] is True
+
+
 def test_get_device_stats():
     response = client.get("/api/v1/devices/stats")
     assert response.status_code == 200
@@ -139,6 +307,221 @@ def test_knn_train_and_predict():
     assert "predictions" in response.json()
 
 
+def test_knn_versions_are_published_and_activated():
+    low = {"X": [[1, 1], [2, 2], [3, 3]], "y": [0, 0, 0]}
+    high = {"X": [[1, 1], [2, 2], [3, 3]], "y": [1, 1, 1]}
+    first = client.post("/api/models/knn/train", json=low).json()["model_version"]
+    second = client.post("/api/models/knn/train", json=high).json()["model_version"]
+    assert second == first + 1
+
+    predicted = client.post("/api/models/knn/predict", json={"X": [[2, 2]]}).json()
+    assert (predicted["predictions"], predicted["model_version"]) == ([1], second)
+    older = client.post("/api/models/knn/predict", params={"version": first}, json={"X": [[2, 2]]}).json()
+    assert older["predictions"] == [0]
+
+    assert client.post(f"/api/models/knn/versions/{first}/activate").status_code == 200
+    status = client.get("/models/status").json()
+    assert status["knn"] is True
+    assert status["versions"]["knn"]["active_version"] == first
+    assert {first, second} <= set(status["versions"]["knn"]["versions"])
+    assert client.post("/api/models/knn/versions/999999/activate").status_code == 404
+
+
+def test_model_registry_readers_see_only_published_models():
+    import threading
+
+    from models import ModelRegistry
+
+    registry = ModelRegistry(keep_versions=3)
+    seen = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            entry = registry.get("knn")
+            if entry is not None:
+                seen.append((entry.version, entry.model["version"]))
+
+    registry.publish("knn", {"version": 1}, samples_trained=1)
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for version in range(2, 201):
+        registry.publish("knn", {"version": version}, samples_trained=version)
+    done.set()
+    for reader in readers:
+        reader.join()
+
+    assert seen and all(version == model_version for version, model_version in seen)
+    assert registry.status()["knn"]["versions"] == [198, 199, 200]
+    registry.activate("knn", 198)
+    registry.publish("knn", {"version": 201}, samples_trained=1, activate=False)
+    assert registry.get("knn").version == 198
+    assert registry.status()["knn"]["versions"] == [198, 199, 200, 201]
+
+
+def test_ml_executor_bounds_queue_and_times_out_jobs():
+    import asyncio
+    import threading
+
+    import pytest
+
+    from services.ml_executor import MLExecutor, MLExecutorBusy, MLJobTimeout
+
+    executor = MLExecutor(max_workers=1, max_queue=1, timeout_seconds=5)
+    release = threading.Event()
+
+    async def scenario():
+        running = asyncio.ensure_future(executor.run(release.wait, 5))
+        await asyncio.sleep(0.05)
+
+        # The queued job never starts: its timeout drops it and frees the slot
+        queued = asyncio.ensure_future(executor.run(sum, [1, 2, 3], timeout=0.2))
+        await asyncio.sleep(0.05)
+        assert (executor.snapshot()["running"], executor.snapshot()["queued"]) == (1, 1)
+        with pytest.raises(MLExecutorBusy):
+            await executor.run(sum, [1])
+        with pytest.raises(MLJobTimeout):
+            await queued
+        assert executor.snapshot()["queued"] == 0
+
+        release.set()
+        assert await running is True
+
+        # A running job cannot be interrupted; its result is abandoned
+        stuck = threading.Event()
+        with pytest.raises(MLJobTimeout):
+            await executor.run(stuck.wait, 5, timeout=0.05)
+        assert executor.snapshot()["running"] == 1
+        stuck.set()
+        assert await executor.run(sum, [1, 2, 3]) == 6
+
+    asyncio.run(scenario())
+    snapshot = executor.snapshot()
+    assert (snapshot["rejected"], snapshot["timedOut"], snapshot["abandoned"]) == (1, 2, 1)
+    assert snapshot["running"] == snapshot["queued"] == 0
+    executor.shutdown()
+
+    assert client.get("/models/executor").json()["executor"]["kind"] == "thread"
+
+
+def test_ml_executor_errors_map_to_standard_statuses():
+    import asyncio
+
+    from routes.knn import _executor_error
+    from services.ml_executor import MLExecutorBusy, MLJobCancelled, MLJobTimeout
+
+    assert _executor_error(MLExecutorBusy("busy")).status_code == 503
+    assert _executor_error(MLJobTimeout("slow")).status_code == 504
+    # Nobody is left to receive a response for a disconnected client
+    assert isinstance(_executor_error(MLJobCancelled("gone")), asyncio.CancelledError)
+
+
+def test_recommend_session_is_cached_per_user_until_sessions_change(tmp_path):
+    from sqlmodel import Session, SQLModel, create_engine, select
+
+    from database import get_session
+    from db_models import SaunaSession
+    from models import model_manager
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'sessions.db'}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as db:
+        for minutes, temperature in [(20, 70), (45, 80), (50, 82), (90, 90)]:
+            db.add(SaunaSession(duration_seconds=minutes * 60, average_temperature=temperature,
+                                max_temperature=temperature + 5, user_id=1))
+        db.add(SaunaSession(duration_seconds=600, average_temperature=60, max_temperature=65, user_id=2))
+        db.commit()
+
+    def override_session():
+        with Session(engine) as db:
+            yield db
+
+    app.dependency_overrides[get_session] = override_session
+    try:
+        misses = model_manager.user_cache_stats["misses"]
+        first = client.get("/api/models/knn/recommend-session", params={"user_id": 1}).json()
+        assert first["based_on_sessions"] == 4
+        assert client.get("/api/models/knn/recommend-session", params={"user_id": 1}).json() == first
+        assert client.get("/api/models/knn/recommend-session", params={"user_id": 2}).json()["based_on_sessions"] == 1
+        assert model_manager.user_cache_stats["misses"] == misses + 2
+
+        with Session(engine) as db:
+            db.add(SaunaSession(duration_seconds=2700, average_temperature=80, max_temperature=84, user_id=1))
+            db.commit()
+        assert client.get("/api/models/knn/recommend-session", params={"user_id": 1}).json()["based_on_sessions"] == 5
+        assert model_manager.user_cache_stats["misses"] == misses + 3
+
+        # Editing a session changes the data version, so the model is rebuilt
+        with Session(engine) as db:
+            edited = db.exec(select(SaunaSession).where(SaunaSession.user_id == 2)).one()
+            edited.duration_seconds = 3000
+            db.add(edited)
+            db.commit()
+        recommendation = client.get("/api/models/knn/recommend-session", params={"user_id": 2}).json()
+        assert recommendation["recommended_duration_minutes"] == 50
+
+        # Windowed requests are answered but never add cache entries
+        cached_users = len(model_manager._user_models)
+        for limit in range(1, 4):
+            response = client.get("/api/models/knn/recommend-session", params={"user_id": 1, "limit": limit})
+            assert response.json()["based_on_sessions"] == limit
+        assert len(model_manager._user_models) == cached_users
+
+        # Recommendations are always for one user, never the whole table
+        assert client.get("/api/models/knn/recommend-session").status_code == 422
+    finally:
+        app.dependency_overrides.pop(get_session, None)
+
+
+def test_session_columns_are_user_scoped_with_window_and_cap(tmp_path):
+    from datetime import datetime, timedelta
+
+    from sqlmodel import Session, SQLModel, create_engine
+
+    from db_models import SaunaSession
+    from services.session_data import load_session_columns
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'columns.db'}")
+    SQLModel.metadata.create_all(engine)
+    start = datetime(2025, 1, 1)
+    with Session(engine) as db:
+        for day in range(5):
+            db.add(SaunaSession(duration_seconds=600 * (day + 1), average_temperature=70 + day,
+                                max_temperature=90, user_id=1, created_at=start + timedelta(days=day)))
+        db.add(SaunaSession(duration_seconds=60, average_temperature=50, max_temperature=55, user_id=2))
+        db.commit()
+
+        columns = load_session_columns(db, 1)
+        assert columns.size == 5
+        assert sorted(columns.duration_seconds.tolist()) == [600.0, 1200.0, 1800.0, 2400.0, 3000.0]
+
+        recent = load_session_columns(db, 1, since=start + timedelta(days=1), limit=2)
+        assert recent.average_temperature.tolist() == [74.0, 73.0]
+        assert load_session_columns(db, 3).size == 0
+
+
+def test_session_features_match_category_rules():
+    import numpy as np
+
+    from services.session_data import SessionColumns
+    from services.session_features import BALANCED, LONG_HOT, QUICK_COOL, categorize, feature_matrix, mode, summarize
+
+    # Boundaries: 30 min / 75 C are not quick/cool, 60 min / 85 C are not long/hot; short wins over hot
+    minutes = np.array([29, 30, 60, 61, 45, 45, 45, 20])
+    temperatures = np.array([80, 80, 85, 80, 74.9, 75, 85.1, 90])
+    X = feature_matrix(SessionColumns(minutes * 60.0, temperatures))
+    labels = categorize(X)
+    assert labels.tolist() == [QUICK_COOL, BALANCED, BALANCED, LONG_HOT, QUICK_COOL, BALANCED, LONG_HOT, QUICK_COOL]
+
+    assert mode(labels) == QUICK_COOL
+    assert mode(np.array([2, 1, 2, 1])) == 1
+    summary = summarize(X, labels == BALANCED)
+    assert summary.sessions == 3
+    assert summary.mean_duration_minutes == 45
+    assert summarize(X[:0]).sessions == 0
+
+
 def test_svm_train_and_predict():
     train_data = {
         "X": [[1, 2], [2, 3], [3, 4], [4, 5], [5, 6], [6, 7]],
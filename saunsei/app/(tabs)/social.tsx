@@ -40,14 +40,18 @@ export default function SocialScreen() {
     try {
       setLoading(true)
 
-      // Fetch sessions, users, saunas, and recommendation in parallel
-      const [sessionsData, usersData, saunasData, recommendationData] =
-        await Promise.all([
-          backendApi.getSessions(0, 20),
-          backendApi.getDBUsers(0, 100),
-          backendApi.getSaunas(0, 100),
-          backendApi.getSessionRecommendation(),
-        ])
+      // Fetch sessions, users and saunas in parallel
+      const [sessionsData, usersData, saunasData] = await Promise.all([
+        backendApi.getSessions(0, 20),
+        backendApi.getDBUsers(0, 100),
+        backendApi.getSaunas(0, 100),
+      ])
+
+      // Recommendations are per user; use the first user's history
+      const recommendationUserId = usersData[0]?.id
+      const recommendationData = recommendationUserId
+        ? await backendApi.getSessionRecommendation(recommendationUserId)
+        : null
 
       // Create lookup maps
       const usersMap = new Map(usersData.map((u) => [u.id!, u]))
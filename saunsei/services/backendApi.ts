@@ -719,9 +719,9 @@ class BackendApiService {
   // ============================================
 
   /**
-   * Get personalized sauna session recommendations based on historical data
+   * Get personalized sauna session recommendations based on a user's session history
    */
-  async getSessionRecommendation(): Promise<{
+  async getSessionRecommendation(userId: number): Promise<{
     recommended_duration_minutes: number
     recommended_temperature: number
     confidence: number
@@ -729,7 +729,9 @@ class BackendApiService {
     insights: string[]
   } | null> {
     try {
-      return await this.request(`${this.apiUrl}/models/knn/recommend-session`)
+      return await this.request(
+        `${this.apiUrl}/models/knn/recommend-session?user_id=${userId}`
+      )
     } catch (error) {
       console.error("Failed to get session recommendation:", error)
       return null